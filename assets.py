@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import time
+
+import pygame
+
+import engine
+import level
+
+PIXEL_FORMAT = "RGBA"
+ALIGNMENT = 64
+
+
+def build_pack(directory="images", output=engine.PACK_PATH):
+    # Decode every image once so the game only has to map the pixels
+    index = {}
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    # Written next to the pack and swapped in, a running game may have it mapped
+    temporary = output + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(engine.PACK_MAGIC + bytes(8))
+        for path in engine.image_paths(directory):
+            stat = os.stat(path)
+            image = pygame.image.load(path)
+            data = pygame.image.tobytes(image, PIXEL_FORMAT)
+            f.write(bytes(-f.tell() % ALIGNMENT))
+            index[path] = {
+                "format": PIXEL_FORMAT,
+                "size": image.get_size(),
+                "offset": f.tell(),
+                "length": len(data),
+                "mtime_ns": stat.st_mtime_ns,
+                "bytes": stat.st_size,
+            }
+            f.write(data)
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode())
+        f.seek(len(engine.PACK_MAGIC))
+        f.write(index_offset.to_bytes(8, "little"))
+    os.replace(temporary, output)
+    return index
+
+
+def time_startup(directory, pack_path, repeat):
+    # What main.py does before the first menu frame: menu atlas and background
+    times = []
+    for _ in range(repeat):
+        engine.image_pack = engine.ImagePack(pack_path)
+        start = time.perf_counter()
+        engine.Atlas().build(os.path.join(directory, "Menu"))
+        engine.load_image(os.path.join(directory, "Menu/Background.png"))
+        times.append(time.perf_counter() - start)
+    return min(times), engine.image_pack
+
+
+def cmd_build(args):
+    index = build_pack(args.images, args.output)
+    print(
+        f"Packed {len(index)} images into {args.output} "
+        f"({os.path.getsize(args.output) / 2**20:.1f} MiB)"
+    )
+
+
+def cmd_levels(args):
+    for name in args.names or level.available_levels(args.source):
+        data = level.compile_level(name, args.source, args.output)
+        path = os.path.join(args.output, name + ".lvl")
+        print(
+            f"{name}: {len(data.platforms)} platforms, {len(data.spawns)} spawns"
+            f" -> {path} ({os.path.getsize(path)} bytes)"
+        )
+
+
+def cmd_time(args):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    for name, path in (("source files", None), ("pixel pack", args.pack)):
+        seconds, pack = time_startup(args.images, path, args.repeat)
+        print(
+            f"{name:<12} {seconds * 1000:7.1f} ms"
+            f"  ({pack.hits} from pack, {pack.misses} decoded)"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Pre-decode images into a memory-mapped pixel pack."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="write the pixel pack")
+    build.add_argument("--images", default="images")
+    build.add_argument("--output", default=engine.PACK_PATH)
+    build.set_defaults(func=cmd_build)
+
+    levels = subparsers.add_parser("levels", help="compile level sources")
+    levels.add_argument("names", nargs="*", help="default: every level")
+    levels.add_argument("--source", default=level.LEVEL_DIR)
+    levels.add_argument("--output", default=level.COMPILED_LEVEL_DIR)
+    levels.set_defaults(func=cmd_levels)
+
+    timing = subparsers.add_parser(
+        "time", help="compare image loading with and without the pack"
+    )
+    timing.add_argument("--images", default="images")
+    timing.add_argument("--pack", default=engine.PACK_PATH)
+    timing.add_argument("--repeat", type=int, default=5)
+    timing.set_defaults(func=cmd_time)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    main()
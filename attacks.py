@@ -1,21 +1,39 @@
+import time
+from collections import deque
 from math import sqrt
-from engine import Game, Sprite
+
+import numpy as np
+import pygame
+
+from engine import Game, MultiSprite, Sprite
+
+TICK_RATE = 60
+MAX_REWIND_TICKS = 12  # 200 ms, rewinding further is unfair to the target
+
+
+def rewind_ticks(latency):
+    return min(round(latency * TICK_RATE), MAX_REWIND_TICKS)
 
 
 class Attack(Sprite):
-    def __init__(
-        self, game: Game, parent, x_velocity=0, y_velocity=0, damage=5, **kwargs
-    ):
-        super().__init__(game, **kwargs)
+    __slots__ = ("parent", "x_velocity", "y_velocity", "damage")
+
+    def reset(self, parent, x_velocity=0, y_velocity=0, damage=5, **kwargs):
+        super().reset(**kwargs)
         self.parent = parent
         self.x_velocity = x_velocity
         self.y_velocity = y_velocity
         self.damage = damage
 
+    def on_release(self):
+        self.parent = None
+
 
 class ShootAttack(Attack):
-    def __init__(self, *args, max_distance=10000, **kwargs):
-        super().__init__(*args, **kwargs)
+    __slots__ = ("max_distance", "distance")
+
+    def reset(self, *args, max_distance=10000, **kwargs):
+        super().reset(*args, **kwargs)
         self.max_distance = max_distance
         self.distance = 0
         self.game.play_sound("sounds/shoot.wav")
@@ -33,14 +51,273 @@ class ShootAttack(Attack):
                     remove_flag = True
                     if hasattr(obj, "on_hit"):
                         obj.on_hit(self)
-            if remove_flag:
-                self.game.remove_object(self)
-                self.parent._shots -= 1
         if (
-            not (int(self.x) in range(0, self.game.width))
-        ) or self.distance > self.max_distance:
-            self.game.remove_object(self)
+            remove_flag
+            or (not (int(self.x) in range(0, self.game.width)))
+            or self.distance > self.max_distance
+        ):
             self.parent._shots -= 1
-        for image in (self.image1, self.image2):
-            image.set_alpha(max(0, 100 * abs(self.max_distance // self.distance)))
+            self.game.release_object(self)
+            return
         super().loop()
+
+    def alpha(self):
+        # Same as ProjectileSystem.alphas
+        distance = max(self.distance, 1)
+        return min(max(100 * abs(self.max_distance // distance), 0), 255)
+
+    def draw(self):
+        # The image is an atlas region shared with every sprite using it, so
+        # the alpha is only set for this blit
+        image = self.image1 if self.direction == 1 else self.image2
+        alpha = image.get_alpha()
+        image.set_alpha(self.alpha())
+        super().draw()
+        image.set_alpha(alpha)
+
+
+class PositionHistory:
+    # Rects of every hittable sprite over the last ticks, so shots can be
+    # checked against where the shooter saw their target
+    def __init__(self, game: Game, max_rewind=MAX_REWIND_TICKS):
+        self.game = game
+        self.frames = deque(maxlen=max_rewind + 1)
+
+    @classmethod
+    def of(cls, game: Game, name="history"):
+        if name not in game.objects:
+            game.add_object(name, cls)
+        return game.objects[name]
+
+    def loop(self):
+        # Runs after the players moved, so frames[-1] is the current tick
+        self.frames.append(
+            {
+                obj: obj.rect.copy()
+                for obj in self.game.objects.values()
+                if isinstance(obj, Sprite) and hasattr(obj, "on_hit")
+            }
+        )
+
+    def rect(self, sprite, ticks):
+        ticks = min(ticks, len(self.frames) - 1)
+        if ticks <= 0:
+            return sprite.rect
+        return self.frames[-1 - ticks].get(sprite, sprite.rect)
+
+
+class Projectile:
+    # Read-only view of one projectile, passed to on_hit like an Attack
+    def __init__(self, parent, x, y, x_velocity, y_velocity, damage, direction):
+        self.parent = parent
+        self.x = x
+        self.y = y
+        self.x_velocity = x_velocity
+        self.y_velocity = y_velocity
+        self.damage = damage
+        self.direction = direction
+
+
+class ProjectileSystem:
+    fields = (
+        "x",
+        "y",
+        "x_velocity",
+        "y_velocity",
+        "distance",
+        "max_distance",
+        "damage",
+        "width",
+        "height",
+        "direction",
+        "image",
+    )
+
+    def __init__(self, game: Game, capacity=64):
+        self.game = game
+        self.count = 0
+        self.arrays = {name: np.zeros(capacity) for name in self.fields}
+        self.parents = []
+        self.image_paths = []  # Image id -> path
+        self.images = []  # Image id -> (image1, image2)
+
+    @classmethod
+    def of(cls, game: Game, name="projectiles"):
+        if name not in game.objects:
+            game.add_object(name, cls)
+        return game.objects[name]
+
+    def __getattr__(self, name):
+        if name in ProjectileSystem.fields:
+            return self.arrays[name][: self.count]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.count
+
+    def image_id(self, image_path):
+        if image_path not in self.image_paths:
+            self.image_paths.append(image_path)
+            self.images.append(
+                (
+                    self.game.atlas.get(image_path),
+                    self.game.atlas.get(image_path, "flipped"),
+                )
+            )
+        return self.image_paths.index(image_path)
+
+    def spawn(
+        self,
+        parent,
+        image_path,
+        x,
+        y,
+        x_velocity=0,
+        y_velocity=0,
+        damage=5,
+        max_distance=10000,
+        direction=1,
+    ):
+        if self.count == len(self.arrays["x"]):
+            for name, array in self.arrays.items():
+                self.arrays[name] = np.concatenate([array, np.zeros_like(array)])
+        image = self.image_id(image_path)
+        width, height = self.images[image][0].get_size()
+        values = (x, y, x_velocity, y_velocity, 0, max_distance, damage)
+        values += (width, height, direction, image)
+        for name, value in zip(self.fields, values):
+            self.arrays[name][self.count] = value
+        self.parents.append(parent)
+        self.count += 1
+        self.game.play_sound("sounds/shoot.wav")
+
+    def projectile(self, i):
+        return Projectile(
+            self.parents[i],
+            *(
+                getattr(self, name)[i].item()
+                for name in ("x", "y", "x_velocity", "y_velocity", "damage")
+            ),
+            int(self.direction[i]),
+        )
+
+    def targets(self, area=None):
+        # Same candidates as Sprite.colliding, minus other attacks
+        return [
+            sprite
+            for obj in self.game.objects.values()
+            if not isinstance(obj, (Attack, ProjectileSystem))
+            for sprite in (
+                (obj.sprites if area is None else obj.sprites_near(area))
+                if isinstance(obj, MultiSprite)
+                else [obj]
+            )
+            if isinstance(sprite, Sprite) and sprite.collidable
+        ]
+
+    def loop(self):
+        if not self.count:
+            return
+        self.x[:] += self.x_velocity
+        self.y[:] += self.y_velocity
+        self.distance[:] += np.floor(np.hypot(self.x_velocity, self.y_velocity))
+        left, top = np.trunc(self.x), np.trunc(self.y)
+
+        hit = np.zeros(self.count, dtype=bool)
+        area = pygame.Rect(left.min(), top.min(), 0, 0)
+        area.width = (left + self.width).max() - area.x
+        area.height = (top + self.height).max() - area.y
+        targets = self.targets(area)
+        if targets:
+            rects = self.target_rects(targets)
+            overlap = (
+                (left[:, None] < rects[..., 0] + rects[..., 2])
+                & (left[:, None] + self.width[:, None] > rects[..., 0])
+                & (top[:, None] < rects[..., 1] + rects[..., 3])
+                & (top[:, None] + self.height[:, None] > rects[..., 1])
+                & (rects[..., 2] > 0)
+                & (rects[..., 3] > 0)
+            )
+            # A projectile never hits the player who fired it
+            index = {id(target): j for j, target in enumerate(targets)}
+            for i, parent in enumerate(self.parents):
+                if id(parent) in index:
+                    overlap[i, index[id(parent)]] = False
+            hit = overlap.any(axis=1)
+            for i, j in zip(*np.nonzero(overlap)):
+                if hasattr(targets[j], "on_hit"):
+                    targets[j].on_hit(self.projectile(i))
+
+        removed = (
+            hit
+            | (left < 0)
+            | (left >= self.game.width)
+            | (self.distance > self.max_distance)
+        )
+        if removed.any():
+            for i in np.flatnonzero(removed):
+                self.parents[i]._shots -= 1
+            self.compact(~removed)
+        self.draw()
+
+    def target_rects(self, targets):
+        # One row of target rects per projectile, rewound by its shooter's lag
+        rects = np.array([target.rect for target in targets], dtype=float)
+        rects = np.broadcast_to(rects, (self.count, *rects.shape))
+        history = self.game.objects.get("history")
+        if history is None:
+            return rects
+        rewinds = np.array([getattr(parent, "rewind", 0) for parent in self.parents])
+        for rewind in set(rewinds.tolist()) - {0}:
+            if not rects.flags.writeable:
+                rects = rects.copy()
+            rects[rewinds == rewind] = [
+                history.rect(target, rewind) for target in targets
+            ]
+        return rects
+
+    def compact(self, keep):
+        kept = np.flatnonzero(keep)
+        for array in self.arrays.values():
+            array[: len(kept)] = array[kept]
+        self.parents = [self.parents[i] for i in kept]
+        self.count = len(kept)
+
+    def alphas(self):
+        distance = np.maximum(self.distance, 1)
+        return np.clip(100 * np.abs(self.max_distance // distance), 0, 255)
+
+    def draw(self):
+        if not self.count:
+            return
+        profiler = self.game.profiler
+        start = time.perf_counter()
+        positions = np.stack([self.x, self.y], axis=1).astype(int)
+        keys = np.stack(
+            [self.image, self.direction == 1, self.alphas()], axis=1
+        ).astype(int)
+        # Few distinct (image, direction, alpha) groups, so set alpha once per group
+        for image, facing_right, alpha in np.unique(keys, axis=0):
+            # Atlas regions are shared with other sprites, restore their alpha
+            surface = self.images[image][0 if facing_right else 1]
+            previous = surface.get_alpha()
+            surface.set_alpha(int(alpha))
+            mask = np.all(keys == (image, facing_right, alpha), axis=1)
+            self.game.blits([(surface, pos) for pos in positions[mask].tolist()])
+            surface.set_alpha(previous)
+        if profiler.detailed:
+            profiler.draw_time += time.perf_counter() - start
+
+    def sprite_states(self):
+        return [
+            (self.image_paths[int(image)], x, y, int(direction))
+            for image, x, y, direction in zip(
+                self.image.tolist(),
+                self.x.tolist(),
+                self.y.tolist(),
+                self.direction.tolist(),
+            )
+        ]
+
+    def state(self):
+        return tuple(getattr(self, name).tolist() for name in self.fields)
@@ -0,0 +1,512 @@
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import pygame
+
+import attacks
+import network
+from engine import Game, Sprite
+from level import Level
+from player import Player
+
+SCREEN_SIZE = (1280, 720)
+DEFAULT_COUNTS = (10, 100, 1000)
+LEVEL_IMAGES = 19
+PLAYER_IMAGES = tuple(f"images/player{i}.png" for i in range(3))
+
+scenarios = {}
+
+
+def scenario(name):
+    def decorator(func):
+        scenarios[name] = func
+        return func
+
+    return decorator
+
+
+def make_game(renderer=None):
+    game = Game(SCREEN_SIZE, renderer=renderer)
+    game.fps = 0
+    return game
+
+
+def add_level(game, count, rng):
+    return game.add_object(
+        "level",
+        Level,
+        sprite_args=[
+            {
+                "image_path": f"images/level/{i % LEVEL_IMAGES}.png",
+                "x": rng.uniform(0, game.width),
+                "y": rng.uniform(100, game.height),
+            }
+            for i in range(count)
+        ],
+    )
+
+
+def add_player(game, name, x, y):
+    return game.add_object(
+        name,
+        Player,
+        image_path="images/player0.png",
+        x=x,
+        y=y,
+        move_acceleration=4,
+        friction=0.25,
+        jump_acceleration=24,
+        gravity=2,
+    )
+
+
+@scenario("sprite_colliding")
+def bench_sprite_colliding(count, rng):
+    game = make_game()
+    add_level(game, count, rng)
+    # Above every platform, so each call scans all of them without an early hit
+    probe = Sprite(game, "images/player0.png", x=game.width / 2, y=-200)
+    return probe.colliding
+
+
+def make_sprites(game, count, rng, cls=Sprite, **kwargs):
+    return [
+        cls(
+            game,
+            image_path=PLAYER_IMAGES[i % len(PLAYER_IMAGES)],
+            x=rng.uniform(0, game.width),
+            y=rng.uniform(0, game.height),
+            **kwargs,
+        )
+        for i in range(count)
+    ]
+
+
+@scenario("sprite_create")
+def bench_sprite_create(count, rng):
+    # Allocated bytes over count are about the memory each sprite takes
+    game = make_game()
+    return lambda: make_sprites(game, count, rng)
+
+
+@scenario("player_create")
+def bench_player_create(count, rng):
+    game = make_game()
+    physics = {
+        "move_acceleration": 4,
+        "friction": 0.25,
+        "jump_acceleration": 24,
+        "gravity": 2,
+    }
+    return lambda: make_sprites(game, count, rng, Player, **physics)
+
+
+@scenario("sprite_move")
+def bench_sprite_move(count, rng):
+    sprites = make_sprites(make_game(), count, rng)
+
+    def run():
+        for sprite in sprites:
+            sprite.x_move(5.5)
+            sprite.y_move(-5.5)
+            sprite.x_move(-5.5)
+            sprite.y_move(5.5)
+
+    return run
+
+
+@scenario("sprite_read")
+def bench_sprite_read(count, rng):
+    sprites = make_sprites(make_game(), count, rng)
+
+    def run():
+        for sprite in sprites:
+            sprite.x + sprite.y + sprite.rect.top + sprite.direction
+
+    return run
+
+
+@scenario("player_simulate")
+def bench_player_simulate(count, rng):
+    game = make_game()
+    add_level(game, count, rng)
+    player = add_player(game, "player0", game.width / 2, 0)
+
+    def run():
+        player.x, player.y = game.width / 2, 0
+        player.x_velocity, player.y_velocity = 4, 8
+        player.simulate()
+
+    return run
+
+
+@scenario("level_loop")
+def bench_level_loop(count, rng):
+    game = make_game()
+    level = add_level(game, count, rng)
+    level.y_velocity = 1
+    for sprite in level.sprites:
+        sprite.teleport = {"+y": {game.height: 0}}
+    return level.loop
+
+
+@scenario("shoot_attack_loop")
+def bench_shoot_attack_loop(count, rng):
+    game = make_game()
+    add_level(game, 20, rng)
+    parent = add_player(game, "player0", 0, game.height - 100)
+    add_player(game, "player1", game.width - 100, game.height - 100)
+    # Keep projectiles above the level so they fly without hitting anything
+    shots = [
+        game.add_object(
+            f"shoot_attack{i}",
+            attacks.ShootAttack,
+            parent=parent,
+            max_distance=10**9,
+            x_velocity=14,
+            image_path="images/attacks/shoot0.png",
+            x=rng.uniform(0, game.width / 2),
+            y=rng.uniform(-90, 0),
+            collidable=False,
+        )
+        for i in range(count)
+    ]
+    starts = [shot.x for shot in shots]
+
+    def run():
+        for shot, x in zip(shots, starts):
+            shot.x = x
+            shot.loop()
+
+    return run
+
+
+def rewind_game(game, rng):
+    # Four players with different lag and a full position history
+    history = attacks.PositionHistory.of(game)
+    players = [game.objects[f"player{i}"] for i in range(2)]
+    players += [add_player(game, f"player{i}", 200 * i, 300) for i in (2, 3)]
+    for i, player in enumerate(players):
+        player.rewind = 3 * i
+    for _ in range(attacks.MAX_REWIND_TICKS + 1):
+        for player in players:
+            player.x += rng.uniform(-5, 5)
+        history.loop()
+    return history, players
+
+
+@scenario("history_lookup")
+def bench_history_lookup(count, rng):
+    game = make_game()
+    add_player(game, "player0", 0, 0)
+    add_player(game, "player1", 100, 0)
+    history, players = rewind_game(game, rng)
+    lookups = [
+        (rng.choice(players), rng.randrange(attacks.MAX_REWIND_TICKS + 1))
+        for _ in range(count)
+    ]
+
+    def run():
+        for player, ticks in lookups:
+            history.rect(player, ticks)
+
+    return run
+
+
+@scenario("projectile_system")
+def bench_projectile_system(count, rng, rewind=False):
+    game = make_game()
+    add_level(game, 20, rng)
+    parents = [add_player(game, "player0", 0, game.height - 100)]
+    add_player(game, "player1", game.width - 100, game.height - 100)
+    if rewind:
+        _, parents = rewind_game(game, rng)
+    projectiles = attacks.ProjectileSystem.of(game)
+    for i in range(count):
+        projectiles.spawn(
+            parent=parents[i % len(parents)],
+            image_path="images/attacks/shoot0.png",
+            x=rng.uniform(0, game.width / 2),
+            y=rng.uniform(-90, 0),
+            x_velocity=14,
+            max_distance=10**9,
+        )
+    starts = projectiles.x.copy()
+
+    def run():
+        projectiles.x[:] = starts
+        projectiles.loop()
+
+    return run
+
+
+@scenario("projectile_system_rewind")
+def bench_projectile_system_rewind(count, rng):
+    return bench_projectile_system(count, rng, rewind=True)
+
+
+@scenario("game_loop")
+def bench_game_loop(count, rng, renderer=None):
+    game = make_game(renderer)
+    add_level(game, 20, rng)
+    for i in range(count):
+        game.add_object(
+            f"sprite{i}",
+            Sprite,
+            image_path=f"images/player{i % 3}.png",
+            x=rng.uniform(0, game.width),
+            y=rng.uniform(-200, 0),
+            collidable=False,
+        )
+    return game.loop
+
+
+@scenario("game_loop_software_renderer")
+def bench_game_loop_software_renderer(count, rng):
+    return bench_game_loop(count, rng, "software")
+
+
+def make_server(count, rng):
+    server = network.Server()
+    server.game = make_game()
+    add_level(server.game, count, rng)
+    for i in range(4):
+        add_player(server.game, f"player{i}", 100 * i, 0)
+    return server
+
+
+@scenario("server_serialize_game")
+def bench_server_serialize_game(count, rng):
+    return make_server(count, rng).serialize_game
+
+
+@scenario("server_encode_snapshot")
+def bench_server_encode_snapshot(count, rng):
+    return make_server(count, rng).encode_snapshot
+
+
+def make_client(count, rng):
+    # With the server's snapshot stored as if it had just arrived
+    client = network.Client("127.0.0.1", 0)
+    client.game = make_game()
+    data = make_server(count, rng).encode_snapshot()
+    client.receive_buffer[: len(data)] = data
+    client.store_snapshot(len(data))
+    return client, data
+
+
+@scenario("client_decode")
+def bench_client_decode(count, rng):
+    client, _ = make_client(count, rng)
+
+    def run():
+        for _ in client.snapshot_entities():
+            pass
+
+    return run
+
+
+@scenario("client_receive")
+def bench_client_receive(count, rng):
+    # Over loopback, from the datagram arriving to the snapshot being stored
+    client, data = make_client(count, rng)
+    client.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.client.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = client.client.getsockname()
+
+    def run():
+        sender.sendto(data, address)
+        client.last_sequence = 0
+        client.store_snapshot(client.receive_into())
+
+    return run
+
+
+@scenario("client_reconcile")
+def bench_client_reconcile(count, rng):
+    # A shot appears and lands every other frame, the rest only move
+    client, _ = make_client(count, rng)
+    entities = list(client.snapshot_entities())
+    states = [entities, entities + [("shoot_attack0", entities[0][1], 0, 0, 1)]]
+    frame = iter(range(10**12))
+
+    def run():
+        client.reconcile(states[next(frame) % 2])
+
+    return run
+
+
+def measure(func, repeat, min_time):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        "number": number,
+        "best": min(samples),
+        "median": statistics.median(samples),
+        "samples": samples,
+        "allocated": measure_allocations(func),
+    }
+
+
+def measure_allocations(func, calls=5):
+    # Most bytes allocated at once during a call, over what it left behind
+    started = tracemalloc.is_tracing()
+    if not started:
+        tracemalloc.start()
+    peak = 0
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    if not started:
+        tracemalloc.stop()
+    return peak
+
+
+def run_benchmarks(counts=DEFAULT_COUNTS, names=None, repeat=5, min_time=0.2, seed=0):
+    for name, setup in scenarios.items():
+        if names and not any(pattern in name for pattern in names):
+            continue
+        for count in counts:
+            func = setup(count, random.Random(seed))
+            result = measure(func, repeat, min_time)
+            yield f"{name}[{count}]", {"scenario": name, "count": count} | result
+
+
+def compare(baseline, current, threshold):
+    rows = []
+    for key, result in current["results"].items():
+        if key not in baseline["results"]:
+            rows.append((key, None, result["best"], None, "new"))
+            continue
+        before = baseline["results"][key]["best"]
+        ratio = result["best"] / before if before else float("inf")
+        status = (
+            "REGRESSION"
+            if ratio > 1 + threshold
+            else "improved" if ratio < 1 - threshold else "ok"
+        )
+        rows.append((key, before, result["best"], ratio, status))
+    return rows
+
+
+def format_time(seconds):
+    if seconds is None:
+        return "-"
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def cmd_run(args):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    results = {}
+    for key, result in run_benchmarks(
+        args.counts, args.filter, args.repeat, args.min_time, args.seed
+    ):
+        results[key] = result
+        print(
+            f"{key:<36} {format_time(result['best']):>10} per op"
+            f" {result['allocated']:>10} B allocated"
+        )
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
+    if args.baseline:
+        return report_comparison(load(args.baseline), report, args.threshold)
+    return 0
+
+
+def report_comparison(baseline, current, threshold):
+    rows = compare(baseline, current, threshold)
+    for key, before, after, ratio, status in rows:
+        print(
+            f"{key:<36} {format_time(before):>10} -> {format_time(after):>10}"
+            f" {'' if ratio is None else f'{ratio:.2f}x':>7}  {status}"
+        )
+    return 1 if any(row[4] == "REGRESSION" for row in rows) else 0
+
+
+def cmd_compare(args):
+    return report_comparison(load(args.baseline), load(args.current), args.threshold)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Headless microbenchmarks for engine and network hot paths."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run benchmarks and save results")
+    run.add_argument("--counts", type=int, nargs="+", default=list(DEFAULT_COUNTS))
+    run.add_argument(
+        "--filter", nargs="+", help="only run scenarios containing these names"
+    )
+    run.add_argument("--repeat", type=int, default=5)
+    run.add_argument("--min-time", type=float, default=0.2, help="seconds per sample")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--output", default="bench.json")
+    run.add_argument("--baseline", help="compare against this results file")
+    run.add_argument("--threshold", type=float, default=0.1)
+    run.set_defaults(func=cmd_run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="flag regressions between two results files"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown that counts as a regression",
+    )
+    compare_parser.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,45 +1,806 @@
+import cProfile
+import csv
+import json
+import mmap
+import os
+import pstats
+import threading
+import time
+import weakref
+from collections import deque
+from datetime import datetime
+
 import pygame
 
+PROFILE_DIR = "profiles"
+
+
+class FrameProfiler:
+    phases = ("events", "background", "func", "update", "flip")
+    overlay_key = pygame.K_F3
+    export_key = pygame.K_F4
+    capture_key = pygame.K_F5
+
+    def __init__(self, game, history=600, capture_frames=120):
+        self.game = game
+        self.frames = deque(maxlen=history)
+        self.capture_frames = capture_frames
+        self.detailed = False  # Per-object timing, only while needed
+        self.overlay = False
+        self.font = None
+        self.draw_time = 0
+        self.objects = {}
+        self.counters = {}  # Name -> per second rates, shown in the overlay
+        self.profile = None
+        self.profile_frames_left = 0
+
+    def handle_event(self, event):
+        if event.type != pygame.KEYDOWN:
+            return
+        if event.key == self.overlay_key:
+            self.overlay = not self.overlay
+            self.detailed = self.overlay
+        elif event.key == self.export_key:
+            print("Frame timings written to", self.export_csv())
+        elif event.key == self.capture_key:
+            self.capture()
+
+    def start_frame(self):
+        self.objects = {}
+        if self.profile_frames_left and self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def end_frame(self, timings):
+        self.frames.append(timings | {"objects": self.objects})
+        if self.profile is not None:
+            self.profile_frames_left -= 1
+            if not self.profile_frames_left:
+                self.profile.disable()
+                print("Profile written to", self.save_profile())
+
+    def add_object(self, obj, elapsed):
+        # Draw time is collected by Sprite.draw while the object loops
+        stats = self.objects.setdefault(type(obj).__name__, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed - self.draw_time
+        stats[2] += self.draw_time
+        self.draw_time = 0
+
+    def capture(self, frames=None):
+        self.profile_frames_left = frames or self.capture_frames
+
+    def output_path(self, prefix, extension):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        return os.path.join(
+            PROFILE_DIR, f"{prefix}-{datetime.now():%Y%m%d-%H%M%S}.{extension}"
+        )
+
+    def save_profile(self):
+        path = self.output_path("profile", "prof")
+        self.profile.dump_stats(path)
+        pstats.Stats(self.profile).sort_stats("cumulative").print_stats(20)
+        self.profile = None
+        return path
+
+    def export_csv(self, path=None):
+        path = path or self.output_path("frames", "csv")
+        types = sorted({name for frame in self.frames for name in frame["objects"]})
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ["frame", *self.phases, "total"]
+                + [f"{name}.{kind}" for name in types for kind in ("update", "draw")]
+            )
+            for i, frame in enumerate(self.frames):
+                writer.writerow(
+                    [i, *(frame[phase] for phase in self.phases), frame["total"]]
+                    + [
+                        value
+                        for name in types
+                        for value in frame["objects"].get(name, (0, 0, 0))[1:]
+                    ]
+                )
+        return path
+
+    def averages(self, frames=60):
+        recent = list(self.frames)[-frames:]
+        if not recent:
+            return {}, {}
+        phases = {
+            phase: sum(frame[phase] for frame in recent) / len(recent)
+            for phase in (*self.phases, "total")
+        }
+        objects = {}
+        for frame in recent:
+            for name, (count, update, draw) in frame["objects"].items():
+                stats = objects.setdefault(name, [0, 0.0, 0.0])
+                stats[0] = max(stats[0], count)
+                stats[1] += update / len(recent)
+                stats[2] += draw / len(recent)
+        return phases, objects
+
+    def draw_overlay(self):
+        if self.font is None:
+            self.font = pygame.font.Font(None, 22)
+        phases, objects = self.averages()
+        if not phases:
+            return
+        lines = [
+            f"{1 / phases['total'] if phases['total'] else 0:.0f} FPS"
+            f"  frame {phases['total'] * 1000:.2f} ms"
+        ]
+        lines += [
+            f"{phase:<10} {phases[phase] * 1000:6.2f} ms" for phase in self.phases
+        ]
+        for name, (count, update, draw) in sorted(
+            objects.items(), key=lambda item: -(item[1][1] + item[1][2])
+        )[:8]:
+            lines.append(
+                f"{name} x{count}  update {update * 1000:.2f} ms"
+                f"  draw {draw * 1000:.2f} ms"
+            )
+        for name, stats in self.game.pool_stats().items():
+            lines.append(
+                f"pool {name}  {stats['in_use']} in use  {stats['free']} free"
+                f"  {stats['created']} created"
+            )
+        for name, rates in self.counters.items():
+            lines.append(
+                f"{name}  "
+                + "  ".join(f"{rate:.1f} {key}/s" for key, rate in rates.items())
+            )
+        if self.profile is not None:
+            lines.append(f"profiling, {self.profile_frames_left} frames left")
+        surfaces = [self.font.render(line, True, "white") for line in lines]
+        width = max(surface.get_width() for surface in surfaces) + 10
+        height = sum(surface.get_height() for surface in surfaces) + 10
+        panel = pygame.Surface((width, height), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        y = 5
+        for surface in surfaces:
+            panel.blit(surface, (5, y))
+            y += surface.get_height()
+        self.game.screen.blit(panel, (0, 0))
+
+
+class Pool:
+    def __init__(self, game, cls):
+        self.game = game
+        self.cls = cls
+        self.free = []
+        # Weak so objects dropped without release (e.g. objects.clear()) can die
+        self.active = weakref.WeakSet()
+        self.created = 0
+        self.reused = 0
+        self.peak = 0
+
+    def acquire(self, *args, **kwargs):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args, **kwargs)
+            self.reused += 1
+        else:
+            obj = self.cls(self.game, *args, **kwargs)
+            self.created += 1
+        self.active.add(obj)
+        self.peak = max(self.peak, len(self.active))
+        return obj
+
+    def release(self, obj):
+        if obj not in self.active:
+            return False
+        self.active.discard(obj)
+        if hasattr(obj, "on_release"):
+            obj.on_release()
+        self.free.append(obj)
+        return True
+
+    def stats(self):
+        return {
+            "in_use": len(self.active),
+            "free": len(self.free),
+            "peak": self.peak,
+            "created": self.created,
+            "reused": self.reused,
+        }
+
+
+HOVER_SCALE = 1.3
+IMAGE_EXTENSIONS = (".png", ".svg", ".jpg", ".bmp")
+PACK_PATH = "build/images.pack"
+PACK_MAGIC = b"FPSPACK1"
+
+
+class ImagePack:
+    # Raw pixels written by `python assets.py build`, memory-mapped on first use
+    def __init__(self, path=PACK_PATH):
+        self.path = path
+        self.index = None
+        self.buffer = None
+        self.hits = 0
+        self.misses = 0
+
+    def open(self):
+        self.index = {}
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+        if data[: len(PACK_MAGIC)] != PACK_MAGIC:
+            return
+        # Magic, index offset, pixel data, JSON index
+        start = len(PACK_MAGIC)
+        index_offset = int.from_bytes(data[start : start + 8], "little")
+        self.index = json.loads(data[index_offset:])
+        self.buffer = memoryview(data)
+
+    def fresh(self, path, entry):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return entry["mtime_ns"] == stat.st_mtime_ns and entry["bytes"] == stat.st_size
+
+    def load(self, path):
+        if self.index is None:
+            self.open()
+        entry = self.index.get(path)
+        if entry is None or not self.fresh(path, entry):
+            self.misses += 1
+            return pygame.image.load(path)
+        self.hits += 1
+        offset, length = entry["offset"], entry["length"]
+        return pygame.image.frombuffer(
+            self.buffer[offset : offset + length], entry["size"], entry["format"]
+        )
+
+
+image_pack = ImagePack()
+
+
+def load_image(path):
+    return image_pack.load(path)
+
+
+def image_paths(directory):
+    for root, _, files in os.walk(directory):
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, file).replace(os.sep, "/")
+
+
+class Atlas:
+    variants = {
+        "normal": lambda image: image,
+        "flipped": lambda image: pygame.transform.flip(image, True, False),
+        "hover": lambda image: pygame.transform.scale(
+            image,
+            (
+                int(image.get_width() * HOVER_SCALE),
+                int(image.get_height() * HOVER_SCALE),
+            ),
+        ),
+    }
+
+    def __init__(self, page_size=2048, max_size=1024, flip_copies=True):
+        self.page_size = page_size
+        self.max_size = max_size  # Bigger images (backgrounds) are not packed
+        # Without flipped copies, "flipped" regions share the normal pixels and
+        # are listed in mirrored for a renderer that can flip while drawing
+        self.flip_copies = flip_copies
+        self.mirrored = weakref.WeakSet()
+        self.pages = []
+        self.regions = {}  # (image path, variant) -> subsurface of a page
+
+    def build(self, directory="images", hover_directories=("Menu",)):
+        items = []
+        for root, _, files in os.walk(directory):
+            hover = os.path.basename(root) in hover_directories
+            for file in sorted(files):
+                if not file.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, file).replace(os.sep, "/")
+                image = load_image(path)
+                if max(image.get_size()) > self.max_size:
+                    continue
+                variants = ("normal", "flipped", "hover") if hover else None
+                items += self.variant_items(path, image, variants)
+        self.pack(items)
+        return self
+
+    def add(self, images):
+        # Decoded elsewhere (see Prefetcher), packed together onto new pages
+        items = []
+        for path, image in images.items():
+            if max(image.get_size()) <= self.max_size:
+                items += self.variant_items(path, image)
+        self.pack(items)
+
+    def variant_items(self, path, image, variants=None):
+        return [
+            ((path, variant), self.variants[variant](image))
+            for variant in variants or ("normal", "flipped")
+            if (path, variant) not in self.regions
+            and (self.flip_copies or variant != "flipped")
+        ]
+
+    def get(self, image_path, variant="normal"):
+        if (image_path, variant) not in self.regions:
+            # Not prebuilt: give the image its own small page
+            image = load_image(image_path)
+            self.pack(
+                self.variant_items(image_path, image, ("normal", "flipped", variant))
+            )
+        if (image_path, variant) not in self.regions:
+            self.add_mirror(image_path)
+        return self.regions[(image_path, variant)]
+
+    def add_mirror(self, image_path):
+        region = self.regions[(image_path, "normal")]
+        mirror = region.get_parent().subsurface(region.get_offset(), region.get_size())
+        self.mirrored.add(mirror)
+        self.regions[(image_path, "flipped")] = mirror
+
+    def pack(self, items):
+        # Shelf packing, tallest first
+        items = sorted(items, key=lambda item: -item[1].get_height())
+        pages = [[]]
+        x = y = shelf = 0
+        for key, image in items:
+            width, height = image.get_size()
+            if x + width > self.page_size:
+                x, y, shelf = 0, y + shelf, 0
+            if pages[-1] and y + height > self.page_size:
+                pages.append([])
+                x = y = shelf = 0
+            pages[-1].append((key, image, x, y))
+            x += width
+            shelf = max(shelf, height)
+        for placed in pages:
+            if placed:
+                self.add_page(placed)
+
+    def add_page(self, placed):
+        size = (
+            max(x + image.get_width() for _, image, x, _ in placed),
+            max(y + image.get_height() for _, image, _, y in placed),
+        )
+        page = pygame.Surface(size, pygame.SRCALPHA)
+        for _, image, x, y in placed:
+            page.blit(image, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+        if pygame.display.get_surface() is not None:
+            page = page.convert_alpha()
+        self.pages.append(page)
+        for key, image, x, y in placed:
+            self.regions[key] = page.subsurface((x, y, *image.get_size()))
+            if key[1] == "normal" and not self.flip_copies:
+                self.add_mirror(key[0])
+
+    def stats(self):
+        return {
+            "pages": len(self.pages),
+            "regions": len(self.regions),
+            "pixels": sum(page.get_width() * page.get_height() for page in self.pages),
+        }
+
+
+atlases = {}  # Shared by every Game in the process
+
+
+def shared_atlas(flip_copies=True):
+    if flip_copies not in atlases:
+        atlases[flip_copies] = Atlas(flip_copies=flip_copies)
+    return atlases[flip_copies]
+
+
+class Prefetcher:
+    # Decodes assets on a worker thread while a menu or lobby is on screen.
+    # Packing needs the display, so install() does that on the game thread
+    def __init__(self, func=None, images=()):
+        self.func = func  # Called with the prefetcher, its result is kept
+        self.paths = list(images)
+        self.images = {}
+        self.result = None
+        self.error = None
+        self.installed = False
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            if self.func:
+                self.result = self.func(self)
+            self.load_images(self.paths)
+        except Exception as e:
+            # Whatever is missing gets loaded on first use instead
+            self.error = e
+        finally:
+            self.ready.set()
+
+    def load_images(self, paths):
+        for path in paths:
+            if path not in self.images:
+                self.images[path] = load_image(path)
+
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def install(self, atlas):
+        if self.installed or not self.ready.is_set():
+            return False
+        atlas.add(self.images)
+        self.installed = True
+        return True
+
+
+RENDERER = "surface"  # Default for new Games, see renderers
+RESOLUTION = None  # Default logical resolution, None draws at window size
+
+
+class Renderer:
+    # With a logical resolution, everything is drawn at that size and scaled
+    # to the largest centred rect of the same aspect that fits the window
+    def fit(self, window_size, resolution):
+        self.resolution = resolution
+        if resolution is None:
+            self.viewport = pygame.Rect((0, 0), window_size)
+            return
+        scale = min(window_size[0] / resolution[0], window_size[1] / resolution[1])
+        self.viewport = pygame.Rect(
+            0, 0, int(resolution[0] * scale), int(resolution[1] * scale)
+        )
+        self.viewport.center = (window_size[0] // 2, window_size[1] // 2)
+
+    def to_logical(self, position):
+        if self.resolution is None:
+            return position
+        return (
+            (position[0] - self.viewport.x) * self.resolution[0] / self.viewport.width,
+            (position[1] - self.viewport.y) * self.resolution[1] / self.viewport.height,
+        )
+
+    def event_position(self, position):
+        # Of a mouse event, mouse.get_pos() goes through to_logical()
+        return self.to_logical(position)
+
+
+class SurfaceRenderer(Renderer):
+    # CPU blits onto the display surface
+    flips = False
+
+    def __init__(self, screen_size, resolution=None):
+        self.window = pygame.display.set_mode(screen_size)
+        self.fit(self.window.get_size(), resolution)
+        self.screen = self.window
+        if self.viewport.size != self.window.get_size():
+            self.screen = pygame.Surface(resolution).convert()
+            self.window.fill("black")
+            self.scaled = self.window.subsurface(self.viewport)
+
+    def begin_frame(self, background=None):
+        if background:
+            self.screen.blit(background, (0, 0))
+        else:
+            self.screen.fill("black")
+
+    def blit(self, image, position):
+        self.screen.blit(image, position)
+
+    def blits(self, items):
+        self.screen.blits(items, doreturn=False)
+
+    def present(self):
+        if self.screen is not self.window:
+            pygame.transform.scale(self.screen, self.viewport.size, self.scaled)
+        pygame.display.flip()
+
+    def close(self):
+        pass
+
+
+class TextureRenderer(Renderer):
+    # SDL renderer: every surface drawn through blit is uploaded once as a
+    # texture (atlas pages as a whole) and mirrored images are flipped by the
+    # renderer. Anything drawn on screen directly is composited on top.
+    flips = True
+    shared = None  # [window, renderer, users], reused by later Games like set_mode
+
+    def __init__(self, screen_size, resolution=None, accelerated=-1):
+        from pygame._sdl2 import video
+
+        self.video = video
+        size = (
+            screen_size if all(screen_size) else pygame.display.get_desktop_sizes()[0]
+        )
+        if TextureRenderer.shared is None:
+            window = video.Window(size=size)
+            TextureRenderer.shared = [
+                window,
+                video.Renderer(window, accelerated=accelerated),
+                0,
+            ]
+        self.window, self.renderer, _ = TextureRenderer.shared
+        TextureRenderer.shared[2] += 1
+        self.closed = False
+        self.window.size = size
+        self.fit(size, resolution)
+        if resolution is not None:
+            # The renderer scales and letterboxes like fit()
+            self.renderer.logical_size = resolution
+            size = resolution
+        self.screen = pygame.Surface(size, pygame.SRCALPHA)
+        self.overlay = video.Texture(self.renderer, size, streaming=True)
+        self.overlay.blend_mode = pygame.BLENDMODE_BLEND
+        self.textures = weakref.WeakKeyDictionary()
+        self.mirrored = ()
+
+    def texture(self, surface):
+        if surface not in self.textures:
+            self.textures[surface] = self.video.Texture.from_surface(
+                self.renderer, surface
+            )
+        return self.textures[surface]
+
+    def begin_frame(self, background=None):
+        self.renderer.draw_color = (0, 0, 0, 255)
+        self.renderer.clear()
+        self.screen.fill((0, 0, 0, 0))
+        if background:
+            self.blit(background, (0, 0))
+
+    def blit(self, image, position):
+        page = image.get_abs_parent()
+        texture = self.texture(page)
+        texture.alpha = 255 if image.get_alpha() is None else image.get_alpha()
+        width, height = image.get_size()
+        texture.draw(
+            (*image.get_abs_offset(), width, height),
+            (int(position[0]), int(position[1]), width, height),
+            flip_x=image in self.mirrored,
+        )
+
+    def blits(self, items):
+        for image, position in items:
+            self.blit(image, position)
+
+    def event_position(self, position):
+        # SDL already maps mouse events to the renderer's logical size
+        return position
+
+    def present(self):
+        self.overlay.update(self.screen)
+        self.overlay.draw()
+        self.renderer.present()
+
+    def close(self):
+        # The window stays until the last Game using it is done, a nested
+        # Game (a match started from a menu) returns to a live one
+        shared = TextureRenderer.shared
+        if self.closed or not shared or shared[0] is not self.window:
+            return
+        self.closed = True
+        shared[2] -= 1
+        if not shared[2]:
+            TextureRenderer.shared = None
+            self.window.destroy()
+
+
+renderers = {
+    "surface": SurfaceRenderer,
+    "texture": TextureRenderer,
+    "software": lambda *args: TextureRenderer(*args, accelerated=0),
+}
+
+MUSIC_END = pygame.USEREVENT + 1
+MUSIC_FADE_MS = 500
+
+
+class Music:
+    # Streams from disk through mixer.music instead of decoding whole tracks
+    shared = None
+
+    def __init__(self, mixer, fade_ms=MUSIC_FADE_MS):
+        self.mixer = mixer
+        self.stream = mixer.music
+        self.fade_ms = fade_ms
+        self.playlist = []
+        self.loop = True
+        self.position = 0
+        self.current = None
+        self.queued = None
+        self.stream.set_endevent(MUSIC_END)
+
+    def play(self, tracks, loop=True, fade_ms=None):
+        playlist = [tracks] if isinstance(tracks, str) else list(tracks)
+        if playlist == self.playlist and loop == self.loop and self.current:
+            return
+        self.playlist, self.loop, self.position = playlist, loop, 0
+        fade_ms = self.fade_ms if fade_ms is None else fade_ms
+        if self.current and self.stream.get_busy():
+            # Fading out drops the queue, so queue afterwards: the first track
+            # starts from the audio thread as soon as the fade ends
+            self.stream.fadeout(fade_ms)
+            self.stream.queue(playlist[0], loops=self.loops())
+            self.queued = 0
+            return
+        self.stream.load(playlist[0])
+        self.stream.play(self.loops(), fade_ms=fade_ms)
+        self.current, self.queued = playlist[0], None
+        self.preload()
+
+    def loops(self):
+        return -1 if self.loop and len(self.playlist) == 1 else 0
+
+    def preload(self):
+        # Open the next track now so it follows the current one without a gap
+        position = self.position + 1
+        if position == len(self.playlist):
+            if not self.loop or len(self.playlist) == 1:
+                return
+            position = 0
+        self.stream.queue(self.playlist[position], loops=self.loops())
+        self.queued = position
+
+    def stop(self, fade_ms=None):
+        self.playlist, self.current, self.queued = [], None, None
+        self.stream.fadeout(self.fade_ms if fade_ms is None else fade_ms)
+
+    def handle_event(self, event):
+        if event.type != MUSIC_END:
+            return
+        if self.queued is None:
+            if not self.stream.get_busy():
+                self.current = None
+            return
+        self.position, self.queued = self.queued, None
+        self.current = self.playlist[self.position]
+        self.preload()
+
 
 class Game:
-    def __init__(self, screen_size, background_image_path=None):
-        pygame.init()
-        self.screen = pygame.display.set_mode(screen_size)
+    running_games = 0  # In main(), nested ones run inside an outer one's frame
+
+    def __init__(
+        self,
+        screen_size,
+        background_image_path=None,
+        renderer=None,
+        resolution=None,
+    ):
+        # Only what the first frame needs, audio starts on first use
+        pygame.display.init()
+        pygame.font.init()
+        self.renderer = renderers[renderer or RENDERER](
+            screen_size, resolution or RESOLUTION
+        )
+        self.screen = self.renderer.screen
         self.objects = {}
         self.clock = pygame.time.Clock()
         self.running = True
         self.dt = 0
+        self.fps = 60
+        self.profiler = FrameProfiler(self)
+        self.pools = {}
+        self.atlas = shared_atlas(flip_copies=not self.renderer.flips)
+        if self.renderer.flips:
+            self.renderer.mirrored = self.atlas.mirrored
+        self._background = None
+        self.sounds = {}
         self.background_image_path = background_image_path
-        self.mixer = pygame.mixer
-        self.mixer.init()
+        self.deferred = []
+        self._mixer = None
+        self.handlers = {}  # Event type -> [(handler, owner)]
 
     def main(self, func=None):
+        Game.running_games += 1
         while self.running:
             self.loop(func)
-        pygame.quit()
+        Game.running_games -= 1
+        self.renderer.close()
+        if not Game.running_games:
+            Music.shared = None
+            pygame.quit()
 
     def loop(self, func=None):
+        profiler = self.profiler
+        profiler.start_frame()
+        timings = dict.fromkeys(profiler.phases, 0.0)
+        start = last = time.perf_counter()
+
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
+            profiler.handle_event(event)
+            if Music.shared:
+                Music.shared.handle_event(event)
+            if event.type in self.handlers:
+                self.dispatch(event)
+        timings["events"] = (now := time.perf_counter()) - last
+        last = now
 
         try:
-            if self.background:
-                self.screen.blit(self.background, (0, 0))
-            else:
-                self.screen.fill("black")
+            self.renderer.begin_frame(self.background)
+            timings["background"] = (now := time.perf_counter()) - last
+            last = now
 
             if func:
                 func()
-            for obj in list(self.objects.values()).copy():
-                if obj and hasattr(obj, "loop"):
-                    obj.loop()
+            timings["func"] = (now := time.perf_counter()) - last
+            last = now
 
-            pygame.display.flip()
+            self.update()
+            timings["update"] = (now := time.perf_counter()) - last
+            if profiler.overlay:
+                profiler.draw_overlay()
+            last = time.perf_counter()
+
+            self.renderer.present()
+            timings["flip"] = time.perf_counter() - last
         except pygame.error:
             pass
 
-        self.dt = self.clock.tick(60) / 1000
+        timings["total"] = time.perf_counter() - start
+        profiler.end_frame(timings)
+        while self.deferred:
+            self.deferred.pop(0)()
+        self.dt = self.clock.tick(self.fps) / 1000
+
+    def on(self, event_type, handler, owner=None):
+        # With an owner, the handler is dropped once the owner is no longer
+        # one of the game's objects
+        self.handlers.setdefault(event_type, []).append((handler, owner))
+
+    def off(self, owner):
+        for event_type, handlers in list(self.handlers.items()):
+            handlers[:] = [item for item in handlers if item[1] is not owner]
+            if not handlers:
+                del self.handlers[event_type]
+
+    def dispatch(self, event):
+        live = None
+        for handler, owner in list(self.handlers.get(event.type, ())):
+            if owner is not None:
+                if live is None:
+                    live = {id(obj) for obj in self.objects.values()}
+                if id(owner) not in live:
+                    self.off(owner)
+                    continue
+            handler(event)
+            live = None  # The handler may have added or removed objects
+
+    def blit(self, image, position):
+        self.renderer.blit(image, position)
+
+    def mouse_position(self):
+        return self.renderer.to_logical(pygame.mouse.get_pos())
+
+    def blits(self, items):
+        self.renderer.blits(items)
+
+    def defer(self, func):
+        # Runs once, after the next frame is on screen
+        self.deferred.append(func)
+
+    def update(self):
+        if not self.profiler.detailed:
+            for obj in list(self.objects.values()).copy():
+                if obj and hasattr(obj, "loop"):
+                    obj.loop()
+            return
+        self.profiler.draw_time = 0
+        for obj in list(self.objects.values()).copy():
+            if obj and hasattr(obj, "loop"):
+                start = time.perf_counter()
+                obj.loop()
+                self.profiler.add_object(obj, time.perf_counter() - start)
 
     def add_object(self, name, func, *args, **kwargs):
         obj = func(self, *args, **kwargs)
@@ -52,6 +813,25 @@ class Game:
                 del self.objects[name]
                 break
 
+    def pool(self, cls):
+        if cls not in self.pools:
+            self.pools[cls] = Pool(self, cls)
+        return self.pools[cls]
+
+    def acquire_object(self, name, cls, *args, **kwargs):
+        # Like add_object, but reuses a released instance of cls via its reset()
+        obj = self.pool(cls).acquire(*args, **kwargs)
+        self.objects[name] = obj
+        return obj
+
+    def release_object(self, obj):
+        self.remove_object(obj)
+        if type(obj) in self.pools:
+            self.pools[type(obj)].release(obj)
+
+    def pool_stats(self):
+        return {cls.__name__: pool.stats() for cls, pool in self.pools.items()}
+
     @property
     def width(self):
         return self.screen.get_width()
@@ -60,32 +840,73 @@ class Game:
     def height(self):
         return self.screen.get_height()
 
+    @property
+    def mixer(self):
+        if self._mixer is None:
+            pygame.mixer.init()
+            self._mixer = pygame.mixer
+        return self._mixer
+
+    @mixer.setter
+    def mixer(self, value):
+        self._mixer = value
+
+    @property
+    def music(self):
+        # mixer.music is a single stream, so every Game shares one manager
+        if Music.shared is None or Music.shared.mixer is not self.mixer:
+            Music.shared = Music(self.mixer)
+        return Music.shared
+
     @property
     def background(self):
-        if self.background_image_path is not None:
-            return pygame.transform.scale(
-                pygame.image.load(self.background_image_path), (self.width, self.height)
+        if self.background_image_path is None:
+            return None
+        key = (self.background_image_path, self.screen.get_size())
+        if self._background is None or self._background[0] != key:
+            image = pygame.transform.scale(
+                load_image(self.background_image_path), key[1]
             )
+            if pygame.display.get_surface() is not None:
+                image = image.convert()
+            self._background = (key, image)
+        return self._background[1]
 
     def play_sound(self, sound_path, id=None):
-        sound = self.mixer.Sound(sound_path)
+        if sound_path not in self.sounds:
+            self.sounds[sound_path] = self.mixer.Sound(sound_path)
+        sound = self.sounds[sound_path]
         if id:
             self.objects[id] = sound
         sound.play()
         return sound
 
-    def sound_loop(self, sound_path, id=None):
-        sound = self.mixer.Sound(sound_path)
-        if id:
-            self.objects[id] = sound
-        sound.play(-1)
-        return sound
-
 
 class Sprite:
-    def __init__(
+    # Slotted, so thousands of entities stay small. Position is x and y alone,
+    # rect is brought in line with them when it is read
+    __slots__ = (
+        "game",
+        "image_path",
+        "image1",
+        "image2",
+        "image",
+        "teleport",
+        "direction",
+        "collidable",
+        "x",
+        "y",
+        "_rect",
+        "__weakref__",  # For pools
+    )
+
+    def __init__(self, game: Game, *args, **kwargs):
+        self.game = game
+        self.image_path = None
+        self.reset(*args, **kwargs)
+
+    def reset(
         self,
-        game: Game,
         image_path: str,
         x=None,
         y=None,
@@ -94,67 +915,55 @@ class Sprite:
         collidable=True,
         teleport=dict(),
     ):
-        self.game = game
-        self.image_path = image_path
+        if image_path != self.image_path:
+            self.image_path = image_path
+            self.image1 = self.game.atlas.get(image_path)
+            self.image2 = self.game.atlas.get(image_path, "flipped")
         self.teleport = teleport
         self.direction = direction
         self.collidable = collidable
-        self.image1 = pygame.image.load(image_path)
-        self.image2 = pygame.transform.flip(self.image1, True, False)
         self.image = self.image1
         if pos_vector is not None:
-            self.pos = pos_vector
-        elif x is not None and y is not None:
-            self.pos = pygame.Vector2(x, y)
-        else:
-            self.pos = pygame.Vector2(0, 0)
-        self.rect = self.image.get_rect()
-        self.rect.x = int(self.pos.x)
-        self.rect.y = int(self.pos.y)
+            x, y = pos_vector
+        elif x is None or y is None:
+            x, y = 0, 0
+        self.x = float(x)
+        self.y = float(y)
+        self._rect = self.image.get_rect()
 
     def loop(self):
         self.check_teleport()
         self.draw()
 
     @property
-    def x(self):
-        return self.pos.x
-
-    @x.setter
-    def x(self, value):
-        self.pos.x = value
-        self.rect.x = int(self.pos.x)
-
-    def x_move(self, value):
-        for _ in range(abs(int(value))):
-            self.x += abs(value) / value
-        self.x += value - int(value)
+    def pos(self):
+        return pygame.Vector2(self.x, self.y)
 
     @property
-    def y(self):
-        return self.pos.y
+    def rect(self):
+        rect = self._rect
+        rect.x = int(self.x)
+        rect.y = int(self.y)
+        return rect
 
-    @y.setter
-    def y(self, value):
-        self.pos.y = value
-        self.rect.y = int(self.pos.y)
+    def x_move(self, value):
+        self.x += value
 
     def y_move(self, value):
-        for _ in range(abs(int(value))):
-            self.y += abs(value) / value
-        self.y += value - int(value)
+        self.y += value
 
     def collides_with(self, other):
         if isinstance(other, str):
             return self.collides_with(self.game.objects[other])
         if isinstance(other, MultiSprite):
-            return self.collides_with(other.sprites)
+            return self.collides_with(other.sprites_near(self.rect))
         if isinstance(other, list):
             return any(self.collides_with(obj) for obj in other)
         if isinstance(other, Sprite):
             return self.rect.colliderect(other.rect)
 
     def colliding(self, otherType=None):
+        rect = self.rect
         return [
             obj
             for obj in self.game.objects.values()
@@ -163,8 +972,8 @@ class Sprite:
                 and (
                     isinstance(obj, MultiSprite)
                     and any(
-                        self.collides_with(obj)
-                        for obj in obj.sprites
+                        rect.colliderect(obj.rect)
+                        for obj in obj.sprites_near(rect)
                         if obj is not self and obj.collidable
                     )
                 )
@@ -172,7 +981,7 @@ class Sprite:
                     isinstance(obj, Sprite)
                     and obj is not self
                     and obj.collidable
-                    and self.collides_with(obj)
+                    and rect.colliderect(obj.rect)
                 )
             )
         ]
@@ -198,10 +1007,17 @@ class Sprite:
 
     def draw(self):
         self.image = self.image1 if self.direction == 1 else self.image2
-        self.game.screen.blit(self.image, (self.x, self.y))
+        if self.game.profiler.detailed:
+            start = time.perf_counter()
+            self.game.blit(self.image, (self.x, self.y))
+            self.game.profiler.draw_time += time.perf_counter() - start
+        else:
+            self.game.blit(self.image, (self.x, self.y))
 
 
 class MultiSprite:
+    __slots__ = ("game", "sprites")
+
     def __init__(self, game: Game, sprite_args):
         self.game = game
         self.sprites = [Sprite(game=game, **arg) for arg in sprite_args]
@@ -226,6 +1042,10 @@ class MultiSprite:
         for sprite in self.sprites:
             sprite.y_move(value)
 
+    def sprites_near(self, rect):
+        # Candidates that may overlap rect, subclasses can narrow this down
+        return self.sprites
+
     def collides_with(self, other):
         return any(sprite.collides_with(other) for sprite in self.sprites)
 
@@ -256,20 +1076,55 @@ class Menu:
         self.game = game
         self.buttons = [
             func._engine_type_(
-                **getattr(self, name)._engine_kwargs_,
+                **func._engine_kwargs_,
                 func=func,
                 game=game,
                 menu=self,
-                x=x
-                - pygame.image.load(
-                    getattr(self, name)._engine_kwargs_["image_path"]
-                ).get_width()
-                / 2,
-                y=y + i * self.button_distance
+                x=x,
+                y=y + i * self.button_distance,
             )
             for i, (name, func) in enumerate(self.__class__.__dict__.items())
             if hasattr(func, "_engine_type_")
         ]
+        for button in self.buttons:
+            button.x -= button.rect.width / 2
+        # Hit-tested on mouse events only, a click fires on release over the
+        # button it was pressed on
+        self.rects = [button.rect for button in self.buttons]
+        self.hovered = None
+        self.pressed = None
+        self.hover(self.button_at(game.mouse_position()))
+        for event_type in (
+            pygame.MOUSEMOTION,
+            pygame.MOUSEBUTTONDOWN,
+            pygame.MOUSEBUTTONUP,
+        ):
+            game.on(event_type, self.handle_event, owner=self)
+
+    def button_at(self, position):
+        index = pygame.Rect(position, (1, 1)).collidelist(self.rects)
+        return self.buttons[index] if index >= 0 else None
+
+    def hover(self, button):
+        if button is self.hovered:
+            return
+        if self.hovered:
+            self.hovered.direction = 1
+        if button:
+            button.direction = -1
+        self.hovered = button
+
+    def handle_event(self, event):
+        button = self.button_at(self.game.renderer.event_position(event.pos))
+        self.hover(button)
+        if event.type == pygame.MOUSEMOTION or event.button != pygame.BUTTON_LEFT:
+            return
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            self.pressed = button
+        else:
+            pressed, self.pressed = self.pressed, None
+            if button is not None and button is pressed:
+                button.func(self)
 
     def loop(self):
         for button in self.buttons:
@@ -277,32 +1132,13 @@ class Menu:
 
 
 class Button(Sprite):
+    __slots__ = ("menu", "func")
+
     def __init__(self, game: Game, menu: Menu, image_path: str, x, y, func):
         super().__init__(game, image_path, x=x, y=y, collidable=False)
         self.menu = menu
         self.func = func
-        self.click_flag = 0
-        self.image2 = pygame.transform.scale(
-            self.image1,
-            (
-                int(self.image1.get_width() * 1.3),
-                int(self.image1.get_height() * 1.3),
-            ),
-        )
-
-    def loop(self):
-        super().loop()
-        if self.rect.collidepoint(pygame.mouse.get_pos()):
-            self.direction = -1
-            if pygame.mouse.get_pressed()[0]:
-                self.click_flag = 1
-            elif self.click_flag == 1:
-                self.click_flag = 2
-            if self.click_flag == 2:
-                self.click_flag = 0
-                self.func(self.menu)
-        else:
-            self.direction = 1
+        self.image2 = game.atlas.get(image_path, "hover")
 
 
 def button(image_path: str):
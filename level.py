@@ -1,37 +1,248 @@
+import bisect
+import json
+import os
+import struct
+
 import pygame
-from engine import MultiSprite
+from engine import MultiSprite, load_image
 
+LEVEL_DIR = "levels"
+COMPILED_LEVEL_DIR = "build/levels"
+DEFAULT_LEVEL = "classic"
+LEVEL_MAGIC = b"FPSLVL01"
+# Magic, image count, platform count, spawn count, teleport count, y velocity
+LEVEL_HEADER = struct.Struct("<8sHHHHf")
+# x from the level centre, y, width, height, image id, collidable
+PLATFORM = struct.Struct("<iiHHHB")
+SPAWN = struct.Struct("<ii")
+# Direction, threshold, target
+TELEPORT = struct.Struct("<Bff")
+TELEPORT_DIRECTIONS = ("+x", "-x", "+y", "-y")
+
+
+class LevelData:
+    def __init__(self, images, platforms, spawns=(), teleport=None, y_velocity=0):
+        self.images = list(images)
+        self.platforms = [tuple(platform) for platform in platforms]
+        self.spawns = [tuple(spawn) for spawn in spawns]
+        self.teleport = teleport or {}
+        self.y_velocity = y_velocity
 
-class Level(MultiSprite):
     @classmethod
-    def load(
-        cls, ctx, pos_filepath, image_filepath, common_sprite_args={}, *args, **kwargs
-    ):
-        with open(pos_filepath) as f:
-            data = f.read().splitlines()
+    def from_source(cls, path):
+        with open(path) as f:
+            if path.endswith(".csv"):
+                source = {
+                    "platforms": [
+                        [int(value) for value in line.split(",")]
+                        for line in f.read().splitlines()
+                        if line
+                    ]
+                }
+            else:
+                source = json.load(f)
+        image_pattern = source.get("image", "images/level/{}.png")
+        images = []
+        platforms = []
+        for i, platform in enumerate(source["platforms"]):
+            if not isinstance(platform, dict):
+                platform = {"x": platform[0], "y": platform[1]}
+            image_path = platform.get("image", image_pattern.format(i))
+            if image_path not in images:
+                images.append(image_path)
+            width, height = load_image(image_path).get_size()
+            platforms.append(
+                (
+                    platform["x"],
+                    platform["y"],
+                    width,
+                    height,
+                    images.index(image_path),
+                    platform.get("collidable", True),
+                )
+            )
         return cls(
+            images,
+            platforms,
+            source.get("spawns", ()),
+            {
+                direction: {float(a): float(b) for a, b in teleports.items()}
+                for direction, teleports in source.get("teleport", {}).items()
+            },
+            source.get("y_velocity", 0),
+        )
+
+    def to_bytes(self):
+        teleports = [
+            (TELEPORT_DIRECTIONS.index(direction), a, b)
+            for direction, items in self.teleport.items()
+            for a, b in items.items()
+        ]
+        data = bytearray(
+            LEVEL_HEADER.pack(
+                LEVEL_MAGIC,
+                len(self.images),
+                len(self.platforms),
+                len(self.spawns),
+                len(teleports),
+                self.y_velocity,
+            )
+        )
+        for image in self.images:
+            encoded = image.encode()
+            data += len(encoded).to_bytes(2, "little") + encoded
+        for record, items in (
+            (PLATFORM, self.platforms),
+            (SPAWN, self.spawns),
+            (TELEPORT, teleports),
+        ):
+            for item in items:
+                data += record.pack(*item)
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, images, platforms, spawns, teleports, y_velocity = (
+            LEVEL_HEADER.unpack_from(data)
+        )
+        if magic != LEVEL_MAGIC:
+            raise ValueError("Not a compiled level")
+        offset = LEVEL_HEADER.size
+        image_paths = []
+        for _ in range(images):
+            length = int.from_bytes(data[offset : offset + 2], "little")
+            image_paths.append(data[offset + 2 : offset + 2 + length].decode())
+            offset += 2 + length
+        tables = []
+        for record, count in ((PLATFORM, platforms), (SPAWN, spawns)):
+            end = offset + record.size * count
+            tables.append(list(record.iter_unpack(data[offset:end])))
+            offset = end
+        teleport = {}
+        end = offset + TELEPORT.size * teleports
+        for direction, a, b in TELEPORT.iter_unpack(data[offset:end]):
+            teleport.setdefault(TELEPORT_DIRECTIONS[direction], {})[a] = b
+        return cls(image_paths, *tables, teleport, y_velocity)
+
+
+def level_source(name, source_dir=LEVEL_DIR):
+    for extension in (".json", ".csv"):
+        path = os.path.join(source_dir, name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def available_levels(source_dir=LEVEL_DIR, compiled_dir=COMPILED_LEVEL_DIR):
+    names = set()
+    for directory, extensions in (
+        (source_dir, (".json", ".csv")),
+        (compiled_dir, (".lvl",)),
+    ):
+        if os.path.isdir(directory):
+            names.update(
+                os.path.splitext(file)[0]
+                for file in os.listdir(directory)
+                if file.endswith(extensions)
+            )
+    return sorted(names)
+
+
+def compile_level(name, source_dir=LEVEL_DIR, compiled_dir=COMPILED_LEVEL_DIR):
+    data = LevelData.from_source(level_source(name, source_dir))
+    os.makedirs(compiled_dir, exist_ok=True)
+    with open(os.path.join(compiled_dir, name + ".lvl"), "wb") as f:
+        f.write(data.to_bytes())
+    return data
+
+
+def load_level_data(name, source_dir=LEVEL_DIR, compiled_dir=COMPILED_LEVEL_DIR):
+    # Compiled file if it is newer than its source, else compile it again
+    source = level_source(name, source_dir)
+    compiled = os.path.join(compiled_dir, name + ".lvl")
+    if os.path.exists(compiled) and (
+        source is None or os.path.getmtime(compiled) >= os.path.getmtime(source)
+    ):
+        with open(compiled, "rb") as f:
+            return LevelData.from_bytes(f.read())
+    if source is None:
+        raise FileNotFoundError(f"No level named {name!r}")
+    try:
+        return compile_level(name, source_dir, compiled_dir)
+    except OSError:
+        return LevelData.from_source(source)
+
+
+class Level(MultiSprite):
+    @classmethod
+    def open(cls, ctx, name=DEFAULT_LEVEL, **kwargs):
+        return cls.from_data(ctx, load_level_data(name), **kwargs)
+
+    @classmethod
+    def from_data(cls, ctx, data: LevelData, **kwargs):
+        # Level x coordinates are relative to the centre of the screen
+        origin = ctx.screen.get_width() / 2
+        teleport = {
+            direction: (
+                {a + origin: b + origin for a, b in teleports.items()}
+                if direction.endswith("x")
+                else teleports
+            )
+            for direction, teleports in data.teleport.items()
+        }
+        level = cls(
             ctx,
             sprite_args=[
-                (
-                    {
-                        "image_path": image_filepath.format(i),
-                        "pos_vector": pygame.Vector2(
-                            ctx.screen.get_width() / 2 + int(line.split(",")[0]),
-                            int(line.split(",")[1]),
-                        ),
-                    }
-                    | common_sprite_args
-                )
-                for i, line in enumerate(data)
-                if line
+                {
+                    "image_path": data.images[image],
+                    "x": origin + x,
+                    "y": y,
+                    "collidable": bool(collidable),
+                    "teleport": teleport,
+                }
+                for x, y, _, _, image, collidable in data.platforms
             ],
-            *args,
-            **kwargs
+            **{"y_velocity": data.y_velocity} | kwargs,
         )
+        level.spawns = [pygame.Vector2(origin + x, y) for x, y in data.spawns]
+        return level
 
     def __init__(self, ctx, sprite_args=[], y_velocity=0):
         super().__init__(ctx, sprite_args)
         self.y_velocity = y_velocity
+        self.spawns = []
+        # Platforms sorted by top in level coordinates, which only change on
+        # teleport, so y_move just shifts the offset
+        self.y_offset = 0
+        self.index = None
+        self.tops = []
+        self.max_height = 0
+
+    def build_index(self):
+        self.index = sorted(self.sprites, key=lambda sprite: sprite.rect.top)
+        self.tops = [sprite.rect.top - self.y_offset for sprite in self.index]
+        self.max_height = max((sprite.rect.height for sprite in self.index), default=0)
+
+    def sprites_near(self, rect):
+        if self.index is None:
+            self.build_index()
+        # One pixel of slack for rects rounding positions differently
+        top = rect.top - self.y_offset - self.max_height - 1
+        bottom = rect.bottom - self.y_offset + 1
+        return self.index[
+            bisect.bisect_right(self.tops, top) : bisect.bisect_left(self.tops, bottom)
+        ]
+
+    def y_move(self, value):
+        super().y_move(value)
+        self.y_offset += value
+
+    def check_teleport(self):
+        for sprite in self.sprites:
+            y = sprite.y
+            sprite.check_teleport()
+            if sprite.y != y:
+                self.index = None
 
     def loop(self):
         self.y_move(self.y_velocity)
@@ -0,0 +1,435 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import random
+import selectors
+import socket
+import statistics
+import struct
+import time
+
+import network
+
+CONTROL_INTERVAL = 1 / 30  # Same rate as network.Client.sync
+ECHO_INTERVAL = 0.1  # Echo round trips show how long the server takes to answer
+JOIN_RETRY_INTERVAL = 0.5
+JOIN_TIMEOUT = 10
+REPORT_SLACK = 10  # Seconds a worker may take past the run to start and report
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    if not samples:
+        return {f"p{p}": None for p in points} | {"max": None}
+    if len(samples) == 1:
+        return {f"p{p}": samples[0] for p in points} | {"max": samples[0]}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {f"p{p}": cuts[p - 1] for p in points} | {"max": max(samples)}
+
+
+def load_script(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class Bot:
+    def __init__(self, address, script=None, rng=None):
+        self.address = address
+        self.script = script
+        self.rng = rng or random.Random()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.joined = False
+        self.last_join_attempt = 0
+        self.tick = 0
+        self.held = {"left": False, "right": False, "jump": False, "shoot": False}
+        self.last_sequence = 0
+        self.snapshots = 0
+        self.lost = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latencies = []
+        self.intervals = []
+        self.last_arrival = None
+        self.echoes = collections.deque()  # Send times, answered in order
+        self.echo_times = []
+
+    def send(self, data):
+        try:
+            self.bytes_out += self.socket.sendto(data, self.address)
+        except OSError:
+            pass
+
+    def join(self, now):
+        if now - self.last_join_attempt > JOIN_RETRY_INTERVAL:
+            self.last_join_attempt = now
+            self.send(network.JOIN_GAME)
+
+    def next_controls(self):
+        if self.script:
+            controls = self.script[self.tick % len(self.script)]
+        else:
+            # Hold each key for a while so bots move like players instead of jittering
+            for key in self.held:
+                if self.rng.random() < 0.1:
+                    self.held[key] = self.rng.random() < 0.4
+            controls = self.held
+        self.tick += 1
+        return json.dumps(controls).encode()
+
+    def send_controls(self):
+        self.send(network.SEND_CONTROLS + self.next_controls())
+
+    def send_echo(self, now):
+        self.echoes.append(now)
+        self.send(network.ECHO)
+
+    def receive(self):
+        while True:
+            try:
+                data, _ = self.socket.recvfrom(network.BUFFER_SIZE)
+            except (BlockingIOError, ConnectionResetError):
+                return
+            now = time.time()
+            self.bytes_in += len(data)
+            if data.startswith(network.OK):
+                self.joined = True
+            elif data.startswith(network.PING):
+                self.send(network.PONG + data[len(network.PING) :])
+            elif data == network.ECHO:
+                if self.echoes:
+                    self.echo_times.append(now - self.echoes.popleft())
+            elif data in (network.WAITING, network.GAME_ALREADY_STARTED):
+                continue
+            elif data.startswith(network.RELIABLE):
+                # Acked right away so the server stops retransmitting
+                self.send(network.ACK + data[len(network.RELIABLE) :][:4])
+            else:
+                self.handle_snapshot(data, now)
+
+    def handle_snapshot(self, data, now):
+        try:
+            magic, seq, sent_at, *_, count = network.snapshot_header(data)
+            for _ in network.snapshot_entities(data, count):
+                pass
+        except struct.error:
+            return
+        if magic != network.SNAPSHOT_MAGIC or seq <= self.last_sequence:
+            return
+        if self.last_sequence:
+            self.lost += seq - self.last_sequence - 1
+            self.intervals.append(now - self.last_arrival)
+        self.last_sequence = seq
+        self.last_arrival = now
+        self.snapshots += 1
+        self.latencies.append(now - sent_at)
+
+    def close(self):
+        self.socket.close()
+
+    def summary(self):
+        return {
+            "joined": self.joined,
+            "snapshots": self.snapshots,
+            "lost": self.lost,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+def run_bots(address, count, duration, script, seed, results):
+    rng = random.Random(seed)
+    bots = [Bot(address, script, random.Random(rng.random())) for _ in range(count)]
+    selector = selectors.DefaultSelector()
+    for bot in bots:
+        selector.register(bot.socket, selectors.EVENT_READ, bot)
+
+    join_deadline = time.time() + JOIN_TIMEOUT
+    while not all(bot.joined for bot in bots) and time.time() < join_deadline:
+        now = time.time()
+        for bot in bots:
+            if not bot.joined:
+                bot.join(now)
+        for key, _ in selector.select(timeout=0.05):
+            key.data.receive()
+
+    start = time.time()
+    deadline = start + duration
+    next_controls = next_echo = start
+    while (now := time.time()) < deadline:
+        if now >= next_controls:
+            for bot in bots:
+                if bot.joined:
+                    bot.send_controls()
+            next_controls += CONTROL_INTERVAL
+        if now >= next_echo:
+            for bot in bots:
+                if bot.joined:
+                    bot.send_echo(now)
+            next_echo += ECHO_INTERVAL
+        for key, _ in selector.select(timeout=max(0, next_controls - time.time())):
+            key.data.receive()
+    elapsed = time.time() - start
+
+    results.put(
+        {
+            "elapsed": elapsed,
+            "bots": [bot.summary() for bot in bots],
+            "latencies": [s for bot in bots for s in bot.latencies],
+            "intervals": [s for bot in bots for s in bot.intervals],
+            "echo_times": [s for bot in bots for s in bot.echo_times],
+        }
+    )
+    for bot in bots:
+        bot.close()
+    selector.close()
+
+
+def busy(seconds):
+    # Pure Python work holding the GIL, like a heavier simulation would
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def serve(host, port, players, stop, results, network_process=False, busy_ms=0):
+    # Headless server that starts the match as soon as every bot has joined
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    server = network.Server(host, port, network_process=network_process)
+    tick_times = []
+    with server:
+        server.start_network()
+        server.players[server.server.getsockname()] = None
+        join_deadline = time.time() + JOIN_TIMEOUT
+        while len(server.sessions) < players and time.time() < join_deadline:
+            if network_process:
+                server.network_tick()
+            time.sleep(0.01)
+        server.start_game()
+        server.waiting = False
+        # Pace the loop here so the clock wait is not counted as tick time
+        frame_time = 1 / server.game.fps
+        server.game.fps = 0
+        while not stop.is_set():
+            if server.death_menu_active:
+                server.game.objects["death_menu"].restart()
+            start = time.perf_counter()
+            server.game.loop(server.game_loop)
+            busy(busy_ms / 1000)
+            tick_time = time.perf_counter() - start
+            tick_times.append(tick_time)
+            time.sleep(max(0, frame_time - tick_time))
+    results.put({"tick_times": tick_times})
+
+
+def collect_reports(results, count, processes, deadline):
+    # Without waiting forever on a process that died
+    reports = []
+    while len(reports) < count:
+        try:
+            reports.append(results.get(timeout=1))
+        except queue.Empty:
+            for process in processes:
+                if process.exitcode:
+                    raise RuntimeError(
+                        f"{process.name} exited with code {process.exitcode}"
+                    )
+            if time.time() > deadline:
+                raise TimeoutError(f"{processes[0].name} did not report in time")
+    return reports
+
+
+def run_stage(
+    address,
+    bots,
+    processes,
+    duration,
+    script,
+    seed,
+    local,
+    network_process=False,
+    busy_ms=0,
+):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    server_results = ctx.Queue()
+    stop = ctx.Event()
+    server_process = None
+    if local:
+        server_process = ctx.Process(
+            target=serve,
+            args=(*address, bots, stop, server_results, network_process, busy_ms),
+            name="Load test server",
+        )
+        server_process.start()
+        time.sleep(1)  # Let the server bind before the first JOIN_GAME
+
+    processes = max(1, min(processes, bots))
+    workers = [
+        ctx.Process(
+            target=run_bots,
+            args=(
+                address,
+                bots // processes + (i < bots % processes),
+                duration,
+                script,
+                seed + i,
+                results,
+            ),
+            name="Bot worker",
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    deadline = time.time() + JOIN_TIMEOUT + duration + REPORT_SLACK
+    try:
+        # A server that died fails the stage too
+        reports = collect_reports(
+            results, len(workers), workers + [server_process] * local, deadline
+        )
+        stop.set()
+        server_report = {}
+        if local:
+            (server_report,) = collect_reports(
+                server_results, 1, [server_process], time.time() + REPORT_SLACK
+            )
+    except BaseException:
+        for process in workers + [server_process] * local:
+            process.terminate()
+        raise
+    for process in workers + [server_process] * local:
+        process.join()
+    return summarize(bots, reports, server_report)
+
+
+def summarize(bots, reports, server_report):
+    summaries = [bot for report in reports for bot in report["bots"]]
+    elapsed = max(report["elapsed"] for report in reports)
+    received = sum(bot["snapshots"] for bot in summaries)
+    lost = sum(bot["lost"] for bot in summaries)
+    return {
+        "bots": bots,
+        "joined": sum(bot["joined"] for bot in summaries),
+        "server_tick_ms": {
+            k: v and v * 1000
+            for k, v in percentiles(server_report.get("tick_times", [])).items()
+        },
+        "snapshot_interval_ms": {
+            k: v and v * 1000
+            for k, v in percentiles(
+                [s for r in reports for s in r["intervals"]]
+            ).items()
+        },
+        "snapshot_latency_ms": {
+            k: v and v * 1000
+            for k, v in percentiles(
+                [s for r in reports for s in r["latencies"]]
+            ).items()
+        },
+        "echo_rtt_ms": {
+            k: v and v * 1000
+            for k, v in percentiles(
+                [s for r in reports for s in r["echo_times"]]
+            ).items()
+        },
+        "packet_loss": lost / (received + lost) if received + lost else 0,
+        "bytes_in_per_client_s": sum(bot["bytes_in"] for bot in summaries)
+        / bots
+        / elapsed,
+        "bytes_out_per_client_s": sum(bot["bytes_out"] for bot in summaries)
+        / bots
+        / elapsed,
+    }
+
+
+def format_ms(stats):
+    return "/".join("-" if v is None else f"{v:.1f}" for v in stats.values())
+
+
+def print_stage(result):
+    print(
+        f"{result['bots']:>5} {result['joined']:>6}"
+        f"  {format_ms(result['server_tick_ms']):>24}"
+        f"  {format_ms(result['snapshot_interval_ms']):>24}"
+        f"  {format_ms(result['snapshot_latency_ms']):>24}"
+        f"  {format_ms(result['echo_rtt_ms']):>24}"
+        f"  {result['packet_loss'] * 100:>6.2f}"
+        f"  {result['bytes_in_per_client_s'] / 1024:>9.1f}"
+        f"  {result['bytes_out_per_client_s'] / 1024:>9.1f}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Spawn headless bot clients against a game server and report "
+        "tick time, snapshot latency, packet loss and traffic per client."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=network.PORT)
+    parser.add_argument(
+        "--bots",
+        type=int,
+        nargs="+",
+        default=[10],
+        help="bot counts to run, one stage per count",
+    )
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument(
+        "--script", help="JSON lines file of controls, replayed in a loop by each bot"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="start a headless server for each stage and begin the match "
+        "once all bots have joined (required for more than one stage)",
+    )
+    parser.add_argument(
+        "--network-process",
+        action="store_true",
+        help="with --local, run the server's socket I/O in a relay process",
+    )
+    parser.add_argument(
+        "--busy-ms",
+        type=float,
+        default=0,
+        help="with --local, extra simulation work per server tick",
+    )
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+    if len(args.bots) > 1 and not args.local:
+        parser.error("more than one stage needs --local")
+
+    script = load_script(args.script) if args.script else None
+    print(
+        " bots joined  server tick p50/p90/p99/max  snapshot gap p50/p90/p99/max"
+        "   latency p50/p90/p99/max  echo rtt p50/p90/p99/max    loss%"
+        "   KiB/s in  KiB/s out"
+    )
+    results = []
+    for bots in args.bots:
+        result = run_stage(
+            (args.host, args.port),
+            bots,
+            args.processes,
+            args.duration,
+            script,
+            args.seed,
+            args.local,
+            args.network_process,
+            args.busy_ms,
+        )
+        print_stage(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
+import argparse
+import sys
+import time
+
+started = time.perf_counter()
+
 import pygame
-import pygame_textinput
 import engine
-import network
+
+# network (and with it level, player, psutil) and pygame_textinput are only
+# imported once Connect or Start is clicked, so the menu shows up sooner
 
 
 class StartMenu(engine.Menu):
@@ -9,6 +16,9 @@ class StartMenu(engine.Menu):
 
     @engine.button("images/Menu/Login.png")
     def connect(self):
+        import network
+        import pygame_textinput
+
         self.game.running = False
         font = pygame.font.Font("images/Anta-Regular.ttf", 30)
         enter_text = font.render(
@@ -20,7 +30,7 @@ class StartMenu(engine.Menu):
             cursor_color="white",
         )
 
-        screen = pygame.display.set_mode((0, 0))
+        screen = self.game.screen
         clock = pygame.time.Clock()
 
         wating = True
@@ -43,11 +53,9 @@ class StartMenu(engine.Menu):
                 if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
                     wating = False
 
-            pygame.display.update()
+            self.game.renderer.present()
             clock.tick(30)
         client = network.Client(ip_input.value, network.PORT)
-        if "music" in self.game.objects:
-            self.game.objects["music"].stop()
         try:
             with client:
                 client.main()
@@ -66,9 +74,15 @@ class StartMenu(engine.Menu):
 
     @engine.button("images/Menu/Start.png")
     def start(self):
+        import network
+
         self.game.running = False
-        server = network.Server()
-        self.game.objects["music"].stop()
+        server = network.Server(
+            record_dir=args.record,
+            metrics_port=args.metrics_port,
+            level=args.level,
+            network_process=args.network_process,
+        )
         with server:
             server.main()
 
@@ -77,7 +91,84 @@ class StartMenu(engine.Menu):
         self.game.running = False
 
 
+def resolution(value):
+    if value == "native":
+        return None
+    width, _, height = value.partition("x")
+    return int(width), int(height)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--record",
+    metavar="DIR",
+    help="when hosting, save each match to DIR for replay.py",
+)
+parser.add_argument(
+    "--metrics-port",
+    type=int,
+    metavar="PORT",
+    help="when hosting, serve server metrics on http://127.0.0.1:PORT/stats",
+)
+parser.add_argument(
+    "--level",
+    default="classic",
+    help="when hosting, play levels/LEVEL.json (or its compiled build/levels/LEVEL.lvl)",
+)
+parser.add_argument(
+    "--network-process",
+    action="store_true",
+    help="when hosting, send and receive in a separate process instead of a "
+    "thread, so a busy frame does not hold up the network",
+)
+parser.add_argument(
+    "--resolution",
+    type=resolution,
+    default="1920x1080",
+    metavar="WIDTHxHEIGHT",
+    help="size everything is drawn at before being scaled to the window, "
+    "or 'native' to draw at the window size",
+)
+parser.add_argument(
+    "--renderer",
+    choices=sorted(engine.renderers),
+    default=engine.RENDERER,
+    help="surface: CPU blits (default), texture: SDL renderer with GPU if "
+    "available, software: SDL renderer without GPU",
+)
+parser.add_argument(
+    "--profile-startup",
+    action="store_true",
+    help="print how long each startup step took and quit after the first frame",
+)
+args = parser.parse_args()
+
+startup = {}
+
+
+def mark(step):
+    startup[step] = time.perf_counter() - started
+
+
+def report_startup():
+    mark("music")
+    last = 0
+    for step, seconds in startup.items():
+        print(f"{step:<12} {seconds * 1000:8.1f} ms  (+{(seconds - last) * 1000:.1f})")
+        last = seconds
+    lazy = ("network", "level", "player", "psutil", "pygame_textinput")
+    print("Loaded:", ", ".join(name for name in lazy if name in sys.modules) or "-")
+    game.running = False
+
+
+mark("imports")
+engine.RENDERER = args.renderer
+engine.RESOLUTION = args.resolution
 game = engine.Game((0, 0), "images/Menu/Background.png")
+mark("display")
+# Only the menus, game images are prefetched while the lobby is shown
+game.atlas.build("images/Menu")
+mark("atlas")
 game.add_object(
     "logo",
     engine.Sprite,
@@ -86,5 +177,9 @@ game.add_object(
     y=10,
 )
 game.add_object("StartMenu", StartMenu)
-game.sound_loop("sounds/menu_music.mp3", id="music")
+mark("menu")
+game.defer(lambda: mark("first frame"))
+game.defer(lambda: game.music.play("sounds/menu_music.mp3"))
+if args.profile_startup:
+    game.defer(report_startup)
 game.main()
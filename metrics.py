@@ -0,0 +1,202 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = 65434
+TIME_BUCKETS = (0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066, 0.1, 0.25, 1.0)
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65507)
+RTT_SMOOTHING = 0.125  # Same weight TCP uses for its smoothed RTT
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        total = 0
+        for le, count in zip((*self.buckets, "+Inf"), self.counts):
+            total += count
+            yield le, total
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0,
+            "max": self.max,
+            "buckets": {str(le): total for le, total in self.cumulative()},
+        }
+
+
+class ServerMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.tick_seconds = Histogram(TIME_BUCKETS)
+        self.broadcast_seconds = Histogram(TIME_BUCKETS)
+        self.snapshot_bytes = Histogram(SIZE_BUCKETS)
+        self.snapshot_dropped_entities = 0  # Left out of full snapshots
+        self.packets_in = {}
+        self.bytes_in = {}
+        self.packets_out = {}
+        self.bytes_out = {}
+        self.clients = {}
+        self.thread_cpu_seconds = {}
+        self.sessions = None  # The server's SessionTable, if any
+
+    def count_in(self, kind, size):
+        self.packets_in[kind] = self.packets_in.get(kind, 0) + 1
+        self.bytes_in[kind] = self.bytes_in.get(kind, 0) + size
+
+    def count_out(self, kind, size):
+        self.packets_out[kind] = self.packets_out.get(kind, 0) + 1
+        self.bytes_out[kind] = self.bytes_out.get(kind, 0) + size
+
+    def observe_snapshot(self, size, dropped=0):
+        self.snapshot_bytes.observe(size)
+        self.snapshot_dropped_entities += dropped
+
+    def client(self, address):
+        key = f"{address[0]}:{address[1]}"
+        if key not in self.clients:
+            self.clients[key] = {"last_seen": None, "rtt": None, "srtt": None}
+        return self.clients[key]
+
+    def forget(self, address):
+        self.clients.pop(f"{address[0]}:{address[1]}", None)
+
+    def seen(self, address):
+        self.client(address)["last_seen"] = time.time()
+
+    def observe_rtt(self, address, rtt):
+        client = self.client(address)
+        client["rtt"] = rtt
+        client["srtt"] = (
+            rtt
+            if client["srtt"] is None
+            else client["srtt"] + RTT_SMOOTHING * (rtt - client["srtt"])
+        )
+
+    def sample_thread_cpu(self, name):
+        # Must be called from the thread being measured
+        self.thread_cpu_seconds[name] = time.thread_time()
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            "uptime_seconds": now - self.started,
+            "tick_seconds": self.tick_seconds.to_dict(),
+            "broadcast_seconds": self.broadcast_seconds.to_dict(),
+            "snapshot_bytes": self.snapshot_bytes.to_dict(),
+            "snapshot_dropped_entities": self.snapshot_dropped_entities,
+            "packets_in": self.packets_in.copy(),
+            "bytes_in": self.bytes_in.copy(),
+            "packets_out": self.packets_out.copy(),
+            "bytes_out": self.bytes_out.copy(),
+            "clients": {
+                address: client
+                | {
+                    "idle_seconds": (
+                        now - client["last_seen"] if client["last_seen"] else None
+                    )
+                }
+                for address, client in self.clients.copy().items()
+            },
+            "sessions": self.sessions.stats() if self.sessions is not None else None,
+            "thread_cpu_seconds": self.thread_cpu_seconds.copy(),
+            "process_cpu_seconds": time.process_time(),
+        }
+
+    def to_prometheus(self):
+        stats = self.to_dict()
+        lines = [f"fps_server_uptime_seconds {stats['uptime_seconds']}"]
+        for name in ("tick_seconds", "broadcast_seconds", "snapshot_bytes"):
+            histogram = stats[name]
+            lines.append(f"# TYPE fps_server_{name} histogram")
+            for le, total in histogram["buckets"].items():
+                lines.append(f'fps_server_{name}_bucket{{le="{le}"}} {total}')
+            lines.append(f"fps_server_{name}_sum {histogram['sum']}")
+            lines.append(f"fps_server_{name}_count {histogram['count']}")
+        lines.append("# TYPE fps_server_snapshot_dropped_entities_total counter")
+        lines.append(
+            "fps_server_snapshot_dropped_entities_total"
+            f" {stats['snapshot_dropped_entities']}"
+        )
+        for name in ("packets_in", "bytes_in", "packets_out", "bytes_out"):
+            lines.append(f"# TYPE fps_server_{name}_total counter")
+            for kind, value in stats[name].items():
+                lines.append(f'fps_server_{name}_total{{type="{kind}"}} {value}')
+        for address, client in stats["clients"].items():
+            for key in ("idle_seconds", "rtt", "srtt"):
+                if client[key] is not None:
+                    lines.append(
+                        f'fps_server_client_{key}{{client="{address}"}} {client[key]}'
+                    )
+        if stats["sessions"] is not None:
+            sessions = stats["sessions"]
+            lines.append(f"fps_server_sessions {sessions['active']}")
+            lines.append(f"fps_server_sessions_disconnected {sessions['disconnected']}")
+            for key in ("evictions", "reconnects", "wasted_sends", "retransmits"):
+                lines.append(f"# TYPE fps_server_{key}_total counter")
+                lines.append(f"fps_server_{key}_total {sessions[key]}")
+        for thread, seconds in stats["thread_cpu_seconds"].items():
+            lines.append(
+                f'fps_server_thread_cpu_seconds{{thread="{thread}"}} {seconds}'
+            )
+        lines.append(f"fps_server_process_cpu_seconds {stats['process_cpu_seconds']}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    def __init__(self, metrics: ServerMetrics, port=METRICS_PORT, host="127.0.0.1"):
+        self.metrics = metrics
+        self.httpd = ThreadingHTTPServer((host, port), self.handler())
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def handler(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.to_prometheus().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path in ("/", "/stats"):
+                    body = json.dumps(metrics.to_dict(), indent=2).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
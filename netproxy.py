@@ -0,0 +1,201 @@
+import argparse
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+
+BUFFER_SIZE = 65507
+
+
+class Impairment:
+    def __init__(
+        self, latency=0, jitter=0, loss=0, duplicate=0, reorder=0, reorder_delay=0.05
+    ):
+        self.latency = latency  # Seconds added to every packet
+        self.jitter = jitter  # Uniform +/- seconds around latency
+        self.loss = loss  # Probabilities between 0 and 1
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay  # Extra hold time for reordered packets
+        self.stats = dict.fromkeys(
+            ("received", "forwarded", "dropped", "duplicated", "reordered"), 0
+        )
+
+    def delays(self, rng):
+        self.stats["received"] += 1
+        if rng.random() < self.loss:
+            self.stats["dropped"] += 1
+            return []
+        copies = 1
+        if rng.random() < self.duplicate:
+            self.stats["duplicated"] += 1
+            copies = 2
+        delays = []
+        for _ in range(copies):
+            delay = max(0, self.latency + rng.uniform(-self.jitter, self.jitter))
+            if rng.random() < self.reorder:
+                self.stats["reordered"] += 1
+                delay += self.reorder_delay
+            delays.append(delay)
+        self.stats["forwarded"] += copies
+        return delays
+
+
+class ImpairmentProxy:
+    def __init__(
+        self,
+        target,
+        listen=("127.0.0.1", 0),
+        upstream=None,
+        downstream=None,
+        seed=None,
+    ):
+        self.target = target
+        self.upstream = upstream or Impairment()  # Client to server
+        self.downstream = downstream or Impairment()  # Server to client
+        self.rng = random.Random(seed)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(listen)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.client_sockets = {}  # Client address -> socket towards the server
+        self.pending = []  # Heap of (due, order, socket, data, address)
+        self.order = itertools.count()
+        self.online = False
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def set(self, **kwargs):
+        for impairment in (self.upstream, self.downstream):
+            for name, value in kwargs.items():
+                if not hasattr(impairment, name):
+                    raise AttributeError(f"Unknown impairment setting: {name}")
+                setattr(impairment, name, value)
+
+    def start(self):
+        self.online = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.online = False
+        if self.thread:
+            self.thread.join()
+        for sock in [self.socket, *self.client_sockets.values()]:
+            sock.close()
+        self.selector.close()
+
+    def run(self):
+        while self.online:
+            timeout = 0.01
+            if self.pending:
+                timeout = min(timeout, max(0, self.pending[0][0] - time.time()))
+            for key, _ in self.selector.select(timeout):
+                self.receive(key.fileobj, key.data)
+            self.deliver()
+
+    def receive(self, sock, client_address):
+        while True:
+            try:
+                data, address = sock.recvfrom(BUFFER_SIZE)
+            except (BlockingIOError, ConnectionResetError):
+                return
+            if client_address is None:
+                # From a client: forward through that client's own server socket
+                self.queue(
+                    self.upstream, self.server_socket(address), data, self.target
+                )
+            else:
+                self.queue(self.downstream, self.socket, data, client_address)
+
+    def server_socket(self, client_address):
+        if client_address not in self.client_sockets:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, client_address)
+            self.client_sockets[client_address] = sock
+        return self.client_sockets[client_address]
+
+    def queue(self, impairment, sock, data, address):
+        now = time.time()
+        for delay in impairment.delays(self.rng):
+            heapq.heappush(
+                self.pending, (now + delay, next(self.order), sock, data, address)
+            )
+
+    def deliver(self):
+        now = time.time()
+        while self.pending and self.pending[0][0] <= now:
+            _, _, sock, data, address = heapq.heappop(self.pending)
+            try:
+                sock.sendto(data, address)
+            except OSError:
+                pass
+
+    @property
+    def stats(self):
+        return {
+            "upstream": dict(self.upstream.stats),
+            "downstream": dict(self.downstream.stats),
+        }
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="UDP proxy between Client and Server that adds latency, "
+        "jitter, loss, duplication and reordering in both directions."
+    )
+    parser.add_argument("target", type=parse_address, help="server HOST:PORT")
+    parser.add_argument(
+        "--listen", type=parse_address, default=("127.0.0.1", 65433), help="HOST:PORT"
+    )
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument("--loss", type=float, default=0, help="0 to 1")
+    parser.add_argument("--duplicate", type=float, default=0, help="0 to 1")
+    parser.add_argument("--reorder", type=float, default=0, help="0 to 1")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    def impairment():
+        return Impairment(
+            latency=args.latency / 1000 / 2,  # Latency is given as round trip
+            jitter=args.jitter / 1000,
+            loss=args.loss,
+            duplicate=args.duplicate,
+            reorder=args.reorder,
+        )
+
+    with ImpairmentProxy(
+        args.target, args.listen, impairment(), impairment(), args.seed
+    ) as proxy:
+        print("Proxy listening on", proxy.address, "forwarding to", args.target)
+        try:
+            while True:
+                time.sleep(5)
+                print(proxy.stats)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
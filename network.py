@@ -2,15 +2,20 @@ import json
 import pickle
 import psutil
 import socket
+import struct
 import threading
 import time
-import zlib
 
 import pygame
 import engine
+from attacks import PositionHistory, rewind_ticks
 from engine import Menu, button
-from level import Level
+from level import DEFAULT_LEVEL, Level, load_level_data
+from metrics import MetricsServer, ServerMetrics
 from player import Player, get_controls
+from relay import RelaySocket
+from replay import Recorder
+from sessions import ReliableChannel, SessionTable
 
 PORT = 65432
 
@@ -24,12 +29,33 @@ SEND_CONTROLS = b"controls:"
 WAITING = b"waiting"
 GAME_ALREADY_STARTED = b"game_already_started"
 GAME_OVER = b"game_over:"
+PING = b"ping:"
+PONG = b"pong:"
+LEAVE = b"leave"
+# Reliable messages are RELIABLE + sequence + payload, and any datagram from a
+# client may start with ACK + the last sequence it got in order
+RELIABLE = b"rel:"
+ACK = b"ack:"
+SEQUENCE = struct.Struct("!I")
+# Snapshots: header, then an entity per sprite, then (sometimes) the string
+# table the entities index into. Strings only change when something new
+# appears, so the table is repeated for a while after a change and then only
+# now and then for clients that joined late or lost it
+SNAPSHOT_MAGIC = b"SNP1"
+# Magic, sequence, send time, table epoch, table size, has table, entities
+SNAPSHOT = struct.Struct("!4sIdHHBH")
+# Name, image path, x, y, direction
+ENTITY = struct.Struct("!HHiib")
+STRING_REPEAT = 30
+MESSAGE_TYPES = (JOIN_GAME, SEND_CONTROLS, GET_FRAME, ECHO, PONG, LEAVE, ACK)
 
 # UDP specific constants
 BUFFER_SIZE = 65507  # Max UDP packet size
 BROADCAST_INTERVAL = 1 / 60  # 60FPS broadcast rate for smoother updates
 MAX_PACKET_AGE = 1.0  # Discard packets older than this
-USE_COMPRESSION = True  # Compress network data
+PING_INTERVAL = 1.0  # Seconds between RTT probes to each client
+RECONNECT_INTERVAL = 3.0  # Client rejoins after this long without a datagram
+JOIN_TIMEOUT = 5.0  # JOIN_GAME is resent with backoff until the server answers
 
 MAX_PLAYER_SKINS = 3
 
@@ -56,17 +82,90 @@ def show_game_over(game: engine.Game, winner=None):
     game.screen.blit(game_over_text, (100, game.height / 2 - 50))
     if winner:
         game.screen.blit(
-            pygame.image.load(winner) if isinstance(winner, str) else winner,
+            engine.load_image(winner) if isinstance(winner, str) else winner,
             (100, 100 + game.height / 2),
         )
         game.screen.blit(winner_text, (200, 100 + game.height / 2))
 
 
+def match_images(level_images=None):
+    # Everything a match draws; every level image while the level is unknown
+    return [
+        *(f"images/player{i}.png" for i in range(MAX_PLAYER_SKINS)),
+        *engine.image_paths("images/attacks"),
+        *(engine.image_paths("images/level") if level_images is None else level_images),
+    ]
+
+
+def sprite_states(obj):
+    # Batched systems (e.g. projectiles) describe their own sprites
+    if hasattr(obj, "sprite_states"):
+        return obj.sprite_states()
+    # Lazily, so encoding a snapshot does not build a list per object
+    return (
+        (s.image_path, s.x, s.y, s.direction)
+        for s in getattr(obj, "sprites", (obj,))
+        if isinstance(s, engine.Sprite)
+    )
+
+
+def message_type(data):
+    for prefix in MESSAGE_TYPES:
+        if data.startswith(prefix):
+            return prefix.rstrip(b":").decode()
+    return "unknown"
+
+
+def snapshot_header(data):
+    # Magic, sequence, send time, table epoch, table size, has table, entities
+    return SNAPSHOT.unpack_from(data)
+
+
+def snapshot_entities(data, count):
+    # (name, image, x, y, direction) with names and images as table indices
+    return ENTITY.iter_unpack(
+        memoryview(data)[SNAPSHOT.size : SNAPSHOT.size + count * ENTITY.size]
+    )
+
+
+def snapshot_strings(data, size, count):
+    offset = SNAPSHOT.size + count * ENTITY.size
+    strings = []
+    for _ in range(size):
+        length = data[offset]
+        strings.append(bytes(data[offset + 1 : offset + 1 + length]).decode())
+        offset += 1 + length
+    return strings
+
+
 class Server:
-    def __init__(self):
+    def __init__(
+        self,
+        host=None,
+        port=PORT,
+        record_dir=None,
+        metrics_port=None,
+        level=DEFAULT_LEVEL,
+        network_process=False,
+    ):
+        self.host = host
+        self.port = port
+        self.level = level
+        # Socket I/O in a relay process, polled by the game loop instead of
+        # an event thread that competes with the simulation for the GIL
+        self.network_process = network_process
+        self.metrics = ServerMetrics()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.last_ping = 0
         self.server: socket.socket
         self.players: dict[tuple, Player | None] = {}
-        self.client_addresses = []
+        # Remote players are keyed by session token, so they survive a new address
+        self.pending_controls = {}  # Latest controls per client, latched each tick
+        self.rewinds = {}  # Lag compensation per client in ticks, latched too
+        self.recorder = Recorder(record_dir) if record_dir else None
+        self.sessions = SessionTable()
+        self.metrics.sessions = self.sessions
         self.online: bool = False
         self.game: engine.Game = engine.Game((0, 0), "images/Menu/Background.png")
         self.waiting: bool = True
@@ -74,6 +173,16 @@ class Server:
         self.last_broadcast = 0
         self.sequence_number = 0
         self.last_game_state = {}  # Store previous state for delta comparison
+        # Snapshots are packed into one buffer, sent before the next is encoded
+        self.snapshot_buffer = bytearray(BUFFER_SIZE)
+        self.snapshot_view = memoryview(self.snapshot_buffer)
+        self.string_ids = {}
+        self.strings = []  # Encoded, in id order
+        self.strings_size = 0  # Bytes the table takes in a snapshot
+        self.string_epoch = 0  # A new table per match
+        self.strings_changed = 0  # Sequence number of the last new string
+        self.entity_names = {}  # Object name -> string ids of its sprites
+        self.prefetch = None
 
     def __enter__(self):
         self.start_server()
@@ -83,124 +192,328 @@ class Server:
         self.stop_server()
 
     def start_server(self):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server.bind((get_wlan_ip(), PORT))
+        address = (self.host if self.host is not None else get_wlan_ip(), self.port)
+        if self.network_process:
+            self.server = RelaySocket(address)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server.bind(address)
         self.online = True
         print("UDP Server started on", self.server.getsockname())
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            self.metrics_server.start()
+            host, port = self.metrics_server.address
+            print(f"Metrics available on http://{host}:{port}/stats")
 
     def stop_server(self):
         self.online = False
+        self.stop_recording()
+        if self.metrics_server:
+            self.metrics_server.stop()
         self.server.close()
         print("Server stopped.")
 
     def main(self):
-        self.game.sound_loop("sounds/menu_music.mp3", id="music")
-        self.event_thread = threading.Thread(target=self.event_loop)
-        self.event_thread.start()
+        self.game.music.play("sounds/menu_music.mp3")
+        self.prefetch = engine.Prefetcher(self.prefetch_match).start()
+        self.start_network()
         self.game.add_object("lobby", ServerLobbyMenu, server=self)
         self.players[self.server.getsockname()] = None
         self.game.main(self.game_loop)
 
-    def event_loop(self):
+    def start_network(self):
         self.server.setblocking(False)
+        if not self.network_process:
+            self.event_thread = threading.Thread(target=self.event_loop)
+            self.event_thread.start()
+
+    def event_loop(self):
         while self.online:
-            # Handle incoming messages
+            self.network_tick()
+            self.metrics.sample_thread_cpu("network")
+
+            # Shorter sleep for more responsive server
+            time.sleep(0.0005)
+
+    def network_tick(self):
+        # Handle incoming messages
+        while True:
             try:
                 self.process_incoming_messages()
-            except (BlockingIOError, ConnectionResetError):
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
                 pass
 
-            # Broadcast game state periodically
-            current_time = time.time()
-            if (
-                current_time - self.last_broadcast > BROADCAST_INTERVAL
-                and not self.waiting
-                and self.client_addresses  # Only broadcast if clients are connected
-            ):
-                self.broadcast_game_state()
-                self.last_broadcast = current_time
+        # Broadcast game state periodically, or every frame when polled by it
+        current_time = time.time()
+        if (
+            (
+                self.network_process
+                or current_time - self.last_broadcast > BROADCAST_INTERVAL
+            )
+            and not self.waiting
+            and not self.death_menu_active
+            and self.sessions  # Only broadcast if clients are connected
+        ):
+            self.broadcast_game_state()
+            self.last_broadcast = current_time
+            self.metrics.broadcast_seconds.observe(time.time() - current_time)
+        self.send_reliable(current_time)
 
-            # Shorter sleep for more responsive server
-            time.sleep(0.0005)
+        if current_time - self.last_ping > PING_INTERVAL:
+            self.evict_idle(current_time)
+            self.ping_clients()
+            self.last_ping = current_time
+
+    def send(self, data, client_address, kind):
+        self.server.sendto(data, client_address)
+        self.sessions.sent(client_address)
+        self.metrics.count_out(kind, len(data))
 
     def process_incoming_messages(self):
         data, client_address = self.server.recvfrom(BUFFER_SIZE)
+        size = len(data)
+        session = self.sessions.seen(client_address)
+        if session:
+            # Only clients with a session, strays would never be forgotten
+            self.metrics.seen(client_address)
+
+        if data.startswith(ACK):
+            # Piggybacked on controls or pongs, or on its own
+            try:
+                (sequence,) = SEQUENCE.unpack_from(data, len(ACK))
+            except struct.error:
+                sequence = 0
+            if session:
+                session.channel.acked(sequence)
+            data = data[len(ACK) + SEQUENCE.size :]
+        self.metrics.count_in(message_type(data) if data else "ack", size)
+        if not data:
+            return
 
         if data.startswith(JOIN_GAME):
-            if self.waiting:
-                if client_address not in self.client_addresses:
-                    self.client_addresses.append(client_address)
-                self.players[client_address] = None
-                self.server.sendto(OK, client_address)
+            # join_game[:token], the token reclaims a player slot after a reconnect
+            token = data[len(JOIN_GAME) + 1 :].decode(errors="replace")
+            if self.waiting or self.sessions.known(token):
+                previous = self.sessions.by_token.get(token)
+                if previous and previous.address != client_address:
+                    self.metrics.forget(previous.address)  # Rebound to a new one
+                session = self.sessions.join(client_address, token)
+                self.metrics.seen(client_address)
+                self.players.setdefault(session.token, None)
+                self.send(OK + b":" + session.token.encode(), client_address, "ok")
             else:
-                self.server.sendto(GAME_ALREADY_STARTED, client_address)
+                self.send(GAME_ALREADY_STARTED, client_address, "game_already_started")
 
         elif data.startswith(SEND_CONTROLS):
-            self.apply_controls(client_address, data[len(SEND_CONTROLS) :])
+            if session:
+                self.apply_controls(session.token, data[len(SEND_CONTROLS) :])
             # No need to send OK for UDP
 
         elif data == GET_FRAME:
             # Legacy support for clients polling for game state
             if self.waiting:
-                self.server.sendto(WAITING, client_address)
+                self.send(WAITING, client_address, "waiting")
             else:
-                self.server.sendto(self.serialize_game(), client_address)
+                self.send(self.serialize_game(), client_address, "frame")
 
         elif data == ECHO:
-            self.server.sendto(data, client_address)
+            self.send(data, client_address, "echo")
+
+        elif data.startswith(PONG):
+            try:
+                (sent_at,) = struct.unpack("!d", data[len(PONG) :])
+            except struct.error:
+                return
+            # The relay timestamps datagrams, so the wait for the next tick
+            # does not count as network delay
+            received = self.server.last_arrival if self.network_process else None
+            if session:
+                self.metrics.observe_rtt(
+                    client_address, (received or time.time()) - sent_at
+                )
+                # A shot arrives a round trip after the snapshot its shooter
+                # aimed at
+                self.rewinds[session.token] = rewind_ticks(
+                    self.metrics.client(client_address)["srtt"]
+                )
+
+        elif data == LEAVE:
+            if session:
+                self.drop(session)
 
         else:
-            self.server.sendto(UNKNOWN, client_address)
+            self.send(UNKNOWN, client_address, "unknown")
 
-    def broadcast_game_state(self):
-        if self.death_menu_active:
-            data = (
-                GAME_OVER
-                + json.dumps(
-                    self.alive_players[0].image_path
-                    if len(self.alive_players) == 1
-                    else ""
-                ).encode()
-            )
+    def evict_idle(self, now=None):
+        for session in self.sessions.expire(now):
+            print(f"Client {session.address} timed out.")
+            if self.waiting:
+                self.drop(session)
+            else:
+                self.release(session)
+
+    def drop(self, session):
+        # Left, or timed out in the lobby: nothing to come back to
+        self.sessions.forget(session)
+        self.release(session)
+        if self.waiting:
+            self.players.pop(session.token, None)
+
+    def release(self, session):
+        self.metrics.forget(session.address)
+        if not self.waiting and session.token in self.players:
+            # Stand still, without lag compensation, until it reconnects
+            self.pending_controls[session.token] = {}
+            self.rewinds[session.token] = 0
         else:
-            game_state = self.serialize_game()
-            self.sequence_number += 1
+            self.rewinds.pop(session.token, None)
 
-            # Binary format: (b'SEQ', sequence_number, game_state_bytes)
-            data = pickle.dumps(("SEQ", self.sequence_number, game_state))
-            if USE_COMPRESSION:
-                data = zlib.compress(data, level=1)  # Use fast compression (level 1)
+    def ping_clients(self):
+        # Clients echo the payload back as PONG, which gives the round trip time,
+        # and double as heartbeats: every answer refreshes the session
+        for client_address in self.sessions.addresses():
+            try:
+                self.send(PING + struct.pack("!d", time.time()), client_address, "ping")
+            except OSError as e:
+                print(f"Error sending to {client_address}: {e}")
+
+    def broadcast_game_state(self):
+        data = self.encode_snapshot()
 
         # Send to all clients with error handling
-        # Copy list to allow modification during iteration
-        for client_address in self.client_addresses[:]:
+        for client_address in self.sessions.addresses():
             try:
-                self.server.sendto(data, client_address)
+                self.send(data, client_address, "snapshot")
             except Exception as e:
                 print(f"Error sending to {client_address}: {e}")
 
+    def broadcast_reliable(self, payload):
+        # Also queued for disconnected sessions, they get it when they rejoin
+        for session in list(self.sessions.by_token.values()):
+            session.channel.send(payload)
+
+    def send_reliable(self, now=None):
+        for session in list(self.sessions.by_address.values()):
+            for sequence, payload in session.channel.due(now):
+                try:
+                    self.send(
+                        RELIABLE + SEQUENCE.pack(sequence) + payload,
+                        session.address,
+                        "reliable",
+                    )
+                except OSError as e:
+                    print(f"Error sending to {session.address}: {e}")
+
+    def intern(self, string):
+        id = self.string_ids.get(string)
+        if id is None:
+            id = self.string_ids[string] = len(self.strings)
+            # At most 255 bytes, cut on a character boundary
+            encoded = string.encode()[:255].decode(errors="ignore").encode()
+            self.strings.append(encoded)
+            self.strings_size += 1 + len(encoded)
+            self.strings_changed = self.sequence_number
+        return id
+
+    def table_size(self):
+        # Room kept for the string table, none if it could never fit
+        if SNAPSHOT.size + self.strings_size > len(self.snapshot_buffer):
+            return 0
+        return self.strings_size
+
+    def encode_snapshot(self):
+        # Valid until the next call. Entities that do not fit in one datagram
+        # next to the string table are left out
+        self.sequence_number += 1
+        buffer = self.snapshot_buffer
+        offset = SNAPSHOT.size
+        count = dropped = 0
+        end = len(buffer) - self.table_size()
+        for n, o in self.game.objects.items():
+            names = self.entity_names.get(n)
+            if names is None:
+                names = self.entity_names[n] = []
+            for i, (image_path, x, y, direction) in enumerate(sprite_states(o)):
+                if i == len(names):
+                    names.append(self.intern(f"{n}{i}"))
+                if offset + ENTITY.size > end:
+                    dropped += 1
+                    continue
+                ENTITY.pack_into(
+                    buffer,
+                    offset,
+                    names[i],
+                    self.intern(image_path),
+                    round(x),
+                    round(y),
+                    direction,
+                )
+                offset += ENTITY.size
+                count += 1
+
+        table_size = self.table_size()
+        has_strings = table_size > 0 and (
+            self.sequence_number - self.strings_changed < STRING_REPEAT
+            or self.sequence_number % STRING_REPEAT == 0
+        )
+        if has_strings and offset + table_size > len(buffer):
+            # The table grew while packing, the last entities make room
+            cut = -(-(offset + table_size - len(buffer)) // ENTITY.size)
+            offset -= cut * ENTITY.size
+            count -= cut
+            dropped += cut
+        if has_strings:
+            for string in self.strings:
+                buffer[offset] = len(string)
+                buffer[offset + 1 : offset + 1 + len(string)] = string
+                offset += 1 + len(string)
+        SNAPSHOT.pack_into(
+            buffer,
+            0,
+            SNAPSHOT_MAGIC,
+            self.sequence_number,
+            time.time(),
+            self.string_epoch,
+            len(self.strings),
+            has_strings,
+            count,
+        )
+        self.metrics.observe_snapshot(offset, dropped)
+        return self.snapshot_view[:offset]
+
     def serialize_game(self):
         # Collect current game state
         current_state = {
             f"{n}{i}": {
-                "p": s.image_path,  # Shorter key names to reduce size
-                "x": round(s.x),
-                "y": round(s.y),
-                "d": s.direction,
+                "p": image_path,  # Shorter key names to reduce size
+                "x": round(x),
+                "y": round(y),
+                "d": direction,
             }
             for n, o in self.game.objects.items()
-            for i, s in enumerate(getattr(o, "sprites", [o]))
-            if isinstance(s, engine.Sprite)
+            for i, (image_path, x, y, direction) in enumerate(sprite_states(o))
         }
 
         return pickle.dumps(current_state)
 
     def game_loop(self):
+        # The profiler has just finished timing the previous tick
+        if self.game.profiler.frames:
+            self.metrics.tick_seconds.observe(self.game.profiler.frames[-1]["total"])
+        self.metrics.sample_thread_cpu("game")
+        if self.network_process:
+            # Inputs before they are latched, then the state of the last update
+            self.network_tick()
         if self.waiting:
             ip_text = pygame.font.Font("images/Anta-Regular.ttf", 74).render(
                 f"IP Address: {self.server.getsockname()[0]}", True, "white"
             )
             self.game.screen.blit(ip_text, (100, self.game.height / 2))
+            if self.prefetch:
+                self.prefetch.install(self.game.atlas)
             return
         if self.death_menu_active:
             show_game_over(
@@ -211,38 +524,76 @@ class Server:
         if (server_player := self.players[self.server.getsockname()]) is not None:
             server_player.keyboard_control()
         self.check_game_over()
+        if self.death_menu_active:
+            return
+        self.latch_controls()
+        if self.recorder and self.recorder.active:
+            self.recorder.record(self.game, list(self.players.values()))
 
     def apply_controls(self, client, data: bytes):
-        if client in self.players and (player := self.players[client]) is not None:
+        if client in self.players and self.players[client] is not None:
             try:
-                player.controls = json.loads(data)
+                self.pending_controls[client] = json.loads(data)
             except json.JSONDecodeError:
                 # Ignore invalid JSON
                 pass
 
+    def latch_controls(self):
+        # Controls arrive on the event thread; apply them only between ticks
+        # so every tick simulates (and records) one consistent set of inputs
+        for client, controls in list(self.pending_controls.items()):
+            if (player := self.players.get(client)) is not None:
+                player.controls = controls
+        for client, rewind in list(self.rewinds.items()):
+            if (player := self.players.get(client)) is not None:
+                player.rewind = rewind
+
+    def stop_recording(self):
+        if self.recorder and (path := self.recorder.stop()):
+            print("Match recorded to", path)
+
+    def prefetch_match(self, prefetch):
+        # On the prefetch thread while the lobby is shown
+        data = load_level_data(self.level)
+        prefetch.load_images(match_images(data.images))
+        return data
+
     def start_game(self):
         self.game.objects.clear()
-        self.game.add_object(
-            "level",
-            Level.load,
-            pos_filepath="level.csv",
-            image_filepath="images/level/{}.png",
-            y_velocity=1,
-            common_sprite_args={"teleport": {"+y": {1080: -440}}},
+        self.pending_controls.clear()
+        self.string_ids.clear()
+        self.strings.clear()
+        self.strings_size = 0
+        self.entity_names.clear()
+        self.string_epoch = (self.string_epoch + 1) % 0x10000
+        data = None
+        if self.prefetch:
+            # Usually finished long before Start is clicked
+            self.prefetch.wait()
+            self.prefetch.install(self.game.atlas)
+            data = self.prefetch.result
+        level = self.game.add_object(
+            "level", Level.from_data, data or load_level_data(self.level)
         )
-        for i, id in enumerate(self.players):
-            self.players[id] = self.game.add_object(
-                f"player{i}",
-                Player,
-                image_path=f"images/player{i % MAX_PLAYER_SKINS}.png",
-                x=self.game.width / 2 + 100 * int(i),
-                y=200,
-                move_acceleration=4,
-                friction=0.25,
-                jump_acceleration=24,
-                gravity=2,
-            )
-        self.game.sound_loop("sounds/game_music.mp3", id="game_music")
+        spawns = level.spawns or [pygame.Vector2(self.game.width / 2, 200)]
+        player_args = [
+            {
+                "image_path": f"images/player{i % MAX_PLAYER_SKINS}.png",
+                "x": spawns[i % len(spawns)].x,
+                "y": spawns[i % len(spawns)].y,
+                "move_acceleration": 4,
+                "friction": 0.25,
+                "jump_acceleration": 24,
+                "gravity": 2,
+            }
+            for i in range(len(self.players))
+        ]
+        for i, (id, args) in enumerate(zip(self.players, player_args)):
+            self.players[id] = self.game.add_object(f"player{i}", Player, **args)
+        PositionHistory.of(self.game)
+        if self.recorder:
+            self.recorder.start(self.game, level, player_args)
+        self.game.music.play("sounds/game_music.mp3")
 
     @property
     def alive_players(self):
@@ -254,13 +605,20 @@ class Server:
 
     def check_game_over(self):
         if len(self.alive_players) <= 1:
-            if "game_music" in self.game.objects:
-                self.game.objects["game_music"].stop()
+            # Sent once, the last snapshot number keeps late snapshots from
+            # ending the client's game over screen
+            winner = self.alive_players[0].image_path if self.alive_players else ""
+            self.broadcast_reliable(
+                GAME_OVER
+                + SEQUENCE.pack(self.sequence_number)
+                + json.dumps(winner).encode()
+            )
+            self.stop_recording()
             self.game.objects.clear()
             self.game.background_image_path = "images/Menu/Background.png"
             self.death_menu_active = True
             self.game.add_object("death_menu", DeathMenu, server=self)
-            self.game.play_sound("sounds/victory.mp3")
+            self.game.music.play("sounds/victory.mp3", loop=False)
 
 
 class Client:
@@ -273,10 +631,27 @@ class Client:
         self.controls = None
         self.last_sequence = 0
         self.connected = False
-        self.game_state = {}  # Current game state
+        # Datagrams are received into one buffer and a newer snapshot is
+        # swapped with the one the game loop decodes from
+        self.receive_buffer = bytearray(BUFFER_SIZE)
+        self.snapshot = bytearray(BUFFER_SIZE)
+        self.snapshot_size = 0
+        self.snapshot_strings = []
+        self.snapshot_lock = threading.Lock()
+        self.strings = []
+        self.string_epoch = None
         self.last_update_time = 0
         self.frame_buffer = []  # Buffer frames to smooth out network jitter
-        self.music = None
+        self.in_game = False
+        self.prefetch = None
+        self.token = None  # Session token from the server's OK
+        self.channel = ReliableChannel()
+        self.entities = {}  # Snapshot key -> sprite, reconciled every frame
+        self.seen = {}  # Snapshot key -> last frame it was in
+        self.frame = 0
+        self.entity_counts = {"created": 0, "destroyed": 0}
+        self.entity_rates = {"created": 0, "destroyed": 0}  # Over the last second
+        self.rate_window = (time.time(), dict(self.entity_counts))
 
     def __enter__(self):
         self.connect()
@@ -287,21 +662,40 @@ class Client:
 
     def connect(self):
         self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.client.settimeout(5)
-        # Send join message
-        self.send_message(JOIN_GAME)
-        # Wait for response
-        response = self.receive_message()
-        if response == GAME_ALREADY_STARTED:
+        # Resend the join with backoff until the server answers
+        timeout = 0.25
+        deadline = time.time() + JOIN_TIMEOUT
+        response = None
+        while response is None and time.time() < deadline:
+            self.client.settimeout(timeout)
+            self.send_message(self.join_message())
+            response = self.receive_message()
+            timeout = min(timeout * 2, 2)
+        if response is None:
+            raise TimeoutError("No response from server")
+        elif response == GAME_ALREADY_STARTED:
             raise ConnectionRefusedError("Game already started")
-        elif response == OK:
+        elif response is not None and response.startswith(OK):
+            self.token = response[len(OK) + 1 :].decode()
             self.connected = True
             self.client.settimeout(0.1)  # Shorter timeout for game loop
         else:
             raise ConnectionRefusedError("Unknown response from server")
 
+    def join_message(self):
+        return JOIN_GAME + (b":" + self.token.encode() if self.token else b"")
+
+    def rejoin(self):
+        # From a fresh socket, in case our address changed; the token keeps
+        # the player slot
+        self.client.close()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(0.1)
+        self.send_message(self.join_message())
+
     def disconnect(self):
         self.connected = False
+        self.send_message(LEAVE)
         self.client.close()
 
     def send_message(self, data):
@@ -314,23 +708,59 @@ class Client:
             print(f"Error sending data: {e}")
 
     def receive_message(self):
+        size = self.receive_into()
+        return bytes(memoryview(self.receive_buffer)[:size]) if size else None
+
+    def receive_into(self):
         try:
-            data, _ = self.client.recvfrom(BUFFER_SIZE)
-            return data
+            size, _ = self.client.recvfrom_into(self.receive_buffer)
+            return size
         except socket.timeout:
-            return None
+            return 0
         except Exception as e:
             print(f"Error receiving data: {e}")
-            return None
+            return 0
+
+    def store_snapshot(self, size):
+        # On the sync thread; only the string table is allocated, when it changes
+        _, sequence, sent_at, epoch, table_size, has_strings, count = snapshot_header(
+            self.receive_buffer
+        )
+        if sequence <= self.last_sequence:
+            return
+        if has_strings and (
+            epoch != self.string_epoch or table_size > len(self.strings)
+        ):
+            self.strings = snapshot_strings(self.receive_buffer, table_size, count)
+            self.string_epoch = epoch
+        if epoch != self.string_epoch or table_size > len(self.strings):
+            return  # Wait for a snapshot that carries the table
+        with self.snapshot_lock:
+            self.snapshot, self.receive_buffer = self.receive_buffer, self.snapshot
+            self.snapshot_size = size
+            self.snapshot_strings = self.strings
+        self.last_sequence = sequence
+        self.last_update_time = time.time()
+        self.next_draw = None  # Reset game over screen when receiving new game state
+
+    def snapshot_entities(self):
+        # Call with snapshot_lock held
+        strings = self.snapshot_strings
+        for name, image, x, y, direction in snapshot_entities(
+            self.snapshot, snapshot_header(self.snapshot)[-1]
+        ):
+            yield strings[name], strings[image], x, y, direction
 
     def main(self):
         self.sync_thread = threading.Thread(target=self.sync)
         self.sync_thread.daemon = True  # Make thread exit when main thread exits
         self.sync_thread.start()
+        self.prefetch = engine.Prefetcher(images=match_images()).start()
         self.game.main(self.game_loop)
 
     def sync(self):
         last_control_send = 0
+        last_received = time.time()
         control_send_interval = (
             1 / 30
         )  # Send controls at 30Hz to reduce network traffic
@@ -343,98 +773,99 @@ class Client:
                     self.controls is not None
                     and current_time - last_control_send > control_send_interval
                 ):
-                    self.send_message(SEND_CONTROLS + self.controls)
+                    self.send_message(self.with_ack(SEND_CONTROLS + self.controls))
                     last_control_send = current_time
 
                 # Receive game state
-                data = self.receive_message()
-                if data:
+                size = self.receive_into()
+                if not size and current_time - last_received > RECONNECT_INTERVAL:
+                    self.rejoin()
+                    last_received = current_time
+                if size >= SNAPSHOT.size and self.receive_buffer.startswith(
+                    SNAPSHOT_MAGIC
+                ):
+                    last_received = current_time
+                    self.store_snapshot(size)
+                elif size:
+                    data = bytes(memoryview(self.receive_buffer)[:size])
+                    last_received = current_time
                     if data == WAITING:
                         self.next_draw = WAITING
-                    elif data.startswith(GAME_OVER):
-                        self.game.objects.clear()
-                        self.next_draw = data
-                    else:
-                        try:
-                            if USE_COMPRESSION:
-                                data = zlib.decompress(data)
-                            msg_type, seq, game_state = pickle.loads(data)
-                            if msg_type == "SEQ" and seq > self.last_sequence:
-                                self.last_sequence = seq
-                                self.game_state = game_state
-                                self.last_update_time = time.time()
-                                self.next_draw = None  # Reset game over screen when receiving new game state
-                        except (UnicodeDecodeError, pickle.PickleError) as e:
-                            print(f"Error parsing game state: {e}")
-                            pass
+                    elif data.startswith(OK):
+                        pass  # Answer to rejoin()
+                    elif data.startswith(PING):
+                        self.send_message(self.with_ack(PONG + data[len(PING) :]))
+                    elif data.startswith(RELIABLE):
+                        (sequence,) = SEQUENCE.unpack_from(data, len(RELIABLE))
+                        offset = len(RELIABLE) + SEQUENCE.size
+                        for payload in self.channel.receive(sequence, data[offset:]):
+                            self.handle_control(payload)
+                        if self.controls is None:
+                            # Nothing to piggyback the ack on
+                            self.send_message(self.with_ack(b""))
             except Exception as e:
                 print(f"Error in sync thread: {e}")
 
             # Shorter sleep for more responsive client
             time.sleep(0.001)
 
+    def with_ack(self, data):
+        sequence = self.channel.take_ack()
+        if sequence is None:
+            return data
+        return ACK + SEQUENCE.pack(sequence) + data
+
+    def handle_control(self, payload):
+        if payload.startswith(GAME_OVER):
+            # Snapshots sent before the game ended may still arrive
+            (sequence,) = SEQUENCE.unpack_from(payload, len(GAME_OVER))
+            self.last_sequence = max(self.last_sequence, sequence)
+            self.next_draw = GAME_OVER + payload[len(GAME_OVER) + SEQUENCE.size :]
+
     def game_loop(self):
-        if (
-            self.game_state is None
-            or self.game_state == {}
-            or self.next_draw == WAITING
-        ):
-            if "menu_music" not in self.game.objects:
-                self.game.sound_loop("sounds/menu_music.mp3", id="menu_music")
+        if not self.snapshot_size or self.next_draw == WAITING:
+            self.game.music.play("sounds/menu_music.mp3")
             waiting_text = pygame.font.Font("images/Anta-Regular.ttf", 74).render(
                 "Waiting for players...", True, "white"
             )
             self.game.screen.blit(waiting_text, (100, self.game.height / 2))
+            if self.prefetch:
+                self.prefetch.install(self.game.atlas)
             return
 
         if self.next_draw and self.next_draw.startswith(GAME_OVER):
             winner = json.loads(self.next_draw[len(GAME_OVER) :])
+            self.reconcile(())
             self.game.background_image_path = "images/Menu/Background.png"
             show_game_over(self.game, winner if len(winner) > 0 else None)
-            if self.music:
-                self.music.stop()
-                self.music = None
-                self.game.play_sound("sounds/victory.mp3")
+            if self.in_game:
+                self.in_game = False
+                self.game.music.play("sounds/victory.mp3", loop=False)
             return
 
-        if not self.music:
-            if "menu_music" in self.game.objects:
-                self.game.objects["menu_music"].stop()
-            self.music = self.game.sound_loop("sounds/game_music.mp3", id="game_music")
+        if not self.in_game:
+            self.in_game = True
+            if self.prefetch:
+                self.prefetch.wait()
+                self.prefetch.install(self.game.atlas)
+            self.game.music.play("sounds/game_music.mp3")
 
         # Update controls - do this before rendering to ensure most recent input
         self.controls = json.dumps(get_controls()).encode()
 
         self.game.background_image_path = None
-        # Update game objects from network state - only do this when needed
-        # Check if we need to rebuild all objects
-        if len(self.game_state) != len(self.game.objects):
-            self.game.objects.clear()
-
-        # Update or create objects from game state
-        if isinstance(self.game_state, bytes):
-            try:
-                self.game_state = pickle.loads(self.game_state)
-            except UnicodeDecodeError:
-                print("Error decoding game state")
-                self.game_state = {}
-
-        for name, obj_data in self.game_state.items():
-            # Convert short keys back to full names if needed
-            image_path = obj_data.get("p", obj_data.get("image_path", ""))
-            x = obj_data.get("x", 0)
-            y = obj_data.get("y", 0)
-            direction = obj_data.get("d", obj_data.get("direction", 1))
-
-            if name in self.game.objects:
-                # Update existing object
-                sprite = self.game.objects[name]
-                sprite.x = x
-                sprite.y = y
-                sprite.direction = direction
-            else:
-                # Create new object
-                self.game.add_object(
+        with self.snapshot_lock:
+            self.reconcile(self.snapshot_entities())
+
+    def reconcile(self, entities):
+        # Only entities that appeared or vanished are created or destroyed;
+        # sprites come from the game's pool and images from the atlas
+        self.frame += 1
+        for name, image_path, x, y, direction in entities:
+            self.seen[name] = self.frame
+            sprite = self.entities.get(name)
+            if sprite is None:
+                self.entities[name] = self.game.acquire_object(
                     name,
                     engine.Sprite,
                     image_path=image_path,
@@ -442,6 +873,28 @@ class Client:
                     y=y,
                     direction=direction,
                 )
+                self.entity_counts["created"] += 1
+            elif sprite.image_path != image_path:
+                sprite.reset(image_path, x, y, direction=direction)
+            else:
+                sprite.x = x
+                sprite.y = y
+                sprite.direction = direction
+
+        for name in [name for name, frame in self.seen.items() if frame != self.frame]:
+            del self.seen[name]
+            self.game.release_object(self.entities.pop(name))
+            self.entity_counts["destroyed"] += 1
+
+        now = time.time()
+        start, counts = self.rate_window
+        if now - start >= 1:
+            self.entity_rates = {
+                key: (value - counts[key]) / (now - start)
+                for key, value in self.entity_counts.items()
+            }
+            self.rate_window = (now, dict(self.entity_counts))
+            self.game.profiler.counters["entities"] = self.entity_rates
 
 
 class ServerLobbyMenu(engine.Menu):
@@ -453,7 +906,6 @@ class ServerLobbyMenu(engine.Menu):
 
     @engine.button("images/Menu/Start.png")
     def start(self):
-        self.game.objects["music"].stop()
         self.game.remove_object(self)
         self.server.start_game()
         self.game.background_image_path = None
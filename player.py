@@ -1,11 +1,23 @@
-from datetime import datetime
-
 import pygame
 import attacks
 from engine import Game, Sprite
 
 
 class Player(Sprite):
+    __slots__ = (
+        "move_acceleration",
+        "friction",
+        "jump_acceleration",
+        "gravity",
+        "x_velocity",
+        "y_velocity",
+        "_backwards",
+        "_shots",
+        "health",
+        "controls",
+        "rewind",
+    )
+
     def __init__(
         self,
         game: Game,
@@ -26,6 +38,7 @@ class Player(Sprite):
         self._shots = 0
         self.health = 100
         self.controls = {}
+        self.rewind = 0  # Ticks its shots are rewound by, from its client's lag
 
     def loop(self):
         self.read_controls()
@@ -75,9 +88,7 @@ class Player(Sprite):
         self.controls = get_controls()
 
     def shoot(self):
-        self.game.add_object(
-            f"shoot_attack{datetime.now()}",
-            attacks.ShootAttack,
+        attacks.ProjectileSystem.of(self.game).spawn(
             max_distance=400,
             parent=self,
             x_velocity=(10 + self.move_acceleration) * self.direction,
@@ -86,7 +97,6 @@ class Player(Sprite):
             x=self.x,
             y=self.y,
             direction=self.direction,
-            collidable=False,
         )
 
     def on_hit(self, attack: attacks.Attack):
@@ -107,6 +117,17 @@ class Player(Sprite):
         return self.health <= 0
 
 
+CONTROLS = ("left", "right", "jump", "shoot")
+
+
+def pack_controls(controls):
+    return sum(1 << i for i, key in enumerate(CONTROLS) if controls.get(key, False))
+
+
+def unpack_controls(mask):
+    return {key: bool(mask >> i & 1) for i, key in enumerate(CONTROLS)}
+
+
 def get_controls():
     key = pygame.key.get_pressed()
     return {
@@ -0,0 +1,226 @@
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+RING_SIZE = 4 * 1024 * 1024  # Bytes each way
+DATAGRAM_SIZE = 65507  # Same as network.BUFFER_SIZE, without importing pygame
+IDLE_WAIT = 0.0005  # Longest the relay sleeps with nothing to send or receive
+CLOSE_TIMEOUT = 1.0
+
+# Ring header: head, tail, capacity, dropped, closed
+HEAD, TAIL, CAPACITY, DROPPED, CLOSED = range(0, 40, 8)
+HEADER_SIZE = 40
+COUNTER = struct.Struct("Q")
+LENGTH = struct.Struct("I")
+WRAP = 0xFFFFFFFF  # Rest of the ring is unused, next record is at the start
+# IPv4 address and port, plus the arrival time for datagrams coming in
+ADDRESS = struct.Struct("!4sH")
+ARRIVAL = struct.Struct("!4sHd")
+
+
+class RingBuffer:
+    # Byte strings queued in shared memory by one producer for one consumer.
+    # Only the producer moves head and only the consumer moves tail
+    def __init__(self, name=None, size=RING_SIZE):
+        if name is None:
+            self.memory = shared_memory.SharedMemory(
+                create=True, size=HEADER_SIZE + size
+            )
+            self.memory.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+            COUNTER.pack_into(self.memory.buf, CAPACITY, size)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+        self.name = self.memory.name
+        self.buf = self.memory.buf
+        self.capacity = self.get(CAPACITY)
+
+    def get(self, field):
+        return COUNTER.unpack_from(self.buf, field)[0]
+
+    def set(self, field, value):
+        COUNTER.pack_into(self.buf, field, value)
+
+    def push(self, data):
+        head = self.get(HEAD)
+        free = self.capacity - (head - self.get(TAIL))
+        offset = head % self.capacity
+        size = LENGTH.size + len(data)
+        # Records never wrap around, the end of the ring is skipped instead
+        pad = self.capacity - offset if offset + size > self.capacity else 0
+        if pad + size > free:
+            self.set(DROPPED, self.get(DROPPED) + 1)
+            return False
+        if pad:
+            if pad >= LENGTH.size:
+                LENGTH.pack_into(self.buf, HEADER_SIZE + offset, WRAP)
+            offset = 0
+        start = HEADER_SIZE + offset + LENGTH.size
+        LENGTH.pack_into(self.buf, start - LENGTH.size, len(data))
+        self.buf[start : start + len(data)] = data
+        self.set(HEAD, head + pad + size)  # Last, so the record is complete
+        return True
+
+    def pop(self):
+        tail = self.get(TAIL)
+        while tail != self.get(HEAD):
+            offset = tail % self.capacity
+            if self.capacity - offset >= LENGTH.size:
+                (length,) = LENGTH.unpack_from(self.buf, HEADER_SIZE + offset)
+                if length != WRAP:
+                    start = HEADER_SIZE + offset + LENGTH.size
+                    data = bytes(self.buf[start : start + length])
+                    self.set(TAIL, tail + LENGTH.size + length)
+                    return data
+            tail += self.capacity - offset
+            self.set(TAIL, tail)
+        return None
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class RelaySocket:
+    # Stands in for the server's UDP socket. A relay process owns the real
+    # one, so receiving and sending never wait for the simulation's GIL
+    def __init__(self, address, size=RING_SIZE):
+        self.inbound = RingBuffer(size=size)
+        self.outbound = RingBuffer(size=size)
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                self.inbound.name,
+                self.outbound.name,
+                str(address[0]),
+                str(address[1]),
+            ],
+            stdin=subprocess.PIPE,  # Closed when this process exits, however
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        line = self.process.stdout.readline().split()
+        if not line:
+            self.close()
+            raise OSError(f"Relay could not bind to {address}")
+        self.address = (line[0], int(line[1]))
+        self.last_arrival = None  # When the relay got the last datagram
+
+    def getsockname(self):
+        return self.address
+
+    def setblocking(self, flag):
+        pass  # Always non-blocking
+
+    def recvfrom(self, bufsize):
+        record = self.inbound.pop()
+        if record is None:
+            raise BlockingIOError
+        ip, port, self.last_arrival = ARRIVAL.unpack_from(record)
+        return record[ARRIVAL.size :][:bufsize], (socket.inet_ntoa(ip), port)
+
+    def sendto(self, data, address):
+        # Dropped like a full socket buffer would, and counted
+        self.outbound.push(
+            ADDRESS.pack(socket.inet_aton(address[0]), address[1]) + data
+        )
+        return len(data)
+
+    def stats(self):
+        return {
+            "inbound_dropped": self.inbound.get(DROPPED),
+            "outbound_dropped": self.outbound.get(DROPPED),
+        }
+
+    def close(self):
+        if self.inbound.buf is None:
+            return
+        self.inbound.set(CLOSED, 1)
+        try:
+            self.process.wait(CLOSE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.inbound.close(unlink=True)
+        self.outbound.close(unlink=True)
+
+
+def watch_parent(orphaned):
+    # The parent holds the other end of stdin, EOF means it is gone without
+    # closing the relay
+    while os.read(sys.stdin.fileno(), 1024):
+        pass
+    orphaned.set()
+
+
+def unlink(ring):
+    # The parent's resource tracker may have got there first
+    resource_tracker.register(ring.memory._name, "shared_memory")
+    try:
+        ring.memory.unlink()
+    except FileNotFoundError:
+        resource_tracker.unregister(ring.memory._name, "shared_memory")
+
+
+def relay(sock, inbound, outbound, orphaned=None):
+    orphaned = orphaned or threading.Event()
+    sock.setblocking(False)
+    while not inbound.get(CLOSED) and not orphaned.is_set():
+        idle = True
+        while True:
+            try:
+                data, (host, port) = sock.recvfrom(DATAGRAM_SIZE)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                continue  # Windows reports an unreachable client here
+            idle = False
+            inbound.push(ARRIVAL.pack(socket.inet_aton(host), port, time.time()) + data)
+        while (record := outbound.pop()) is not None:
+            idle = False
+            ip, port = ADDRESS.unpack_from(record)
+            try:
+                sock.sendto(
+                    memoryview(record)[ADDRESS.size :], (socket.inet_ntoa(ip), port)
+                )
+            except OSError:
+                pass
+        if idle:
+            select.select([sock], [], [], IDLE_WAIT)
+
+
+def main(argv=None):
+    inbound_name, outbound_name, host, port = argv or sys.argv[1:]
+    inbound = RingBuffer(inbound_name)
+    outbound = RingBuffer(outbound_name)
+    for ring in (inbound, outbound):
+        # Attaching registers the segment as if this process owned it, and it
+        # would be unlinked when the relay exits
+        resource_tracker.unregister(ring.memory._name, "shared_memory")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, int(port)))
+    print(*sock.getsockname(), flush=True)
+    orphaned = threading.Event()
+    threading.Thread(target=watch_parent, args=(orphaned,), daemon=True).start()
+    try:
+        relay(sock, inbound, outbound, orphaned)
+    finally:
+        sock.close()
+        for ring in (inbound, outbound):
+            if orphaned.is_set():
+                unlink(ring)
+            ring.close()
+
+
+if __name__ == "__main__":
+    main()
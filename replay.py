@@ -0,0 +1,176 @@
+import argparse
+import os
+import pickle
+import time
+import zlib
+from datetime import datetime
+
+from attacks import PositionHistory
+from engine import Game, MultiSprite, Sprite
+from level import Level
+from player import Player, pack_controls, unpack_controls
+
+RECORDING_VERSION = 3
+
+
+def state_hash(game: Game):
+    state = []
+    for obj in game.objects.values():
+        if hasattr(obj, "state"):
+            state.append((type(obj).__name__, obj.state()))
+            continue
+        for sprite in obj.sprites if isinstance(obj, MultiSprite) else [obj]:
+            if isinstance(sprite, Sprite):
+                state.append(
+                    (
+                        type(sprite).__name__,
+                        sprite.x,
+                        sprite.y,
+                        sprite.direction,
+                        getattr(sprite, "health", None),
+                        getattr(sprite, "x_velocity", None),
+                        getattr(sprite, "y_velocity", None),
+                    )
+                )
+    return zlib.crc32(repr(state).encode())
+
+
+def save_recording(recording, path):
+    with open(path, "wb") as f:
+        f.write(zlib.compress(pickle.dumps(recording)))
+
+
+def load_recording(path):
+    with open(path, "rb") as f:
+        recording = pickle.loads(zlib.decompress(f.read()))
+    if recording.get("version") != RECORDING_VERSION:
+        raise ValueError(f"Unsupported recording version in {path}")
+    return recording
+
+
+class Recorder:
+    def __init__(self, directory="recordings"):
+        self.directory = directory
+        self.recording = None
+
+    @property
+    def active(self):
+        return self.recording is not None
+
+    def start(self, game: Game, level: Level, player_args):
+        self.recording = {
+            "version": RECORDING_VERSION,
+            "screen_size": game.screen.get_size(),
+            "level": {
+                "sprite_args": [
+                    {
+                        "image_path": sprite.image_path,
+                        "x": sprite.x,
+                        "y": sprite.y,
+                        "teleport": sprite.teleport,
+                        "collidable": sprite.collidable,
+                    }
+                    for sprite in level.sprites
+                ],
+                "y_velocity": level.y_velocity,
+            },
+            "players": player_args,
+            "controls": [],
+            "rewinds": [],
+            "hashes": [],
+        }
+
+    def record(self, game: Game, players):
+        # Called once per tick, after controls are latched and before objects update
+        self.recording["hashes"].append(state_hash(game))
+        self.recording["controls"].append(
+            tuple(pack_controls(player.controls) for player in players)
+        )
+        self.recording["rewinds"].append(tuple(player.rewind for player in players))
+
+    def stop(self):
+        if not self.active:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, f"match-{datetime.now():%Y%m%d-%H%M%S-%f}.rec"
+        )
+        save_recording(self.recording, path)
+        self.recording = None
+        return path
+
+
+class Replayer:
+    def __init__(self, recording, game: Game | None = None):
+        self.recording = recording
+        self.game = game or Game(recording["screen_size"])
+        self.game.fps = 0
+        self.players = []
+
+    def setup(self):
+        self.game.objects.clear()
+        self.game.add_object("level", Level, **self.recording["level"])
+        self.players = [
+            self.game.add_object(f"player{i}", Player, **args)
+            for i, args in enumerate(self.recording["players"])
+        ]
+        PositionHistory.of(self.game)
+
+    def run(self, check=True):
+        self.setup()
+        mismatch = None
+        start = time.perf_counter()
+        for tick, (masks, rewinds, expected) in enumerate(
+            zip(
+                self.recording["controls"],
+                self.recording["rewinds"],
+                self.recording["hashes"],
+            )
+        ):
+            if check and mismatch is None and state_hash(self.game) != expected:
+                mismatch = tick
+            for player, mask, rewind in zip(self.players, masks, rewinds):
+                player.controls = unpack_controls(mask)
+                player.rewind = rewind
+            self.game.update()
+        elapsed = time.perf_counter() - start
+        ticks = len(self.recording["controls"])
+        return {
+            "ticks": ticks,
+            "elapsed": elapsed,
+            "ticks_per_second": ticks / elapsed if elapsed else float("inf"),
+            "first_mismatch": mismatch,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Re-run a recorded match headlessly as fast as possible and "
+        "check that every tick reproduces the recorded state."
+    )
+    parser.add_argument("recording")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--no-check", action="store_true")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    recording = load_recording(args.recording)
+    failed = False
+    for _ in range(args.repeat):
+        result = Replayer(recording).run(check=not args.no_check)
+        realtime = result["ticks_per_second"] / 60
+        print(
+            f"{result['ticks']} ticks in {result['elapsed']:.3f}s "
+            f"({result['ticks_per_second']:.0f} ticks/s, {realtime:.1f}x realtime)"
+        )
+        if result["first_mismatch"] is not None:
+            print(
+                f"State diverged from the recording at tick {result['first_mismatch']}"
+            )
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,170 @@
+import secrets
+import threading
+import time
+
+SESSION_TIMEOUT = 5.0  # Seconds without a datagram, pings come every second
+RETRANSMIT_TIMEOUT = 0.2  # Doubles with every retransmit
+MAX_RETRANSMIT_TIMEOUT = 2.0
+
+
+class ReliableChannel:
+    # Sequence numbers, cumulative acks and retransmits for the few messages
+    # that must arrive, in order, exactly once. Framing is up to the caller
+    def __init__(self, timeout=RETRANSMIT_TIMEOUT):
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.next_sequence = 1
+        self.unacked = {}  # Sequence -> [payload, next send time, timeout]
+        self.received = 0  # Last sequence delivered in order
+        self.early = {}  # Arrived ahead of a gap
+        self.ack_pending = False
+        self.sent = 0
+        self.retransmits = 0
+
+    def send(self, payload):
+        # Queued, goes out with the next due()
+        with self.lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            self.unacked[sequence] = [payload, 0, self.timeout]
+        return sequence
+
+    def due(self, now=None):
+        if not self.unacked:
+            return []
+        now = now or time.time()
+        packets = []
+        with self.lock:
+            for sequence, entry in self.unacked.items():
+                payload, send_at, timeout = entry
+                if send_at > now:
+                    continue
+                if send_at:
+                    self.retransmits += 1
+                    timeout = entry[2] = min(timeout * 2, MAX_RETRANSMIT_TIMEOUT)
+                else:
+                    self.sent += 1
+                entry[1] = now + timeout
+                packets.append((sequence, payload))
+        return packets
+
+    def acked(self, sequence):
+        with self.lock:
+            for acked in [s for s in self.unacked if s <= sequence]:
+                del self.unacked[acked]
+
+    def receive(self, sequence, payload):
+        # Payloads that are now deliverable, in order
+        self.ack_pending = True
+        if sequence <= self.received:
+            return []  # Duplicate, our ack was lost
+        self.early[sequence] = payload
+        delivered = []
+        while self.received + 1 in self.early:
+            self.received += 1
+            delivered.append(self.early.pop(self.received))
+        return delivered
+
+    def take_ack(self):
+        if not self.ack_pending:
+            return None
+        self.ack_pending = False
+        return self.received
+
+
+class Session:
+    def __init__(self, address, token=None):
+        self.address = address
+        self.token = token or secrets.token_hex(8)
+        self.active = True
+        self.last_seen = time.time()
+        self.sends = 0
+        self.unanswered = 0  # Sent since the client was last heard from
+        self.channel = ReliableChannel()
+
+
+class SessionTable:
+    # Clients by address and by the token they rejoin with after the address
+    # changed. Only active sessions are sent to
+    def __init__(self, timeout=SESSION_TIMEOUT):
+        self.timeout = timeout
+        self.by_address = {}
+        self.by_token = {}
+        self.evictions = 0
+        self.reconnects = 0
+        self.wasted_sends = 0
+        self.retransmits = 0  # Of sessions already forgotten
+
+    def __len__(self):
+        return len(self.by_address)
+
+    def addresses(self):
+        return list(self.by_address)
+
+    def get(self, address):
+        return self.by_address.get(address)
+
+    def known(self, token):
+        return token in self.by_token
+
+    def join(self, address, token=None):
+        session = self.by_token.get(token)
+        if session is None:
+            session = self.by_address.get(address)
+            if session is None:
+                session = Session(address)
+                self.by_token[session.token] = session
+        elif session.address != address or not session.active:
+            self.reconnects += 1
+            self.by_address.pop(session.address, None)
+        session.address = address
+        session.active = True
+        self.by_address[address] = session
+        self.seen(address)
+        return session
+
+    def seen(self, address, now=None):
+        session = self.by_address.get(address)
+        if session is not None:
+            session.last_seen = now or time.time()
+            session.unanswered = 0
+        return session
+
+    def sent(self, address):
+        session = self.by_address.get(address)
+        if session is not None:
+            session.sends += 1
+            session.unanswered += 1
+
+    def expire(self, now=None):
+        # Idle sessions stop receiving but keep their token for a reconnect
+        now = now or time.time()
+        expired = [
+            session
+            for session in self.by_address.values()
+            if now - session.last_seen > self.timeout
+        ]
+        for session in expired:
+            del self.by_address[session.address]
+            session.active = False
+            self.evictions += 1
+            self.wasted_sends += session.unanswered
+        return expired
+
+    def forget(self, session):
+        if self.by_address.get(session.address) is session:
+            del self.by_address[session.address]
+        if self.by_token.pop(session.token, None) is session:
+            self.retransmits += session.channel.retransmits
+        session.active = False
+
+    def stats(self):
+        return {
+            "active": len(self.by_address),
+            "disconnected": len(self.by_token) - len(self.by_address),
+            "evictions": self.evictions,
+            "reconnects": self.reconnects,
+            "wasted_sends": self.wasted_sends,
+            "retransmits": self.retransmits
+            + sum(session.channel.retransmits for session in self.by_token.values()),
+        }
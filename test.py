@@ -1,12 +1,35 @@
+import ctypes
+import glob
 import unittest
-from unittest.mock import MagicMock, mock_open, patch
+from unittest.mock import MagicMock, patch
 import pygame
+import multiprocessing
+import os
 import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 from engine import Game, Menu, Sprite, MultiSprite, button
+import engine
 from network import get_wlan_ip
+import network
+import loadtest
+import netproxy
+import replay
+import bench
+import metrics
+import urllib.request
 from level import Level
+import level as level_module
 from player import Player
+import player as player_module
 import attacks
+import assets
+import sessions
+import relay
+import shutil
 
 # Mock pygame.mixer globally
 pygame.mixer = MagicMock()
@@ -46,6 +69,519 @@ class TestGame(unittest.TestCase):
         self.assertFalse(self.game.running)
         mock_flip.assert_called_once()
 
+    def test_mixer_starts_on_first_use(self, *_):
+        with patch("pygame.mixer") as mixer:
+            game = Game((800, 600))
+            mixer.init.assert_not_called()
+            game.play_sound("sounds/shoot.wav")
+            game.play_sound("sounds/shoot.wav")
+            mixer.init.assert_called_once()
+
+    def test_defer_runs_after_frame(self, *_):
+        calls = []
+        self.game.fps = 0
+        self.game.defer(lambda: calls.append(len(self.game.profiler.frames)))
+        self.game.loop()
+        self.game.loop()
+        self.assertEqual(calls, [1])
+
+
+class TestMusic(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.game.mixer = MagicMock()
+        self.stream = self.game.mixer.music
+        self.stream.get_busy.return_value = True
+        self.music = self.game.music
+
+    def tearDown(self):
+        engine.Music.shared = None
+
+    def end_track(self):
+        self.music.handle_event(pygame.event.Event(engine.MUSIC_END))
+
+    def test_streams_instead_of_decoding(self):
+        self.music.play("sounds/menu_music.mp3")
+        self.stream.load.assert_called_once_with("sounds/menu_music.mp3")
+        self.stream.play.assert_called_once_with(-1, fade_ms=engine.MUSIC_FADE_MS)
+        self.game.mixer.Sound.assert_not_called()
+        self.assertEqual(self.game.objects, {})
+
+    def test_shared_between_games(self):
+        other = Game((800, 600))
+        other.mixer = self.game.mixer
+        self.assertIs(other.music, self.music)
+
+    def test_same_track_keeps_playing(self):
+        self.music.play("sounds/menu_music.mp3")
+        self.music.play("sounds/menu_music.mp3")
+        self.stream.load.assert_called_once()
+        self.stream.fadeout.assert_not_called()
+
+    def test_switch_fades_into_queued_track(self):
+        self.music.play("sounds/menu_music.mp3")
+        self.music.play("sounds/victory.mp3", loop=False)
+        self.stream.fadeout.assert_called_once_with(engine.MUSIC_FADE_MS)
+        self.stream.queue.assert_called_once_with("sounds/victory.mp3", loops=0)
+        self.stream.load.assert_called_once()
+        self.assertEqual(self.music.current, "sounds/menu_music.mp3")
+        self.end_track()
+        self.assertEqual(self.music.current, "sounds/victory.mp3")
+        self.stream.get_busy.return_value = False
+        self.end_track()
+        self.assertIsNone(self.music.current)
+
+    def test_playlist_preloads_next_track(self):
+        self.music.play(["a.mp3", "b.mp3"])
+        self.stream.play.assert_called_once_with(0, fade_ms=engine.MUSIC_FADE_MS)
+        self.stream.queue.assert_called_once_with("b.mp3", loops=0)
+        self.end_track()
+        self.assertEqual(self.music.current, "b.mp3")
+        self.stream.queue.assert_called_with("a.mp3", loops=0)
+        self.end_track()
+        self.assertEqual(self.music.current, "a.mp3")
+
+    def test_game_loop_forwards_end_event(self):
+        self.music.play(["a.mp3", "b.mp3"])
+        self.game.fps = 0
+        with patch(
+            "pygame.event.get", return_value=[pygame.event.Event(engine.MUSIC_END)]
+        ):
+            self.game.loop()
+        self.assertEqual(self.music.current, "b.mp3")
+
+    def test_stop_fades_out(self):
+        self.music.play("sounds/menu_music.mp3")
+        self.music.stop()
+        self.stream.fadeout.assert_called_once_with(engine.MUSIC_FADE_MS)
+        self.assertIsNone(self.music.current)
+        self.end_track()
+        self.music.play("sounds/menu_music.mp3")
+        self.assertEqual(self.stream.load.call_count, 2)
+
+
+class TestTextureRenderer(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((320, 240), renderer="software")
+        self.addCleanup(self.game.renderer.close)
+
+    def draw_scene(self, game):
+        game.renderer.begin_frame()
+        Sprite(game, "images/player0.png", x=10, y=20, direction=-1).draw()
+        Sprite(game, "images/level/0.png", x=100, y=100).draw()
+        shot = Sprite(game, "images/attacks/shoot0.png", x=200, y=30)
+        shot.image1.set_alpha(100)
+        shot.draw()
+        shot.image1.set_alpha(None)
+
+    def test_matches_surface_renderer(self, *_):
+        self.draw_scene(self.game)
+        pixels = pygame.surfarray.array3d(self.game.renderer.renderer.to_surface())
+        surface_game = Game((320, 240))
+        self.draw_scene(surface_game)
+        expected = pygame.surfarray.array3d(surface_game.screen)
+        self.assertGreater(expected.sum(), 0)
+        self.assertLessEqual(abs(pixels.astype(int) - expected).max(), 2)
+
+    def test_flipped_by_renderer(self, *_):
+        sprite = Sprite(self.game, "images/player0.png", x=0, y=0)
+        self.assertIn(sprite.image2, self.game.atlas.mirrored)
+        self.assertEqual(sprite.image2.get_abs_offset(), sprite.image1.get_abs_offset())
+        self.assertFalse(self.game.atlas.flip_copies)
+
+    def test_textures_uploaded_once(self, *_):
+        self.game.fps = 0
+        self.game.add_object("sprite", Sprite, "images/player0.png", x=0, y=0)
+        self.game.loop()
+        textures = len(self.game.renderer.textures)
+        self.game.loop()
+        self.game.loop()
+        self.assertEqual(len(self.game.renderer.textures), textures)
+
+    @patch("pygame.quit")
+    def test_nested_game_keeps_window(self, quit):
+        # A match started from a menu button returns to the menu's frame
+        def start_match():
+            match = Game((320, 240), renderer="software")
+            match.main(lambda: setattr(match, "running", False))
+            self.game.running = False
+
+        self.game.fps = 0
+        self.game.main(start_match)
+        quit.assert_called_once()
+        self.assertIsNone(engine.TextureRenderer.shared)
+
+    def test_screen_is_an_overlay(self, *_):
+        self.assertEqual(self.game.screen.get_size(), (320, 240))
+        self.game.screen.fill("white")
+        self.game.renderer.present()
+
+
+class TestLogicalResolution(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((400, 300), resolution=(200, 100))
+
+    def test_size(self, *_):
+        self.assertEqual((self.game.width, self.game.height), (200, 100))
+        self.assertEqual(self.game.renderer.viewport, pygame.Rect(0, 50, 400, 200))
+
+    def test_scaled_once_to_window(self, *_):
+        self.game.screen.fill("black")
+        self.game.screen.fill("white", (100, 50, 1, 1))
+        self.game.renderer.present()
+        window = pygame.display.get_surface()
+        self.assertEqual(window.get_at((200, 150)), pygame.Color("white"))
+        self.assertEqual(window.get_at((201, 151)), pygame.Color("white"))
+        self.assertEqual(window.get_at((202, 150)), pygame.Color("black"))
+        self.assertEqual(window.get_at((200, 10)), pygame.Color("black"))
+
+    @patch("pygame.mouse.get_pos", return_value=(200, 150))
+    def test_mouse_position(self, *_):
+        self.assertEqual(self.game.mouse_position(), (100, 50))
+
+    def test_button_hover(self, *_):
+        menu = TestMenu.Menu1(self.game, x=100, y=40)
+        button, _ = menu.buttons
+        # In window coordinates, the menu works in logical ones
+        x, y = button.rect.center
+        for position, direction in (((2 * x, 50 + 2 * y), -1), ((x, y), 1)):
+            event = pygame.event.Event(pygame.MOUSEMOTION, pos=position)
+            menu.handle_event(event)
+            self.assertEqual(button.direction, direction)
+
+    def test_texture_renderer(self, *_):
+        game = Game((400, 300), renderer="software", resolution=(200, 100))
+        self.addCleanup(game.renderer.close)
+        self.assertEqual(game.screen.get_size(), (200, 100))
+        self.assertEqual(game.renderer.renderer.logical_size, (200, 100))
+        with patch("pygame.mouse.get_pos", return_value=(0, 50)):
+            self.assertEqual(game.mouse_position(), (0, 0))
+
+    def push_sdl_event(self, game, event_type, position):
+        # Straight into SDL's queue, where its renderer maps the position
+        path = glob.glob(
+            os.path.join(
+                os.path.dirname(pygame.__file__), "..", "pygame.libs", "libSDL2-2*"
+            )
+        )
+        if not path:
+            self.skipTest("pygame's SDL library not found")
+        event = (ctypes.c_uint8 * 56)()
+        down = event_type == pygame.MOUSEBUTTONDOWN
+        struct.pack_into(
+            "IIIIBBBBii",
+            event,
+            0,
+            event_type,
+            0,
+            game.renderer.window.id,
+            0,
+            1,
+            down,
+            1,
+            0,
+            *position,
+        )
+        ctypes.CDLL(path[0]).SDL_PushEvent(event)
+
+    def test_texture_renderer_click(self, *_):
+        game = Game((400, 300), renderer="software", resolution=(200, 100))
+        self.addCleanup(game.renderer.close)
+        game.fps = 0
+        menu = game.add_object("menu", TestMenu.Menu1, x=100, y=40)
+        clicks = []
+        menu.buttons[0].func = clicks.append
+        x, y = menu.buttons[0].rect.center
+        for event_type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+            self.push_sdl_event(game, event_type, (2 * x, 50 + 2 * y))
+        game.loop()
+        self.assertEqual(clicks, [menu])
+
+
+class TestFrameProfiler(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.game.fps = 0
+        self.game.add_object("sprite", Sprite, "images/level/0.png", x=100, y=100)
+        self.profiler = self.game.profiler
+
+    def press(self, key):
+        self.profiler.handle_event(pygame.event.Event(pygame.KEYDOWN, key=key))
+
+    def test_phase_timings(self, *_):
+        for _ in range(3):
+            self.game.loop()
+        self.assertEqual(len(self.profiler.frames), 3)
+        frame = self.profiler.frames[-1]
+        for phase in (*self.profiler.phases, "total"):
+            self.assertGreaterEqual(frame[phase], 0)
+        self.assertEqual(frame["objects"], {})
+
+    def test_overlay_records_objects(self, *_):
+        self.press(self.profiler.overlay_key)
+        self.assertTrue(self.profiler.overlay)
+        self.game.loop()
+        self.game.loop()
+        count, update, draw = self.profiler.frames[-1]["objects"]["Sprite"]
+        self.assertEqual(count, 1)
+        self.assertGreater(draw, 0)
+        self.press(self.profiler.overlay_key)
+        self.assertFalse(self.profiler.detailed)
+
+    def test_ring_buffer(self, *_):
+        self.profiler.frames = engine.deque(maxlen=2)
+        for _ in range(5):
+            self.game.loop()
+        self.assertEqual(len(self.profiler.frames), 2)
+
+    def test_export_and_capture(self, *_):
+        with tempfile.TemporaryDirectory() as directory, patch(
+            "engine.PROFILE_DIR", directory
+        ), patch("pstats.Stats.print_stats"):
+            self.profiler.detailed = True
+            self.game.loop()
+            path = self.profiler.export_csv()
+            with open(path) as f:
+                rows = f.read().splitlines()
+            self.assertEqual(len(rows), 2)
+            self.assertIn("Sprite.draw", rows[0])
+
+            self.profiler.capture(2)
+            self.game.loop()
+            self.assertIsNotNone(self.profiler.profile)
+            self.game.loop()
+            self.assertIsNone(self.profiler.profile)
+            self.assertTrue(
+                any(name.endswith(".prof") for name in os.listdir(directory))
+            )
+
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.player = self.game.add_object(
+            "player",
+            Player,
+            move_acceleration=0.5,
+            friction=0.1,
+            jump_acceleration=10,
+            gravity=0.5,
+            image_path="images/level/0.png",
+            x=100,
+            y=100,
+        )
+
+    def acquire(self, name="shot", **kwargs):
+        return self.game.acquire_object(
+            name,
+            attacks.ShootAttack,
+            parent=self.player,
+            image_path="images/attacks/shoot0.png",
+            **kwargs,
+        )
+
+    def test_acquire_and_release(self, *_):
+        shot = self.acquire(x=10, y=20, x_velocity=5)
+        self.assertIs(self.game.objects["shot"], shot)
+        self.game.release_object(shot)
+        self.assertNotIn("shot", self.game.objects)
+        self.assertIsNone(shot.parent)
+        reused = self.acquire(x=30, y=40, max_distance=50)
+        self.assertIs(reused, shot)
+        self.assertEqual((reused.x, reused.y), (30, 40))
+        self.assertEqual(reused.rect.topleft, (30, 40))
+        self.assertEqual(reused.x_velocity, 0)
+        self.assertEqual(reused.max_distance, 50)
+        self.assertEqual(reused.distance, 0)
+        self.assertIs(reused.parent, self.player)
+
+    def test_stats(self, *_):
+        shots = [self.acquire(f"shot{i}") for i in range(3)]
+        for shot in shots[:2]:
+            self.game.release_object(shot)
+        self.game.release_object(shots[0])  # Released twice, counted once
+        self.acquire()
+        self.assertEqual(
+            self.game.pool_stats()["ShootAttack"],
+            {"in_use": 2, "free": 1, "peak": 3, "created": 3, "reused": 1},
+        )
+
+    def test_released_on_loop(self, *_):
+        shot = self.acquire(x=1000000, y=0)
+        self.player._shots = 1
+        shot.loop()
+        self.assertNotIn(shot, self.game.objects.values())
+        self.assertEqual(self.player._shots, 0)
+        self.assertIs(self.acquire(), shot)
+
+    def test_sounds_are_cached(self, *_):
+        self.game.mixer = MagicMock()
+        self.game.play_sound("sounds/shoot.wav")
+        self.game.play_sound("sounds/shoot.wav")
+        self.game.mixer.Sound.assert_called_once_with("sounds/shoot.wav")
+        self.assertEqual(self.game.sounds["sounds/shoot.wav"].play.call_count, 2)
+
+
+class TestAtlas(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.atlas = engine.Atlas(page_size=512).build("images")
+
+    def assertSamePixels(self, a, b):
+        self.assertEqual(a.get_size(), b.get_size())
+        self.assertEqual(
+            pygame.image.tobytes(a, "RGBA"), pygame.image.tobytes(b, "RGBA")
+        )
+
+    def test_build_packs_every_image(self, *_):
+        paths = {path for path, _ in self.atlas.regions}
+        self.assertIn("images/player0.png", paths)
+        self.assertIn("images/level/18.png", paths)
+        self.assertIn("images/attacks/shoot0.png", paths)
+        self.assertIn("images/Menu/Start.png", paths)
+        self.assertIn("images/fps-logo.svg", paths)
+        # Too big for a page, stays a separate surface
+        self.assertNotIn("images/Menu/Background.png", paths)
+        self.assertIn(("images/Menu/Start.png", "hover"), self.atlas.regions)
+        self.assertNotIn(("images/player0.png", "hover"), self.atlas.regions)
+        self.assertLess(len(self.atlas.pages), len(paths))
+
+    def test_regions_do_not_overlap(self, *_):
+        for page in self.atlas.pages:
+            rects = [
+                pygame.Rect(region.get_offset(), region.get_size())
+                for region in self.atlas.regions.values()
+                if region.get_parent() is page
+            ]
+            self.assertTrue(page.get_rect().contains(rects[0].unionall(rects)))
+            for i, rect in enumerate(rects):
+                self.assertEqual(rect.collidelist(rects[i + 1 :]), -1)
+
+    def test_variants_match_source(self, *_):
+        image = pygame.image.load("images/Menu/Start.png")
+        self.assertSamePixels(self.atlas.get("images/Menu/Start.png"), image)
+        self.assertSamePixels(
+            self.atlas.get("images/Menu/Start.png", "flipped"),
+            pygame.transform.flip(image, True, False),
+        )
+        self.assertEqual(
+            self.atlas.get("images/Menu/Start.png", "hover").get_size(),
+            (int(image.get_width() * 1.3), int(image.get_height() * 1.3)),
+        )
+
+    def test_missing_image_is_added(self, *_):
+        pages = len(self.atlas.pages)
+        region = self.atlas.get("images/Menu/Background.png")
+        self.assertGreater(len(self.atlas.pages), pages)
+        self.assertIs(self.atlas.get("images/Menu/Background.png"), region)
+
+    def test_sprites_share_atlas_regions(self, *_):
+        a = Sprite(self.game, "images/player0.png", 0, 0)
+        b = Sprite(self.game, "images/player0.png", 10, 10)
+        self.assertIs(a.image1, b.image1)
+        self.assertIs(a.image2, b.image2)
+        self.assertIsNotNone(a.image1.get_parent())
+        self.assertIn(a.image1.get_parent(), self.game.atlas.pages)
+
+
+class TestImagePack(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.images = os.path.join(self.directory, "images")
+        os.makedirs(os.path.join(self.images, "Menu"))
+        for name in ("player0.png", "fps-logo.svg", "Menu/Start.png"):
+            shutil.copy(f"images/{name}", os.path.join(self.images, name))
+        self.path = os.path.join(self.directory, "images.pack")
+        self.index = assets.build_pack(self.images, self.path)
+        self.pack = engine.ImagePack(self.path)
+
+    def test_index(self, *_):
+        entry = self.index[f"{self.images}/player0.png"]
+        self.assertEqual(entry["format"], "RGBA")
+        self.assertEqual(entry["offset"] % assets.ALIGNMENT, 0)
+        self.assertEqual(entry["length"], entry["size"][0] * entry["size"][1] * 4)
+        self.assertEqual(len(self.index), 3)
+
+    def test_load_from_pack(self, *_):
+        for path in self.index:
+            image = self.pack.load(path)
+            self.assertEqual(
+                pygame.image.tobytes(image, "RGBA"),
+                pygame.image.tobytes(pygame.image.load(path), "RGBA"),
+            )
+        self.assertEqual((self.pack.hits, self.pack.misses), (3, 0))
+
+    def test_stale_image_is_decoded(self, *_):
+        path = f"{self.images}/player0.png"
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(self.pack.load(path).get_size(), (65, 70))
+        self.assertEqual((self.pack.hits, self.pack.misses), (0, 1))
+
+    def test_missing_pack(self, *_):
+        pack = engine.ImagePack(os.path.join(self.directory, "missing.pack"))
+        self.assertEqual(pack.load("images/player0.png").get_size(), (65, 70))
+        self.assertEqual(pack.misses, 1)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.atlas = engine.Atlas()
+        self.paths = ["images/player0.png", "images/attacks/shoot0.png"]
+
+    def test_decodes_on_worker_thread(self, *_):
+        threads = set()
+
+        def load(path):
+            threads.add(threading.current_thread())
+            return pygame.image.load(path)
+
+        with patch("engine.load_image", side_effect=load):
+            prefetch = engine.Prefetcher(images=self.paths).start()
+            self.assertTrue(prefetch.wait(5))
+        self.assertEqual(threads, {prefetch.thread})
+        self.assertEqual(list(prefetch.images), self.paths)
+
+    def test_install_packs_once_ready(self, *_):
+        prefetch = engine.Prefetcher(images=self.paths)
+        self.assertFalse(prefetch.install(self.atlas))
+        prefetch.start().wait(5)
+        self.assertTrue(prefetch.install(self.atlas))
+        self.assertFalse(prefetch.install(self.atlas))
+        self.assertEqual(len(self.atlas.pages), 1)
+        for path in self.paths:
+            self.assertIn((path, "flipped"), self.atlas.regions)
+        pages = len(self.atlas.pages)
+        self.atlas.get("images/player0.png")
+        self.assertEqual(len(self.atlas.pages), pages)
+
+    def test_result_and_errors(self, *_):
+        prefetch = engine.Prefetcher(lambda p: p.load_images(self.paths) or 42)
+        prefetch.start().wait(5)
+        self.assertEqual(prefetch.result, 42)
+        self.assertEqual(len(prefetch.images), 2)
+        prefetch = engine.Prefetcher(images=["images/missing.png"]).start()
+        self.assertTrue(prefetch.wait(5))
+        self.assertIsInstance(prefetch.error, Exception)
+        self.assertTrue(prefetch.install(self.atlas))
+
+    def test_server_starts_from_prefetched_level(self, *_):
+        server = network.Server()
+        server.game = self.game
+        server.players = {("a", 1): None}
+        server.prefetch = engine.Prefetcher(server.prefetch_match).start()
+        server.prefetch.wait(5)
+        self.assertIn("images/level/18.png", server.prefetch.images)
+        self.assertIn("images/player2.png", server.prefetch.images)
+        with patch("network.load_level_data") as load_level_data:
+            server.start_game()
+        load_level_data.assert_not_called()
+        self.assertTrue(server.prefetch.installed)
+        self.assertEqual(len(server.game.objects["level"].sprites), 19)
+
 
 class TestSprite(unittest.TestCase):
     def setUp(self):
@@ -70,6 +606,14 @@ class TestSprite(unittest.TestCase):
         self.assertEqual(self.sprite.y, 200)
         self.assertEqual(self.sprite.rect.y, 200)
 
+    def test_position_is_x_and_y(self, *_):
+        self.sprite.x_move(-10.5)
+        self.sprite.pos.y = 0  # A copy
+        self.assertEqual(self.sprite.pos, pygame.Vector2(89.5, 100))
+        self.assertEqual(self.sprite.rect.topleft, (89, 100))
+        with self.assertRaises(AttributeError):
+            self.sprite.__dict__
+
     def test_x_move(self, *_):
         self.sprite.x_move(10)
         self.assertNotEqual(self.sprite.x, 100)  # Since dt is not set, it will change
@@ -229,6 +773,16 @@ class TestMenu(unittest.TestCase):
         self.button_distance = 10
         self.menu = self.Menu1(self.game)
 
+    def click(self, button, release=None):
+        pygame.event.post(
+            pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=button.rect.center, button=1)
+        )
+        pygame.event.post(
+            pygame.event.Event(
+                pygame.MOUSEBUTTONUP, pos=(release or button).rect.center, button=1
+            )
+        )
+
     def test_init(self, *_):
         self.assertIsInstance(self.menu.buttons, list)
         self.assertEqual(len(self.menu.buttons), 2)
@@ -239,6 +793,42 @@ class TestMenu(unittest.TestCase):
         self.menu.loop()
         # No assertion, just ensure no exceptions
 
+    def test_click_on_event(self, *_):
+        clicks = []
+        self.game.add_object("menu", self.Menu1, x=400, y=100)
+        menu = self.game.objects["menu"]
+        menu.buttons[1].func = clicks.append
+        self.click(menu.buttons[1])
+        self.click(menu.buttons[1], release=menu.buttons[0])  # Dragged off
+        self.game.loop()
+        self.assertEqual(clicks, [menu])
+        self.assertEqual(menu.buttons[1].direction, 1)
+        self.assertEqual(menu.buttons[0].direction, -1)
+
+    @patch("pygame.mouse.get_pos", side_effect=AssertionError)
+    @patch("pygame.mouse.get_pressed", side_effect=AssertionError)
+    def test_idle_menu_does_not_poll(self, *_):
+        self.game.objects["menu"] = self.menu
+        self.game.loop()
+
+    def test_removed_menu_stops_handling(self, *_):
+        clicks = []
+        self.game.objects["menu"] = self.menu
+        self.menu.buttons[0].func = clicks.append
+        self.game.objects.clear()
+        self.click(self.menu.buttons[0])
+        self.game.loop()
+        self.assertEqual(clicks, [])
+        self.assertEqual(self.game.handlers, {})
+
+    @patch("pygame.image.load", side_effect=AssertionError)
+    def test_images_come_from_atlas(self, *_):
+        menu = self.Menu1(self.game)
+        self.assertEqual(
+            menu.buttons[0].x,
+            400 - self.game.atlas.get("images/level/0.png").get_width() / 2,
+        )
+
 
 class TestPlayer(unittest.TestCase):
     def setUp(self):
@@ -290,7 +880,7 @@ class TestPlayer(unittest.TestCase):
             "jump": True,
             "shoot": False,
         }
-        with patch.object(self.player, "colliding", return_value=True):
+        with patch.object(Player, "colliding", return_value=True):
             self.player.read_controls()
             self.assertEqual(self.player.y_velocity, -10)
 
@@ -305,13 +895,9 @@ class TestPlayer(unittest.TestCase):
         self.assertEqual(self.player.y_velocity, 5.5)  # 5 + 0.5
 
     def test_loop(self, *_):
-        with patch.object(
-            self.player, "read_controls"
-        ) as mock_read_controls, patch.object(
-            self.player, "simulate"
-        ) as mock_simulate, patch.object(
-            Sprite, "loop"
-        ) as mock_super_loop:
+        with patch.object(Player, "read_controls") as mock_read_controls, patch.object(
+            Player, "simulate"
+        ) as mock_simulate, patch.object(Sprite, "loop") as mock_super_loop:
             self.player.loop()
             mock_read_controls.assert_called_once()
             mock_simulate.assert_called_once()
@@ -333,7 +919,7 @@ class TestPlayer(unittest.TestCase):
 
     def test_y_move_no_collision(self, *_):
         self.player.y_velocity = 5
-        with patch.object(self.player, "colliding", return_value=False):
+        with patch.object(Player, "colliding", return_value=False):
             self.player.simulate()
             self.assertEqual(self.player.y_velocity, 5.5)
 
@@ -354,7 +940,7 @@ class TestPlayer(unittest.TestCase):
             "jump": True,
             "shoot": False,
         }
-        with patch.object(self.player, "colliding", return_value=True):
+        with patch.object(Player, "colliding", return_value=True):
             self.player.read_controls()
             self.assertEqual(self.player.y_velocity, -10)
 
@@ -367,11 +953,7 @@ class TestPlayer(unittest.TestCase):
         }
         self.player.read_controls()
         self.player.read_controls()
-        attack_count = 0
-        for obj in self.game.objects.values():
-            if isinstance(obj, attacks.ShootAttack):
-                attack_count += 1
-        self.assertEqual(attack_count, 1)
+        self.assertEqual(len(self.game.objects["projectiles"]), 1)
 
     def test_check_fall(self, *_):
         self.player.y = 10000000
@@ -407,17 +989,6 @@ class TestLevel(unittest.TestCase):
         self.assertEqual(self.level.sprites[0].x, 400)
         self.assertEqual(self.level.sprites[0].y, 300)
 
-    @patch("builtins.open", new_callable=mock_open, read_data="0,0\n100,100")
-    def test_load(self, mock_file, *_):
-        image_filepath = "images/level/{}.png"
-        level = Level.load(self.game, "level.csv", image_filepath)
-        self.assertEqual(len(level.sprites), 2)
-        self.assertEqual(level.sprites[0].x, 400)
-        self.assertEqual(level.sprites[0].y, 0)
-        self.assertEqual(level.sprites[1].x, 500)
-        self.assertEqual(level.sprites[1].y, 100)
-        mock_file.assert_called_once_with("level.csv")
-
     def test_loop(self, *_):
         with patch.object(self.level, "y_move") as mock_y_move, patch.object(
             self.level, "check_teleport"
@@ -428,6 +999,164 @@ class TestLevel(unittest.TestCase):
             mock_draw.assert_called_once()
 
 
+class TestLevelIndex(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.rng = bench.random.Random(1)
+        self.level = bench.add_level(self.game, 200, self.rng)
+        self.level.y_velocity = 3.5
+        for sprite in self.level.sprites[::7]:
+            sprite.collidable = False
+        for sprite in self.level.sprites:
+            sprite.teleport = {"+y": {self.game.height: -100}}
+        self.probe = Sprite(self.game, "images/player0.png", 0, 0)
+
+    def brute_force(self):
+        return [
+            sprite
+            for sprite in self.level.sprites
+            if sprite.collidable and self.probe.rect.colliderect(sprite.rect)
+        ]
+
+    def check_probes(self):
+        for _ in range(50):
+            self.probe.x = self.rng.uniform(-50, self.game.width)
+            self.probe.y = self.rng.uniform(-200, self.game.height)
+            expected = self.brute_force()
+            near = self.level.sprites_near(self.probe.rect)
+            self.assertTrue(all(sprite in near for sprite in expected))
+            self.assertEqual(bool(self.probe.colliding()), bool(expected))
+            self.assertEqual(
+                self.probe.collides_with(self.level),
+                any(
+                    self.probe.rect.colliderect(sprite.rect)
+                    for sprite in self.level.sprites
+                ),
+            )
+
+    def test_matches_brute_force(self, *_):
+        self.check_probes()
+        self.assertLess(
+            len(self.level.sprites_near(self.probe.rect)), len(self.level.sprites)
+        )
+
+    def test_matches_after_moving_and_teleporting(self, *_):
+        teleported = False
+        for _ in range(120):
+            self.level.loop()
+            teleported = teleported or self.level.index is None
+            self.check_probes()
+        self.assertTrue(teleported)
+
+    def test_projectiles_use_index(self, *_):
+        projectiles = attacks.ProjectileSystem.of(self.game)
+        with patch.object(
+            self.level, "sprites_near", wraps=self.level.sprites_near
+        ) as sprites_near:
+            shooter = Player(
+                self.game,
+                image_path="images/player0.png",
+                move_acceleration=0,
+                friction=0,
+                jump_acceleration=0,
+                gravity=0,
+            )
+            shooter._shots = 1
+            projectiles.spawn(shooter, "images/attacks/shoot0.png", x=100, y=100)
+            projectiles.loop()
+            sprites_near.assert_called_once()
+
+
+class TestCompiledLevel(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.source = os.path.join(self.directory, "levels")
+        self.compiled = os.path.join(self.directory, "build")
+        os.makedirs(self.source)
+        with open(os.path.join(self.source, "test.json"), "w") as f:
+            f.write(
+                '{"y_velocity": 2, "teleport": {"+y": {"1080": -440}},'
+                ' "spawns": [[0, 200], [100, 200]],'
+                ' "platforms": [[-270, -870], {"x": 160, "y": -780,'
+                ' "image": "images/level/5.png", "collidable": false}]}'
+            )
+        with open(os.path.join(self.source, "flat.csv"), "w") as f:
+            f.write("0,0\n100,100\n")
+
+    def load(self, name):
+        return level_module.load_level_data(name, self.source, self.compiled)
+
+    def test_round_trip(self, *_):
+        data = level_module.LevelData.from_source(
+            os.path.join(self.source, "test.json")
+        )
+        loaded = level_module.LevelData.from_bytes(data.to_bytes())
+        for field in ("images", "platforms", "spawns", "teleport", "y_velocity"):
+            self.assertEqual(getattr(loaded, field), getattr(data, field))
+        self.assertEqual(loaded.images, ["images/level/0.png", "images/level/5.png"])
+        width, height = pygame.image.load("images/level/5.png").get_size()
+        self.assertEqual(loaded.platforms[1], (160, -780, width, height, 1, 0))
+        self.assertEqual(loaded.teleport, {"+y": {1080: -440}})
+
+    def test_from_data(self, *_):
+        level = Level.from_data(self.game, self.load("test"))
+        self.assertEqual((level.sprites[0].x, level.sprites[0].y), (130, -870))
+        self.assertTrue(level.sprites[0].collidable)
+        self.assertFalse(level.sprites[1].collidable)
+        self.assertEqual(level.sprites[1].rect.size, level.sprites[1].image.get_size())
+        self.assertEqual(level.spawns, [pygame.Vector2(400, 200), (500, 200)])
+        self.assertEqual(level.y_velocity, 2)
+        self.assertEqual(
+            Level.from_data(self.game, self.load("test"), y_velocity=0).y_velocity, 0
+        )
+
+    def test_csv_source(self, *_):
+        level = Level.from_data(self.game, self.load("flat"))
+        self.assertEqual(
+            [(sprite.x, sprite.y) for sprite in level.sprites], [(400, 0), (500, 100)]
+        )
+
+    def test_compiled_file_is_used_until_stale(self, *_):
+        self.load("test")
+        compiled = os.path.join(self.compiled, "test.lvl")
+        self.assertTrue(os.path.exists(compiled))
+        with patch.object(
+            level_module.LevelData, "from_source", side_effect=AssertionError
+        ):
+            self.assertEqual(len(self.load("test").platforms), 2)
+        source = os.path.join(self.source, "test.json")
+        os.utime(source, (time.time() + 10, time.time() + 10))
+        with patch.object(
+            level_module.LevelData,
+            "from_source",
+            wraps=level_module.LevelData.from_source,
+        ) as from_source:
+            self.load("test")
+            from_source.assert_called_once()
+
+    def test_available_levels(self, *_):
+        self.assertEqual(
+            level_module.available_levels(self.source, self.compiled), ["flat", "test"]
+        )
+        self.assertIn("classic", level_module.available_levels())
+        with self.assertRaises(FileNotFoundError):
+            self.load("missing")
+
+    def test_server_uses_spawns(self, *_):
+        server = network.Server()
+        server.game = self.game
+        server.players = {("a", 1): None, ("b", 2): None}
+        server.start_game()
+        centre = server.game.width / 2
+        self.assertEqual(
+            [player.pos for player in server.players.values()],
+            [pygame.Vector2(centre, 200), pygame.Vector2(centre + 100, 200)],
+        )
+        self.assertEqual(len(server.game.objects["level"].sprites), 19)
+
+
 class TestShootAttack(unittest.TestCase):
     def setUp(self):
         self.game = Game((800, 600))
@@ -457,7 +1186,7 @@ class TestShootAttack(unittest.TestCase):
 
     def test_loop(self, *_):
         self.game.objects["shoot_attack"] = self.attack
-        dummy_sprite = self.game.add_object(
+        target = self.game.add_object(
             "sprite",
             Player,
             image_path="images/level/0.png",
@@ -468,17 +1197,173 @@ class TestShootAttack(unittest.TestCase):
             jump_acceleration=0,
             gravity=0,
         )
-        with patch.object(dummy_sprite, "on_hit") as mock_on_hit:
+        with patch.object(Player, "on_hit", autospec=True) as mock_on_hit:
             self.attack.loop()
             self.assertEqual(self.attack.x, self.attack.x_velocity)
             self.assertEqual(self.attack.y, self.attack.y_velocity)
-            mock_on_hit.assert_called_once()
+            mock_on_hit.assert_called_once_with(target, self.attack)
             self.assertNotIn("shoot_attack", self.game.objects)
         self.game.objects["shoot_attack"] = self.attack
         self.attack.x = 1000000
         self.attack.loop()
         self.assertNotIn("shoot_attack", self.game.objects)
 
+    def test_shared_image_keeps_alpha(self, *_):
+        image = self.attack.image1
+        alpha = image.get_alpha()
+        self.attack.x_velocity = self.attack.y_velocity = 0  # Distance stays 0
+        self.attack.loop()
+        self.assertEqual(image.get_alpha(), alpha)
+
+
+class TestProjectileSystem(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.shooter = self.add_player("shooter", 100, 100)
+        self.target = self.add_player("target", 300, 100)
+        self.projectiles = attacks.ProjectileSystem.of(self.game)
+
+    def add_player(self, name, x, y, game=None):
+        return (game or self.game).add_object(
+            name,
+            Player,
+            move_acceleration=0,
+            friction=0,
+            jump_acceleration=0,
+            gravity=0,
+            image_path="images/player0.png",
+            x=x,
+            y=y,
+        )
+
+    def spawn(self, **kwargs):
+        self.shooter._shots += 1
+        self.projectiles.spawn(
+            **{
+                "parent": self.shooter,
+                "image_path": "images/attacks/shoot0.png",
+                "x": 100,
+                "y": 110,
+                "x_velocity": 14,
+                "max_distance": 400,
+            }
+            | kwargs
+        )
+
+    def test_advance(self, *_):
+        self.spawn(y=-100)
+        self.projectiles.loop()
+        self.assertEqual(self.projectiles.x.tolist(), [114])
+        self.assertEqual(self.projectiles.distance.tolist(), [14])
+
+    def test_shared_image_keeps_alpha(self, *_):
+        image = self.game.atlas.get("images/attacks/shoot0.png")
+        alpha = image.get_alpha()
+        self.spawn(y=-100, max_distance=20)  # Faded to 100
+        self.projectiles.loop()
+        self.assertEqual(image.get_alpha(), alpha)
+
+    def rewind_target(self):
+        # The target stood still, then moved out of the way this tick
+        history = attacks.PositionHistory.of(self.game)
+        for _ in range(5):
+            history.loop()
+        self.target.y = -500
+        history.loop()
+        self.spawn(x=300, x_velocity=0)
+
+    def test_hit_where_the_shooter_saw_the_target(self, *_):
+        self.rewind_target()
+        self.shooter.rewind = 3
+        self.projectiles.loop()
+        self.assertLess(self.target.health, 100)
+        self.assertEqual(len(self.projectiles), 0)
+
+    def test_no_lag_misses_moved_target(self, *_):
+        self.rewind_target()
+        self.projectiles.loop()
+        self.assertEqual(self.target.health, 100)
+        self.assertEqual(len(self.projectiles), 1)
+
+    def test_rewind_is_capped(self, *_):
+        history = attacks.PositionHistory(self.game, max_rewind=2)
+        for y in range(5):
+            self.target.y = y
+            history.loop()
+        self.assertEqual(len(history.frames), 3)
+        self.assertEqual(history.rect(self.target, 10).y, 2)
+        self.assertEqual(history.rect(self.target, 1).y, 3)
+        self.assertIs(history.rect(self.target, 0), self.target.rect)
+        self.assertEqual(attacks.rewind_ticks(0.08), 5)
+        self.assertEqual(attacks.rewind_ticks(5), attacks.MAX_REWIND_TICKS)
+
+    def test_hit(self, *_):
+        self.spawn(x=290)
+        self.projectiles.loop()
+        self.assertEqual(len(self.projectiles), 0)
+        self.assertEqual(self.target.health, 95)
+        self.assertEqual(self.target.x_velocity, 7)
+        self.assertEqual(self.shooter.health, 100)
+        self.assertEqual(self.shooter._shots, 0)
+
+    def test_culling(self, *_):
+        self.spawn(y=-100, x=790)
+        self.spawn(y=-100, max_distance=10)
+        self.spawn(y=-100)
+        self.projectiles.loop()
+        self.assertEqual(len(self.projectiles), 1)
+        self.assertEqual(self.shooter._shots, 1)
+
+    def test_growth(self, *_):
+        for i in range(100):
+            self.spawn(y=-100 - i)
+        self.assertEqual(len(self.projectiles), 100)
+        self.assertEqual(self.projectiles.y[-1], -199)
+
+    def test_sprite_states(self, *_):
+        self.spawn(direction=-1)
+        self.assertEqual(
+            network.sprite_states(self.projectiles),
+            [("images/attacks/shoot0.png", 100, 110, -1)],
+        )
+
+    def test_matches_shoot_attack(self, *_):
+        # The batch system must hit and cull exactly like individual ShootAttacks
+        game = Game((800, 600))
+        shooter = self.add_player("shooter", 100, 100, game)
+        target = self.add_player("target", 300, 100, game)
+        shots = [(100, 110, 14), (100, 200, 14), (400, 110, -14), (700, 110, 14)]
+        for x, y, velocity in shots:
+            self.spawn(x=x, y=y, x_velocity=velocity)
+            shooter._shots += 1
+            game.add_object(
+                f"shot{x}{y}{velocity}",
+                attacks.ShootAttack,
+                parent=shooter,
+                image_path="images/attacks/shoot0.png",
+                x=x,
+                y=y,
+                x_velocity=velocity,
+                max_distance=400,
+                collidable=False,
+            )
+        for _ in range(40):
+            for obj in list(game.objects.values()):
+                if isinstance(obj, attacks.ShootAttack):
+                    obj.loop()
+            self.projectiles.loop()
+            remaining = sorted(
+                (o.x, o.y)
+                for o in game.objects.values()
+                if isinstance(o, attacks.ShootAttack)
+            )
+            self.assertEqual(
+                sorted(zip(self.projectiles.x.tolist(), self.projectiles.y.tolist())),
+                remaining,
+            )
+            self.assertEqual(self.target.health, target.health)
+            self.assertEqual(self.shooter._shots, shooter._shots)
+
 
 class TestNetwork(unittest.TestCase):
     @patch("psutil.net_if_addrs")
@@ -494,5 +1379,623 @@ class TestNetwork(unittest.TestCase):
         self.assertIsNone(get_wlan_ip())
 
 
+class TestServerMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = network.Server("127.0.0.1", 0, metrics_port=0)
+        self.server.start_server()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.server.stop_server()
+        self.client.close()
+
+    def exchange(self, data):
+        self.client.sendto(data, self.server.server.getsockname())
+        self.server.process_incoming_messages()
+
+    def test_histogram(self, *_):
+        histogram = metrics.Histogram((1, 10))
+        for value in (0.5, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(histogram.to_dict()["buckets"], {"1": 1, "10": 2, "+Inf": 3})
+        self.assertEqual(histogram.max, 50)
+
+    def test_traffic_counters(self, *_):
+        self.exchange(network.JOIN_GAME)
+        ok = self.client.recvfrom(1024)[0]
+        self.assertTrue(ok.startswith(network.OK))
+        self.exchange(network.ECHO)
+        stats = self.server.metrics.to_dict()
+        self.assertEqual(stats["packets_in"], {"join_game": 1, "echo": 1})
+        self.assertEqual(stats["bytes_out"]["ok"], len(ok))
+        self.assertEqual(len(stats["clients"]), 1)
+
+    def test_rtt(self, *_):
+        self.exchange(network.JOIN_GAME)
+        self.client.recvfrom(1024)
+        self.server.ping_clients()
+        data = self.client.recvfrom(1024)[0]
+        self.assertTrue(data.startswith(network.PING))
+        self.exchange(network.PONG + data[len(network.PING) :])
+        (client,) = self.server.metrics.to_dict()["clients"].values()
+        self.assertGreaterEqual(client["rtt"], 0)
+        self.assertEqual(client["rtt"], client["srtt"])
+
+    def test_rtt_sets_rewind(self, *_):
+        self.exchange(network.JOIN_GAME)
+        self.client.recvfrom(1024)
+        self.server.start_game()
+        self.exchange(network.PONG + struct.pack("!d", time.time() - 0.1))
+        self.server.latch_controls()
+        (player,) = self.server.players.values()
+        self.assertEqual(player.rewind, 6)
+        self.assertIn("history", self.server.game.objects)
+
+    def test_snapshot_metrics(self, *_):
+        self.server.game.add_object("sprite", Sprite, "images/level/0.png", x=0, y=0)
+        self.server.encode_snapshot()
+        stats = self.server.metrics.to_dict()
+        self.assertEqual(stats["snapshot_bytes"]["count"], 1)
+        self.assertNotIn("compression_ratio", stats)
+
+    def test_http_endpoint(self, *_):
+        self.exchange(network.ECHO)
+        host, port = self.server.metrics_server.address
+        with urllib.request.urlopen(f"http://{host}:{port}/stats") as response:
+            stats = network.json.loads(response.read())
+        self.assertEqual(stats["packets_in"]["echo"], 1)
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+            text = response.read().decode()
+        self.assertIn('fps_server_packets_in_total{type="echo"} 1', text)
+
+
+class TestSessions(unittest.TestCase):
+    def setUp(self):
+        self.server = network.Server("127.0.0.1", 0)
+        self.server.start_server()
+        self.server.server.settimeout(1)
+        self.clients = []
+
+    def tearDown(self):
+        self.server.stop_server()
+        for client in self.clients:
+            client.close()
+
+    def new_client(self):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(1)
+        self.clients.append(client)
+        return client
+
+    def exchange(self, client, data):
+        client.sendto(data, self.server.server.getsockname())
+        self.server.process_incoming_messages()
+
+    def join(self, client, token=b""):
+        self.exchange(client, network.JOIN_GAME + token)
+        data = client.recvfrom(1024)[0]
+        return data[len(network.OK) + 1 :] if data.startswith(network.OK) else data
+
+    def test_join_twice_keeps_one_session(self, *_):
+        client = self.new_client()
+        token = self.join(client)
+        self.assertEqual(self.join(client), token)
+        self.assertEqual(len(self.server.sessions), 1)
+        self.assertEqual(list(self.server.players), [token.decode()])
+
+    def test_idle_client_is_evicted(self, *_):
+        client = self.new_client()
+        self.join(client)
+        self.server.waiting = False
+        self.server.broadcast_game_state()
+        self.server.broadcast_game_state()
+        self.server.evict_idle(time.time() + sessions.SESSION_TIMEOUT + 1)
+        self.assertEqual(len(self.server.sessions), 0)
+        stats = self.server.metrics.to_dict()["sessions"]
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["wasted_sends"], 3)  # OK and two snapshots
+        self.assertEqual(stats["disconnected"], 1)
+        self.assertEqual(self.server.metrics.clients, {})
+        sent = self.server.metrics.packets_out["snapshot"]
+        self.server.broadcast_game_state()
+        self.assertEqual(self.server.metrics.packets_out["snapshot"], sent)
+
+    def test_lobby_timeout_frees_slot(self, *_):
+        self.join(self.new_client())
+        self.server.evict_idle(time.time() + sessions.SESSION_TIMEOUT + 1)
+        self.assertEqual(self.server.players, {})
+        self.assertEqual(self.server.sessions.by_token, {})
+
+    def test_reconnect_from_new_address(self, *_):
+        token = self.join(self.new_client())
+        self.server.start_game()
+        self.server.waiting = False
+        player = self.server.players[token.decode()]
+        self.server.evict_idle(time.time() + sessions.SESSION_TIMEOUT + 1)
+        self.assertEqual(self.join(self.new_client()), network.GAME_ALREADY_STARTED)
+        client = self.new_client()
+        self.assertEqual(self.join(client, b":" + token), token)
+        self.assertEqual(self.server.sessions.reconnects, 1)
+        self.exchange(client, network.SEND_CONTROLS + b'{"left": true}')
+        self.server.latch_controls()
+        self.assertIs(self.server.players[token.decode()], player)
+        self.assertEqual(player.controls, {"left": True})
+
+    def test_strays_are_not_tracked(self, *_):
+        stray = self.new_client()
+        self.exchange(stray, network.ECHO)
+        self.exchange(stray, network.PONG + struct.pack("!d", time.time()))
+        self.assertEqual(self.server.metrics.clients, {})
+        self.join(self.new_client())
+        self.assertEqual(len(self.server.metrics.clients), 1)
+
+    def test_rebind_forgets_old_address(self, *_):
+        old = self.new_client()
+        token = self.join(old)
+        client = self.new_client()
+        self.join(client, b":" + token)
+        self.assertEqual(
+            list(self.server.metrics.clients),
+            [f"127.0.0.1:{client.getsockname()[1]}"],
+        )
+
+    def test_released_player_is_not_rewound(self, *_):
+        token = self.join(self.new_client()).decode()
+        self.server.start_game()
+        self.server.waiting = False
+        self.server.rewinds[token] = 6
+        self.server.latch_controls()
+        self.server.evict_idle(time.time() + sessions.SESSION_TIMEOUT + 1)
+        self.server.latch_controls()
+        self.assertEqual(self.server.players[token].rewind, 0)
+
+    def test_leave(self, *_):
+        client = self.new_client()
+        self.join(client)
+        self.exchange(client, network.LEAVE)
+        self.assertEqual(len(self.server.sessions), 0)
+        self.assertEqual(self.server.players, {})
+
+    def test_reliable_channel(self, *_):
+        sender = sessions.ReliableChannel(timeout=1)
+        receiver = sessions.ReliableChannel()
+        sender.send(b"a")
+        sender.send(b"b")
+        self.assertEqual(sender.due(10), [(1, b"a"), (2, b"b")])
+        self.assertEqual(sender.due(10.5), [])
+        self.assertEqual(receiver.receive(2, b"b"), [])
+        self.assertEqual(receiver.take_ack(), 0)
+        self.assertEqual(sender.due(11), [(1, b"a"), (2, b"b")])
+        self.assertEqual(sender.due(12), [])  # Backed off to 2 seconds
+        self.assertEqual(receiver.receive(1, b"a"), [b"a", b"b"])
+        self.assertEqual(receiver.receive(1, b"a"), [])
+        sender.acked(receiver.take_ack())
+        self.assertIsNone(receiver.take_ack())
+        self.assertEqual(sender.due(20), [])
+        self.assertEqual((sender.sent, sender.retransmits), (2, 2))
+
+    def test_game_over_is_reliable(self, *_):
+        client = self.new_client()
+        self.join(client)
+        self.server.start_game()
+        self.server.waiting = False
+        for player in self.server.alive_players[1:]:
+            player.dead = True
+        self.server.check_game_over()
+        self.server.send_reliable(1)
+        data = client.recvfrom(1024)[0]
+        self.assertTrue(data.startswith(network.RELIABLE))
+        self.assertIn(network.GAME_OVER, data)
+        self.server.send_reliable(1.1)
+        client.settimeout(0.05)
+        self.assertRaises(socket.timeout, client.recvfrom, 1024)
+        self.server.send_reliable(1.3)
+        self.assertEqual(client.recvfrom(1024)[0], data)
+        self.exchange(client, network.ACK + data[len(network.RELIABLE) :][:4])
+        self.server.send_reliable(10)
+        self.assertRaises(socket.timeout, client.recvfrom, 1024)
+        self.assertEqual(self.server.metrics.to_dict()["sessions"]["retransmits"], 1)
+
+
+class TestClientReconcile(unittest.TestCase):
+    def setUp(self):
+        self.client = network.Client("127.0.0.1", 0)
+
+    def state(self, *names, image="images/level/0.png"):
+        return [(name, image, i, 0, 1) for i, name in enumerate(names)]
+
+    def test_keyed_create_and_destroy(self, *_):
+        self.client.reconcile(self.state("player0", "shot0"))
+        player = self.client.game.objects["player0"]
+        shot = self.client.game.objects["shot0"]
+        self.client.reconcile(self.state("player0", "shot1"))
+        self.assertIs(self.client.game.objects["player0"], player)
+        self.assertNotIn("shot0", self.client.game.objects)
+        self.assertEqual(self.client.entity_counts, {"created": 3, "destroyed": 1})
+        self.client.reconcile(self.state("player0", "shot1", "shot2"))
+        self.assertIs(self.client.game.objects["shot2"], shot)  # From the pool
+        self.assertEqual(self.client.game.pool_stats()["Sprite"]["reused"], 1)
+
+    def test_update_in_place(self, *_):
+        self.client.reconcile(self.state("player0"))
+        player = self.client.game.objects["player0"]
+        self.client.reconcile([("player0", "images/level/1.png", 5, 6, 1)])
+        self.assertIs(self.client.game.objects["player0"], player)
+        self.assertEqual(player.image_path, "images/level/1.png")
+        self.assertEqual((player.x, player.y), (5, 6))
+        self.assertEqual(self.client.entity_counts["created"], 1)
+
+    def test_leaves_other_objects(self, *_):
+        self.client.game.objects["sound"] = MagicMock()
+        self.client.reconcile(self.state("player0"))
+        self.client.reconcile(())
+        self.assertEqual(list(self.client.game.objects), ["sound"])
+
+    def test_rates(self, *_):
+        self.client.rate_window = (time.time() - 2, dict(self.client.entity_counts))
+        self.client.reconcile(self.state("a", "b", "c", "d"))
+        self.assertAlmostEqual(self.client.entity_rates["created"], 2, places=1)
+        self.assertIs(
+            self.client.game.profiler.counters["entities"], self.client.entity_rates
+        )
+
+    def receive(self, data):
+        self.client.receive_buffer[: len(data)] = data
+        self.client.store_snapshot(len(data))
+
+    def test_snapshot_round_trip(self, *_):
+        server = network.Server()
+        server.game.add_object("sprite", Sprite, "images/level/0.png", x=1.4, y=-2)
+        server.game.add_object(
+            "level",
+            MultiSprite,
+            sprite_args=[{"image_path": "images/level/1.png", "x": 5, "y": 6}] * 2,
+        )
+        self.receive(server.encode_snapshot())
+        with self.client.snapshot_lock:
+            entities = list(self.client.snapshot_entities())
+        self.assertEqual(
+            entities,
+            [
+                ("sprite0", "images/level/0.png", 1, -2, 1),
+                ("level0", "images/level/1.png", 5, 6, 1),
+                ("level1", "images/level/1.png", 5, 6, 1),
+            ],
+        )
+        self.assertEqual(self.client.last_sequence, 1)
+
+    def test_snapshot_fits_a_datagram(self, *_):
+        server = network.Server()
+        server.game.add_object(
+            "level",
+            MultiSprite,
+            sprite_args=[{"image_path": "images/level/1.png", "x": 5, "y": 6}] * 6000,
+        )
+        data = server.encode_snapshot()
+        self.assertLessEqual(len(data), network.BUFFER_SIZE)
+        self.receive(data)
+        with self.client.snapshot_lock:
+            count = len(list(self.client.snapshot_entities()))
+        self.assertGreater(count, 0)
+        dropped = server.metrics.to_dict()["snapshot_dropped_entities"]
+        self.assertEqual(count + dropped, 6000)
+
+    def test_snapshot_strings_cut_on_characters(self, *_):
+        server = network.Server()
+        server.intern("images" + "é" * 200)
+        (string,) = server.strings
+        self.assertEqual(len(string), 254)
+        string.decode()
+
+    def test_snapshot_waits_for_string_table(self, *_):
+        server = network.Server()
+        server.game.add_object("sprite", Sprite, "images/level/0.png", x=0, y=0)
+        for _ in range(network.STRING_REPEAT + 1):
+            data = bytes(server.encode_snapshot())
+        self.assertFalse(network.snapshot_header(data)[5])
+        self.receive(data)
+        self.assertEqual(self.client.snapshot_size, 0)
+        for _ in range(network.STRING_REPEAT - 1):
+            data = server.encode_snapshot()
+        self.assertTrue(network.snapshot_header(data)[5])
+        self.receive(data)
+        self.assertEqual(self.client.snapshot_size, len(data))
+        # A new match starts a new table
+        server.start_game()
+        self.receive(server.encode_snapshot())
+        self.assertEqual(self.client.string_epoch, server.string_epoch)
+
+
+class TestRelay(unittest.TestCase):
+    def test_ring_buffer(self, *_):
+        ring = relay.RingBuffer(size=64)
+        try:
+            self.assertIsNone(ring.pop())
+            for i in range(10):
+                # 24 bytes per record, so every other push wraps around
+                self.assertTrue(ring.push(bytes([i]) * 20))
+                self.assertEqual(ring.pop(), bytes([i]) * 20)
+            self.assertTrue(ring.push(b"a" * 20))
+            self.assertTrue(ring.push(b"b" * 20))
+            self.assertFalse(ring.push(b"c" * 20))
+            self.assertEqual(ring.get(relay.DROPPED), 1)
+            self.assertEqual((ring.pop(), ring.pop()), (b"a" * 20, b"b" * 20))
+            self.assertIsNone(ring.pop())
+        finally:
+            ring.close(unlink=True)
+
+    def receive(self, sock, timeout=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                return sock.recvfrom(1024)
+            except BlockingIOError:
+                time.sleep(0.001)
+        self.fail("Nothing received")
+
+    def test_relay_socket(self, *_):
+        sock = relay.RelaySocket(("127.0.0.1", 0))
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(2)
+        try:
+            client.sendto(b"hello", sock.getsockname())
+            data, address = self.receive(sock)
+            self.assertEqual(data, b"hello")
+            self.assertEqual(address[1], client.getsockname()[1])
+            self.assertLessEqual(sock.last_arrival, time.time())
+            sock.sendto(b"world", address)
+            self.assertEqual(client.recvfrom(1024)[0], b"world")
+        finally:
+            client.close()
+            sock.close()
+        self.assertEqual(sock.process.returncode, 0)
+
+    def test_relay_exits_without_parent(self, *_):
+        sock = relay.RelaySocket(("127.0.0.1", 0))
+        sock.process.stdin.close()  # As if the server died
+        self.assertEqual(sock.process.wait(2), 0)
+        sock.process.stdout.close()
+        for ring in (sock.inbound, sock.outbound):
+            ring.close()
+            with self.assertRaises(FileNotFoundError):
+                relay.shared_memory.SharedMemory(ring.name)
+            relay.resource_tracker.unregister(ring.memory._name, "shared_memory")
+        # The port is free for the next server
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM).bind(sock.address)
+
+    def test_server_network_process(self, *_):
+        server = network.Server("127.0.0.1", 0, network_process=True)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(2)
+        with server:
+            server.start_network()
+            client.sendto(network.JOIN_GAME, server.server.getsockname())
+            deadline = time.time() + 2
+            while not server.sessions and time.time() < deadline:
+                server.network_tick()
+            self.assertTrue(client.recvfrom(1024)[0].startswith(network.OK))
+            self.assertFalse(hasattr(server, "event_thread"))
+        client.close()
+
+
+class TestLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = loadtest.Bot(("127.0.0.1", 0))
+
+    def tearDown(self):
+        self.bot.close()
+
+    def snapshot(self, seq, sent_at):
+        return network.SNAPSHOT.pack(network.SNAPSHOT_MAGIC, seq, sent_at, 0, 0, 0, 0)
+
+    def test_decode_snapshot(self, *_):
+        magic, seq, sent_at, *_ = network.snapshot_header(self.snapshot(3, 1.5))
+        self.assertEqual((magic, seq, sent_at), (network.SNAPSHOT_MAGIC, 3, 1.5))
+
+    def test_packet_loss(self, *_):
+        for seq in (1, 2, 5, 4, 6):
+            self.bot.handle_snapshot(self.snapshot(seq, 10), 10.01)
+        self.assertEqual(self.bot.snapshots, 4)
+        self.assertEqual(self.bot.lost, 2)
+        self.assertEqual(len(self.bot.latencies), 4)
+
+    def test_scripted_controls(self, *_):
+        self.bot.script = [{"left": True}, {"right": True}]
+        sent = [network.json.loads(self.bot.next_controls()) for _ in range(3)]
+        self.assertEqual(sent, [{"left": True}, {"right": True}, {"left": True}])
+
+    def test_percentiles(self, *_):
+        stats = loadtest.percentiles(list(range(1, 101)))
+        self.assertAlmostEqual(stats["p50"], 50.5)
+        self.assertEqual(stats["max"], 100)
+        self.assertIsNone(loadtest.percentiles([])["p99"])
+
+    def test_dead_worker_fails_the_stage(self, *_):
+        ctx = multiprocessing.get_context("spawn")
+        worker = ctx.Process(target=sys.exit, args=(3,))
+        worker.start()
+        worker.join()
+        with self.assertRaisesRegex(RuntimeError, "code 3"):
+            loadtest.collect_reports(ctx.Queue(), 1, [worker], time.time() + 60)
+
+    def test_dead_server_fails_the_stage(self, *_):
+        taken = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        taken.bind(("127.0.0.1", 0))
+        self.addCleanup(taken.close)
+        with self.assertRaisesRegex(RuntimeError, "Load test server exited"):
+            loadtest.run_stage(taken.getsockname(), 1, 1, 0.5, None, 0, local=True)
+
+    @patch("sys.stderr")
+    def test_stages_need_local(self, *_):
+        with self.assertRaises(SystemExit):
+            loadtest.main(["--bots", "1", "2"])
+
+
+class TestImpairmentProxy(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(1)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(1)
+        self.proxy = netproxy.ImpairmentProxy(self.server.getsockname(), seed=1)
+        self.proxy.start()
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.server.close()
+        self.client.close()
+
+    def send(self, data):
+        self.client.sendto(data, self.proxy.address)
+
+    def test_forward_both_directions(self, *_):
+        self.send(b"ping")
+        data, address = self.server.recvfrom(1024)
+        self.assertEqual(data, b"ping")
+        self.server.sendto(b"pong", address)
+        self.assertEqual(self.client.recvfrom(1024)[0], b"pong")
+
+    def test_latency(self, *_):
+        self.proxy.set(latency=0.05)
+        start = time.time()
+        self.send(b"ping")
+        data, address = self.server.recvfrom(1024)
+        self.server.sendto(b"pong", address)
+        self.client.recvfrom(1024)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_loss(self, *_):
+        self.proxy.set(loss=1)
+        self.server.settimeout(0.1)
+        self.send(b"ping")
+        with self.assertRaises(socket.timeout):
+            self.server.recvfrom(1024)
+        self.assertEqual(self.proxy.stats["upstream"]["dropped"], 1)
+
+    def test_duplicate(self, *_):
+        self.proxy.upstream.duplicate = 1
+        self.send(b"ping")
+        self.assertEqual(self.server.recvfrom(1024)[0], b"ping")
+        self.assertEqual(self.server.recvfrom(1024)[0], b"ping")
+
+    def test_reorder(self, *_):
+        self.proxy.upstream.reorder = 1
+        self.send(b"first")
+        while self.proxy.stats["upstream"]["received"] < 1:
+            time.sleep(0.001)
+        self.proxy.upstream.reorder = 0
+        self.send(b"second")
+        self.assertEqual(self.server.recvfrom(1024)[0], b"second")
+        self.assertEqual(self.server.recvfrom(1024)[0], b"first")
+
+    def test_unknown_setting(self, *_):
+        with self.assertRaises(AttributeError):
+            self.proxy.set(bandwidth=1)
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.game = Game((800, 600))
+        self.level = self.game.add_object(
+            "level",
+            Level,
+            sprite_args=[
+                {"image_path": "images/level/0.png", "x": 300, "y": 300},
+                {"image_path": "images/level/1.png", "x": 500, "y": 200},
+            ],
+            y_velocity=1,
+        )
+        self.player_args = [
+            {
+                "image_path": f"images/player{i}.png",
+                "x": 300 + 100 * i,
+                "y": 100,
+                "move_acceleration": 4,
+                "friction": 0.25,
+                "jump_acceleration": 24,
+                "gravity": 2,
+            }
+            for i in range(2)
+        ]
+        self.players = [
+            self.game.add_object(f"player{i}", Player, **args)
+            for i, args in enumerate(self.player_args)
+        ]
+        self.recorder = replay.Recorder()
+        self.recorder.start(self.game, self.level, self.player_args)
+        script = [
+            {"right": True},
+            {"right": True, "jump": True},
+            {"left": True, "shoot": True},
+            {},
+        ]
+        for tick in range(120):
+            for i, player in enumerate(self.players):
+                player.controls = script[(tick // 10 + i) % len(script)]
+            self.recorder.record(self.game, self.players)
+            self.game.update()
+        self.recording = self.recorder.recording
+
+    def test_pack_controls(self, *_):
+        controls = {"left": True, "right": False, "jump": True, "shoot": False}
+        self.assertEqual(
+            player_module.unpack_controls(player_module.pack_controls(controls)),
+            controls,
+        )
+
+    def test_replay_matches(self, *_):
+        result = replay.Replayer(self.recording, Game((800, 600))).run()
+        self.assertEqual(result["ticks"], 120)
+        self.assertIsNone(result["first_mismatch"])
+
+    def test_replay_uses_recorded_rewind(self, *_):
+        self.assertEqual(self.recording["rewinds"][0], (0, 0))
+        self.recording["rewinds"] = [(12, 0)] * 120
+        replayer = replay.Replayer(self.recording, Game((800, 600)))
+        replayer.run(check=False)
+        self.assertEqual(replayer.players[0].rewind, 12)
+        self.assertIn("history", replayer.game.objects)
+
+    def test_replay_detects_divergence(self, *_):
+        self.recording["controls"][50] = (0b0001, 0b0010)
+        result = replay.Replayer(self.recording, Game((800, 600))).run()
+        self.assertEqual(result["first_mismatch"], 51)
+
+    def test_save_and_load(self, *_):
+        with tempfile.TemporaryDirectory() as directory:
+            self.recorder.directory = directory
+            path = self.recorder.stop()
+            self.assertFalse(self.recorder.active)
+            self.assertEqual(replay.load_recording(path), self.recording)
+
+
+class TestBench(unittest.TestCase):
+    def test_scenarios_run(self, *_):
+        results = dict(bench.run_benchmarks(counts=[2], repeat=1, min_time=0))
+        self.assertEqual(
+            {result["scenario"] for result in results.values()}, set(bench.scenarios)
+        )
+        for result in results.values():
+            self.assertGreater(result["best"], 0)
+
+    def test_compare(self, *_):
+        baseline = {"results": {"a[1]": {"best": 1.0}, "b[1]": {"best": 1.0}}}
+        current = {
+            "results": {
+                "a[1]": {"best": 1.5},
+                "b[1]": {"best": 0.5},
+                "c[1]": {"best": 1.0},
+            }
+        }
+        statuses = {
+            row[0]: row[4] for row in bench.compare(baseline, current, threshold=0.1)
+        }
+        self.assertEqual(
+            statuses, {"a[1]": "REGRESSION", "b[1]": "improved", "c[1]": "new"}
+        )
+
+
 if __name__ == "__main__":
     unittest.main()